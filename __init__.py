@@ -2,26 +2,76 @@
 """
 Plugin to store some usual PostgreSQL functions
 
+Operators and hooks are imported on first access (`from postgres_plugin import PostgresToS3Operator`
+or `PostgresPlugin.operators`), so loading the plugins folder doesn't import psycopg2, boto3 and the
+other plugins until a task needs them.
+
 """
 # pylint: disable=import-error,missing-docstring,too-few-public-methods
+import importlib
+import sys
+
 from airflow.plugins_manager import AirflowPlugin
 
-from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+# Public name -> module defining it
+_LAZY_IMPORTS = {
+    'PostgresWithSecretsManagerCredentialsHook': 'postgres_plugin.hooks.postgres_hook',
+    'PostgresWithSecretsManagerCredentialsOperator': 'postgres_plugin.operators.postgres_operator',
+    'PostgresToPostgresOperator': 'postgres_plugin.operators.postgres_operator',
+    'PostgresToS3Operator': 'postgres_plugin.operators.postgres_to_s3_operator',
+    'S3ToPostgresOperator': 'postgres_plugin.operators.postgres_to_s3_operator',
+    'PostgresDumpOperator': 'postgres_plugin.operators.postgres_dump_operator',
+    'PostgresFleetOperator': 'postgres_plugin.operators.postgres_fleet_operator',
+    'PostgresRestoreOperator': 'postgres_plugin.operators.postgres_restore_operator',
+}
+
+__all__ = ['PostgresPlugin'] + sorted(_LAZY_IMPORTS)
+
+
+def _resolve(name):
+    """
+    Import a public name from its module, and keep it in module globals so next accesses are direct
+    """
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __getattr__(name):
+    if name in _LAZY_IMPORTS:
+        return _resolve(name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_IMPORTS))
+
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ (PEP 562): import everything now
+    for _name in _LAZY_IMPORTS:
+        _resolve(_name)
+
 
-from postgres_plugin.operators.postgres_operator import PostgresWithSecretsManagerCredentialsOperator
-from postgres_plugin.operators.postgres_operator import PostgresToPostgresOperator
+class _LazyClasses(object):
+    """
+    Plugin class attribute resolving its classes when read
+    """
 
-from postgres_plugin.operators.postgres_to_s3_operator import PostgresToS3Operator
-from postgres_plugin.operators.postgres_to_s3_operator import S3ToPostgresOperator
+    def __init__(self, *names):
+        self.names = names
 
-from postgres_plugin.operators.postgres_dump_operator import PostgresDumpOperator
+    def __get__(self, instance, owner):
+        return [_resolve(name) for name in self.names]
 
 
 class PostgresPlugin(AirflowPlugin):
     name = "postgres_plugin"
-    operators = [PostgresWithSecretsManagerCredentialsOperator,
-                 PostgresToPostgresOperator,
-                 PostgresToS3Operator,
-                 S3ToPostgresOperator,
-                 PostgresDumpOperator]
-    hooks = [PostgresWithSecretsManagerCredentialsHook]
+    operators = _LazyClasses('PostgresWithSecretsManagerCredentialsOperator',
+                             'PostgresToPostgresOperator',
+                             'PostgresToS3Operator',
+                             'S3ToPostgresOperator',
+                             'PostgresDumpOperator',
+                             'PostgresFleetOperator',
+                             'PostgresRestoreOperator')
+    hooks = _LazyClasses('PostgresWithSecretsManagerCredentialsHook')
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the import time of the plugin, as paid by every Airflow process loading the plugins folder
+(scheduler, webserver, workers, DAG file processors).
+
+Each measure runs in a fresh interpreter: `import postgres_plugin` alone, then each public name
+(`from postgres_plugin import X`). Airflow itself is imported before the clock starts, since every
+Airflow process has already paid for it. The median of several runs is reported with the heavy
+modules (psycopg2, boto3, other plugins...) loaded by the import.
+
+`--eager` resolves every operator and hook right after the plugin import, like the plugin did before
+operators were loaded lazily, to measure the before/after difference on the same tree.
+
+Run from the Airflow plugins folder:
+
+    python -m postgres_plugin.benchmarks.import_time --output import_time.json
+    python -m postgres_plugin.benchmarks.import_time --compare import_time.json --output import_time_new.json
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+PLUGIN = 'postgres_plugin'
+HEAVY_MODULES = ('psycopg2', 'boto3', 'botocore', 'aws_plugin', 'bash_plugin', 'airflow.hooks.postgres_hook',
+                 'airflow.hooks.S3_hook')
+NAMES = ('PostgresWithSecretsManagerCredentialsHook',
+         'PostgresWithSecretsManagerCredentialsOperator',
+         'PostgresToPostgresOperator',
+         'PostgresToS3Operator',
+         'S3ToPostgresOperator',
+         'PostgresDumpOperator',
+         'PostgresFleetOperator',
+         'PostgresRestoreOperator')
+
+# Runs in the child interpreter: argv = plugin name, name to import (or ''), eager flag, heavy modules
+MEASURE = '''
+import json, sys, time
+import airflow.models
+plugin, name, eager, heavy = sys.argv[1], sys.argv[2], sys.argv[3] == '1', sys.argv[4].split(',')
+started_at = time.time()
+module = __import__(plugin)
+if eager:
+    for attribute in module.__all__:
+        getattr(module, attribute)
+if name:
+    getattr(module, name)
+seconds = time.time() - started_at
+print(json.dumps({'seconds': seconds, 'loaded': [m for m in heavy if m in sys.modules]}))
+'''
+
+
+def measure(name, eager, runs):
+    """
+    Median import time of `name` (plugin alone when empty) over `runs` fresh interpreters
+
+    :rtype: dict
+    """
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', MEASURE, PLUGIN, name, '1' if eager else '0', ','.join(HEAVY_MODULES)])
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.append(result['seconds'])
+        loaded = result['loaded']
+    return {
+        'name': name or PLUGIN,
+        'median_seconds': round(statistics.median(timings), 4),
+        'min_seconds': round(min(timings), 4),
+        'heavy_modules': loaded,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Annotate results with their change against a baseline run, returning regressed names
+    """
+    previous = dict((result['name'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get(result['name'])
+        if not before or not before['median_seconds']:
+            continue
+        result['change'] = result['median_seconds'] / before['median_seconds'] - 1
+        if result['change'] > threshold:
+            regressions.append(result['name'])
+    return regressions
+
+
+def print_results(results):
+    print('{:<48} {:>10} {:>10} {:>8}  {}'.format('import', 'median ms', 'min ms', 'change', 'heavy modules'))
+    for result in results:
+        print('{:<48} {:>10.1f} {:>10.1f} {:>8}  {}'.format(
+            result['name'], result['median_seconds'] * 1000, result['min_seconds'] * 1000,
+            '{:+.1%}'.format(result['change']) if 'change' in result else '',
+            ', '.join(result['heavy_modules'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7, help='fresh interpreters per measure')
+    parser.add_argument('--eager', action='store_true', help='resolve every operator and hook (previous behaviour)')
+    parser.add_argument('--output', default='import_time.json', help='JSON results file')
+    parser.add_argument('--compare', help='previous JSON results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='import time increase reported as regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in ('',) + NAMES:
+        print('Measuring {}...'.format(name or PLUGIN), file=sys.stderr)
+        results.append(measure(name, args.eager, args.runs))
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args), 'created_at': time.time(), 'results': results}, f, indent=2)
+
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
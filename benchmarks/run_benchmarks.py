@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the transfer operators against a throwaway local PostgreSQL and an in-process S3 stand-in.
+
+A temporary PostgreSQL cluster is created with initdb/pg_ctl, a moto server provides S3, Secrets Manager
+and KMS, and a synthetic source table is generated. Each case runs in its own process so peak RSS is
+measured per case, with TMPDIR pointing to a dedicated directory whose peak size is recorded.
+
+Results (rows/s, MB/s, peak RSS, temp disk bytes and wall time per operator and mode) are written to
+JSON, and can be compared to a previous run to detect regressions.
+
+Requires PostgreSQL server binaries (initdb, pg_ctl, pg_dump), Airflow, psycopg2, boto3 and moto.
+Run from the Airflow plugins folder:
+
+    python -m postgres_plugin.benchmarks.run_benchmarks --rows 1000000 --output bench.json
+    python -m postgres_plugin.benchmarks.run_benchmarks --compare bench.json --output bench_new.json
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+# Heavy imports are made inside functions: Airflow imports every module of the plugins folder.
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SOURCE_TABLE = 'bench_source'
+DEST_TABLE = 'bench_dest'
+S3_BUCKET = 'bench-bucket'
+SECRET_NAME = 'bench/postgres'
+AWS_CONN_ID = 'aws_default'
+MB = 1024.0 * 1024.0
+
+
+# Cases: name -> (operator, function running it). Functions receive the benchmark environment dict.
+
+def _pg_conn(env):
+    return {'aws_conn_id': AWS_CONN_ID, 'aws_secret_name': SECRET_NAME, 'database': env['dbname']}
+
+
+def _pg_to_s3(env, case, **kwargs):
+    from postgres_plugin.operators.postgres_to_s3_operator import PostgresToS3Operator
+    PostgresToS3Operator(task_id='bench_{}'.format(case),
+                         sql='SELECT * FROM {}'.format(SOURCE_TABLE),
+                         dest_s3_bucket_name=S3_BUCKET,
+                         dest_s3_key_name='output/{}/data'.format(case),
+                         src_postgres_conn=_pg_conn(env),
+                         dest_s3_conn_id=AWS_CONN_ID,
+                         dest_s3_replace=True,
+                         **kwargs).execute({})
+
+
+def _s3_to_pg(env, case, **kwargs):
+    from postgres_plugin.operators.postgres_to_s3_operator import S3ToPostgresOperator
+    kwargs.setdefault('s3_key_name', 'input/data.tsv')
+    S3ToPostgresOperator(task_id='bench_{}'.format(case),
+                         postgres_conn=_pg_conn(env),
+                         dest_table_name=DEST_TABLE,
+                         dest_table_columns=None,
+                         s3_conn_id=AWS_CONN_ID,
+                         s3_bucket_name=S3_BUCKET,
+                         **kwargs).execute({})
+
+
+def _pg_to_pg(env, case, **kwargs):
+    from postgres_plugin.operators.postgres_operator import PostgresToPostgresOperator
+    PostgresToPostgresOperator(task_id='bench_{}'.format(case),
+                               sql='SELECT * FROM {}'.format(SOURCE_TABLE),
+                               pg_table=DEST_TABLE,
+                               src_postgres_conn=_pg_conn(env),
+                               dest_postgres_conn=_pg_conn(env),
+                               **kwargs).execute({})
+
+
+def _dump(env, case, **kwargs):
+    from postgres_plugin.operators.postgres_dump_operator import PostgresDumpOperator
+    operator = PostgresDumpOperator(task_id='bench_{}'.format(case),
+                                    db_name=env['dbname'],
+                                    secret_name=SECRET_NAME,
+                                    s3_bucket_name=S3_BUCKET,
+                                    aws_kms_key_arn=env['kms_key_arn'],
+                                    **kwargs)
+    operator.s3_key_name = 'dumps/{}/{{dump_name}}'.format(case)
+    operator.execute({})
+
+
+CASES = [
+    ('pg_to_s3.tempfile', 'PostgresToS3Operator', lambda env, case: _pg_to_s3(env, case)),
+    ('pg_to_s3.tempfile_gzip', 'PostgresToS3Operator', lambda env, case: _pg_to_s3(env, case, compress_file=True)),
+    ('pg_to_s3.streaming', 'PostgresToS3Operator', lambda env, case: _pg_to_s3(env, case, streaming=True)),
+    ('pg_to_s3.streaming_pgzip', 'PostgresToS3Operator',
+     lambda env, case: _pg_to_s3(env, case, streaming=True, compression='pgzip')),
+    ('pg_to_s3.streaming_zstd', 'PostgresToS3Operator',
+     lambda env, case: _pg_to_s3(env, case, streaming=True, compression='zstd')),
+    ('pg_to_s3.parquet', 'PostgresToS3Operator', lambda env, case: _pg_to_s3(env, case, output_format='parquet')),
+    ('pg_to_s3.shards_4', 'PostgresToS3Operator',
+     lambda env, case: _pg_to_s3(env, case, shards=4, shard_column='id')),
+    ('s3_to_pg.tempfile', 'S3ToPostgresOperator', lambda env, case: _s3_to_pg(env, case)),
+    ('s3_to_pg.streaming', 'S3ToPostgresOperator', lambda env, case: _s3_to_pg(env, case, streaming=True)),
+    ('s3_to_pg.streaming_gzip', 'S3ToPostgresOperator',
+     lambda env, case: _s3_to_pg(env, case, streaming=True, s3_key_name='input/data.tsv.gz')),
+    ('s3_to_pg.prefix_4', 'S3ToPostgresOperator',
+     lambda env, case: _s3_to_pg(env, case, s3_key_name=None, s3_prefix='input/parts/', load_concurrency=4)),
+    ('pg_to_pg.insert', 'PostgresToPostgresOperator', lambda env, case: _pg_to_pg(env, case)),
+    ('pg_to_pg.copy_text', 'PostgresToPostgresOperator', lambda env, case: _pg_to_pg(env, case, transfer_mode='copy')),
+    ('pg_to_pg.copy_binary', 'PostgresToPostgresOperator',
+     lambda env, case: _pg_to_pg(env, case, transfer_mode='copy', copy_format='binary')),
+    ('pg_to_pg.batch', 'PostgresToPostgresOperator', lambda env, case: _pg_to_pg(env, case, transfer_mode='batch')),
+    ('pg_to_pg.copy_partitioned_4', 'PostgresToPostgresOperator',
+     lambda env, case: _pg_to_pg(env, case, transfer_mode='copy', partition_column='id', parallelism=4)),
+    ('dump.streaming', 'PostgresDumpOperator', lambda env, case: _dump(env, case, streaming=True)),
+    ('dump.streaming_zstd', 'PostgresDumpOperator',
+     lambda env, case: _dump(env, case, streaming=True, compression='zstd')),
+    ('dump.parallel_4', 'PostgresDumpOperator', lambda env, case: _dump(env, case, parallel_jobs=4)),
+]
+
+
+# Local services
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def pg_bin(name):
+    path = shutil.which(name)
+    if path:
+        return path
+    bindir = subprocess.check_output(['pg_config', '--bindir']).decode().strip()
+    return os.path.join(bindir, name)
+
+
+def start_postgres(work_dir):
+    """
+    Create and start a throwaway PostgreSQL cluster
+
+    :return: connection settings
+    :rtype: dict
+    """
+    data_dir = os.path.join(work_dir, 'pgdata')
+    port = free_port()
+    subprocess.check_call([pg_bin('initdb'), '-D', data_dir, '-U', 'bench', '--auth=trust'],
+                          stdout=subprocess.DEVNULL)
+    subprocess.check_call([pg_bin('pg_ctl'), '-D', data_dir, '-w', '-l', os.path.join(work_dir, 'postgres.log'),
+                           '-o', '-p {} -k {} -c listen_addresses=localhost -c fsync=off'.format(port, work_dir),
+                           'start'], stdout=subprocess.DEVNULL)
+    return {'data_dir': data_dir, 'host': 'localhost', 'port': port, 'user': 'bench',
+            'password': 'bench', 'dbname': 'postgres'}
+
+
+def stop_postgres(pg):
+    subprocess.call([pg_bin('pg_ctl'), '-D', pg['data_dir'], '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+
+
+def start_aws_mock():
+    """
+    Start an in-process moto server and point boto3 to it
+
+    :return: moto server
+    """
+    from moto.server import ThreadedMotoServer
+    port = free_port()
+    server = ThreadedMotoServer(port=port)
+    server.start()
+    os.environ.update({
+        'AWS_ENDPOINT_URL': 'http://localhost:{}'.format(port),
+        'AWS_ACCESS_KEY_ID': 'bench',
+        'AWS_SECRET_ACCESS_KEY': 'bench',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+    })
+    return server
+
+
+def pg_connect(pg):
+    import psycopg2
+    conn = psycopg2.connect(host=pg['host'], port=pg['port'], user=pg['user'], dbname=pg['dbname'])
+    conn.autocommit = True
+    return conn
+
+
+def prepare_data(pg, rows, columns, width, parts):
+    """
+    Create source table, destination table, S3 bucket, input files, secret and KMS key
+
+    :return: benchmark environment shared with cases
+    :rtype: dict
+    """
+    import boto3
+    import gzip
+
+    conn = pg_connect(pg)
+    cursor = conn.cursor()
+    text_columns = ', '.join("substr(repeat(md5((g + {i})::text), {repeat}), 1, {width}) AS c{i}".format(
+        i=i, repeat=width // 32 + 1, width=width) for i in range(columns))
+    cursor.execute('DROP TABLE IF EXISTS {}'.format(SOURCE_TABLE))
+    cursor.execute('CREATE TABLE {table} AS SELECT g AS id, now() - g * interval \'1 second\' AS created_at, '
+                   '{columns} FROM generate_series(1, %s) AS g'.format(table=SOURCE_TABLE, columns=text_columns),
+                   (rows,))
+    cursor.execute('ALTER TABLE {} ADD PRIMARY KEY (id)'.format(SOURCE_TABLE))
+    cursor.execute('ANALYZE {}'.format(SOURCE_TABLE))
+    cursor.execute('DROP TABLE IF EXISTS {}'.format(DEST_TABLE))
+    cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING ALL)'.format(DEST_TABLE, SOURCE_TABLE))
+    cursor.execute('SELECT sum(pg_column_size(t.*)) FROM {} AS t'.format(SOURCE_TABLE))
+    data_bytes = int(cursor.fetchone()[0] or 0)
+
+    s3 = boto3.client('s3')
+    s3.create_bucket(Bucket=S3_BUCKET)
+
+    # Input files for S3ToPostgresOperator: text COPY output with a header line
+    with tempfile.TemporaryFile() as f:
+        f.write(b'header\n')
+        cursor.copy_expert('COPY {} TO STDOUT'.format(SOURCE_TABLE), f)
+        f.seek(0)
+        data = f.read()
+    s3.put_object(Bucket=S3_BUCKET, Key='input/data.tsv', Body=data)
+    s3.put_object(Bucket=S3_BUCKET, Key='input/data.tsv.gz', Body=gzip.compress(data))
+    lines = data.split(b'\n')[1:-1]
+    step = len(lines) // parts + 1
+    for part in range(parts):
+        body = b'header\n' + b''.join(line + b'\n' for line in lines[part * step:(part + 1) * step])
+        s3.put_object(Bucket=S3_BUCKET, Key='input/parts/part-{:04d}.tsv'.format(part), Body=body)
+
+    secret = {'username': pg['user'], 'engine': 'postgres', 'dbname': pg['dbname'], 'host': pg['host'],
+              'password': pg['password'], 'port': pg['port'], 'dbInstanceIdentifier': 'bench'}
+    boto3.client('secretsmanager').create_secret(Name=SECRET_NAME, SecretString=json.dumps(secret))
+    kms_key_arn = boto3.client('kms').create_key()['KeyMetadata']['Arn']
+
+    conn.close()
+    return {'dbname': pg['dbname'], 'rows': rows, 'data_bytes': data_bytes, 'kms_key_arn': kms_key_arn}
+
+
+def reset_destination(pg):
+    conn = pg_connect(pg)
+    conn.cursor().execute('TRUNCATE {}'.format(DEST_TABLE))
+    conn.close()
+
+
+# Measurement
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class DiskUsageMonitor(threading.Thread):
+    """
+    Poll a directory size and keep its peak
+    """
+
+    def __init__(self, path, interval=0.1):
+        super(DiskUsageMonitor, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak = max(self.peak, directory_size(self.path))
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, directory_size(self.path))
+
+
+def run_case_process(case_name, env, result_queue):
+    """
+    Child process: run one case and report wall time, peak RSS and error
+    """
+    import resource
+    case = dict((name, function) for name, _, function in CASES)[case_name]
+    started_at = time.time()
+    error = None
+    try:
+        case(env, case_name.replace('.', '_'))
+    except Exception as e:  # pylint: disable=broad-except
+        error = '{}: {}'.format(type(e).__name__, str(e))
+    wall_time = time.time() - started_at
+    # ru_maxrss is in kilobytes on Linux
+    result_queue.put({'wall_time': wall_time,
+                      'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                      'error': error})
+
+
+def run_case(case_name, operator, env, pg, work_dir):
+    import multiprocessing
+
+    reset_destination(pg)
+    temp_dir = os.path.join(work_dir, 'tmp', case_name)
+    os.makedirs(temp_dir)
+    os.environ['TMPDIR'] = temp_dir
+
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    monitor = DiskUsageMonitor(temp_dir)
+    monitor.start()
+    process = context.Process(target=run_case_process, args=(case_name, env, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    monitor.stop()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+    wall_time = result['wall_time']
+    result.update({
+        'case': case_name,
+        'operator': operator,
+        'rows': env['rows'],
+        'data_bytes': env['data_bytes'],
+        'temp_disk_bytes': monitor.peak,
+        'rows_per_sec': env['rows'] / wall_time if wall_time else 0,
+        'mb_per_sec': env['data_bytes'] / MB / wall_time if wall_time else 0,
+    })
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare throughput with a baseline run
+
+    :return: regressed case names
+    :rtype: list
+    """
+    baseline_cases = dict((result['case'], result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        previous = baseline_cases.get(result['case'])
+        if not previous or result['error'] or previous['error'] or not previous['rows_per_sec']:
+            continue
+        change = result['rows_per_sec'] / previous['rows_per_sec'] - 1
+        result['baseline_rows_per_sec'] = previous['rows_per_sec']
+        result['change'] = change
+        if change < -threshold:
+            regressions.append(result['case'])
+    return regressions
+
+
+def print_results(results):
+    print('{:<32} {:>10} {:>12} {:>9} {:>10} {:>12} {:>8}'.format(
+        'case', 'wall (s)', 'rows/s', 'MB/s', 'RSS (MB)', 'tmp (MB)', 'change'))
+    for result in results:
+        if result['error']:
+            print('{:<32} ERROR {}'.format(result['case'], result['error']))
+            continue
+        print('{:<32} {:>10.2f} {:>12.0f} {:>9.1f} {:>10.1f} {:>12.1f} {:>8}'.format(
+            result['case'], result['wall_time'], result['rows_per_sec'], result['mb_per_sec'],
+            result['peak_rss_bytes'] / MB, result['temp_disk_bytes'] / MB,
+            '{:+.1%}'.format(result['change']) if 'change' in result else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000, help='rows of the synthetic source table')
+    parser.add_argument('--columns', type=int, default=4, help='text columns of the synthetic source table')
+    parser.add_argument('--width', type=int, default=64, help='characters per text column')
+    parser.add_argument('--parts', type=int, default=8, help='input files for prefix loading cases')
+    parser.add_argument('--cases', default='', help='comma separated case name prefixes to run (default: all)')
+    parser.add_argument('--output', default='bench_results.json', help='JSON results file')
+    parser.add_argument('--compare', help='previous JSON results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='rows/s drop reported as regression')
+    args = parser.parse_args(argv)
+
+    prefixes = [prefix for prefix in args.cases.split(',') if prefix]
+    cases = [(name, operator) for name, operator, _ in CASES
+             if not prefixes or any(name.startswith(prefix) for prefix in prefixes)]
+
+    work_dir = tempfile.mkdtemp(prefix='postgres_plugin_bench')
+    pg = start_postgres(work_dir)
+    aws_mock = start_aws_mock()
+    try:
+        env = prepare_data(pg, args.rows, args.columns, args.width, args.parts)
+        results = []
+        for name, operator in cases:
+            print('Running {}...'.format(name), file=sys.stderr)
+            results.append(run_case(name, operator, env, pg, work_dir))
+    finally:
+        aws_mock.stop()
+        stop_postgres(pg)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump({'settings': vars(args), 'created_at': time.time(), 'results': results}, f, indent=2)
+
+    if regressions:
+        print('Regressions: {}'.format(', '.join(regressions)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,10 @@ This is useful to create a password rotation on RDS instance using Secrets Manag
 """
 # pylint: disable=import-error,missing-docstring,too-few-public-methods
 import ast
+import threading
+import time
+from collections import OrderedDict
+
 import psycopg2
 import psycopg2.extensions
 
@@ -26,6 +30,80 @@ from airflow.hooks.postgres_hook import PostgresHook as AirflowPostgresHook
 # Current plugin imports
 from aws_plugin.hooks.aws_secrets_manager_hook import AwsSecretsManagerHook
 
+from postgres_plugin.hooks.postgres_pool import get_pool
+from postgres_plugin.utils.metrics import TaskMetrics
+
+# Default lifetime (seconds) of a cached secret and maximum number of cached secrets per process
+SECRET_CACHE_TTL = 300
+SECRET_CACHE_MAX_SIZE = 128
+
+# Messages returned by PostgreSQL when the credentials are no longer valid (ex: after a password rotation)
+AUTHENTICATION_ERROR_MESSAGES = (
+    'password authentication failed',
+    'authentication failed',
+    'pam authentication failed',
+)
+
+
+class SecretsCache(object):
+    """
+    Process-wide, thread-safe TTL cache for AWS Secrets Manager payloads.
+    Least recently used entries are evicted when the cache is full.
+
+    :param max_size: maximum number of secrets kept in memory
+    :type max_size: int
+    """
+
+    def __init__(self, max_size=SECRET_CACHE_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.pop(key)
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=SECRET_CACHE_TTL):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + ttl)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+secrets_cache = SecretsCache()
+
+
+def is_authentication_error(error):
+    """
+    Check if a psycopg2 error was raised because of invalid credentials
+
+    :param error: exception raised by psycopg2
+    :type error: Exception
+    :rtype: bool
+    """
+    if getattr(error, 'pgcode', None) in ('28P01', '28000'):
+        return True
+    message = str(error).lower()
+    return any(msg in message for msg in AUTHENTICATION_ERROR_MESSAGES)
+
 
 class PostgresWithSecretsManagerCredentialsHook(AirflowPostgresHook):
     """
@@ -37,6 +115,16 @@ class PostgresWithSecretsManagerCredentialsHook(AirflowPostgresHook):
     :type aws_conn_id: string
     :param schema: name of database which overwrite defined one in connection
     :type schema: string
+    :param secret_cache_ttl: seconds to keep the secret in the process-wide cache (0 disables the cache)
+    :type secret_cache_ttl: int
+    :param use_pool: share connections with other hooks of this worker process through a connection pool
+    :type use_pool: bool
+    :param pool_kwargs: ConnectionPool arguments (min_size, max_size, idle_timeout...) used when creating the pool
+    :type pool_kwargs: dict
+    :param metrics: task metrics receiving `secret_fetch` and `connect` phase timings
+    :type metrics: TaskMetrics
+    :param conn_kwargs: extra psycopg2 connection arguments (ex: connect_timeout, options)
+    :type conn_kwargs: dict
 
     """
     conn_name_attr = 'aws_default'
@@ -49,8 +137,30 @@ class PostgresWithSecretsManagerCredentialsHook(AirflowPostgresHook):
         self.host = kwargs.pop("host", None)
         self.aws_conn_id = kwargs.pop("aws_conn_id", None)
         self.aws_secret_name = kwargs.pop("aws_secret_name", None)
+        self.secret_cache_ttl = kwargs.pop("secret_cache_ttl", SECRET_CACHE_TTL)
+        self.use_pool = kwargs.pop("use_pool", False)
+        self.pool_kwargs = kwargs.pop("pool_kwargs", None) or {}
+        self.metrics = kwargs.pop("metrics", None) or TaskMetrics(self.__class__.__name__)
+        self.conn_kwargs = kwargs.pop("conn_kwargs", None) or {}
 
-    def get_conn(self):
+    def get_secret(self, refresh=False):
+        """
+        Retrieve database credentials from AWS Secrets Manager, using the process-wide cache when possible
+
+        :param refresh: ignore cached value and fetch the secret again
+        :type refresh: bool
+        :return: Secret payload
+        :rtype: dict
+        """
+        cache_key = (self.aws_conn_id, self.aws_secret_name)
+        if refresh:
+            secrets_cache.invalidate(cache_key)
+        elif self.secret_cache_ttl:
+            aws_secret_key = secrets_cache.get(cache_key)
+            if aws_secret_key is not None:
+                self.log.info('Using cached AWS Secret Manager key [{}]'.format(self.aws_secret_name))
+                self.metrics.incr('secret_cache_hits')
+                return aws_secret_key
 
         self.log.info('Looking for AWS Secret Manager key [{}]'.format(self.aws_secret_name))
         secret_manager = AwsSecretsManagerHook(
@@ -58,14 +168,35 @@ class PostgresWithSecretsManagerCredentialsHook(AirflowPostgresHook):
             aws_conn_id=self.aws_conn_id
         )
 
-        aws_secret_key = ast.literal_eval(secret_manager.get_secret())
+        with self.metrics.phase('secret_fetch'):
+            aws_secret_key = ast.literal_eval(secret_manager.get_secret())
 
-        self.log.info('Got key to database [{}] on host [{}:{}]'.format(
-            self.schema or aws_secret_key['dbname'],
-            self.host or aws_secret_key['host'],
-            aws_secret_key['port']
-        ))
+        if self.secret_cache_ttl:
+            secrets_cache.set(cache_key, aws_secret_key, ttl=self.secret_cache_ttl)
+
+        return aws_secret_key
+
+    def get_conn(self):
 
+        aws_secret_key = self.get_secret()
+        try:
+            return self._connect(aws_secret_key)
+        except psycopg2.OperationalError as e:
+            if not is_authentication_error(e):
+                raise
+            # Password may have been rotated since secret was cached: fetch it again and retry once
+            self.log.warning('Authentication failed, refreshing AWS Secret Manager key [{}]'.format(
+                self.aws_secret_name))
+            self.metrics.incr('authentication_retries')
+            aws_secret_key = self.get_secret(refresh=True)
+            return self._connect(aws_secret_key)
+
+    def get_conn_args(self, aws_secret_key):
+        """
+        psycopg2 connection arguments from a secret payload
+
+        :rtype: dict
+        """
         # Expected dict format based on automatic AWS Secrets Manager's Lambda rotation function:
         # https://docs.aws.amazon.com/secretsmanager/latest/userguide/rotating-secrets-lambda-function-overview.html
         conn_args = dict(
@@ -74,6 +205,24 @@ class PostgresWithSecretsManagerCredentialsHook(AirflowPostgresHook):
             password=aws_secret_key['password'],
             dbname=self.schema or aws_secret_key['dbname'],
             port=aws_secret_key['port'] or 5432)
+        conn_args.update(self.conn_kwargs)
+        return conn_args
+
+    def _connect(self, aws_secret_key):
+
+        self.log.info('Got key to database [{}] on host [{}:{}]'.format(
+            self.schema or aws_secret_key['dbname'],
+            self.host or aws_secret_key['host'],
+            aws_secret_key['port']
+        ))
+
+        conn_args = self.get_conn_args(aws_secret_key)
 
-        psycopg2_conn = psycopg2.connect(**conn_args)
+        with self.metrics.phase('connect'):
+            if self.use_pool:
+                pool = get_pool(conn_args['host'], conn_args['port'], conn_args['dbname'], conn_args['user'],
+                                **self.pool_kwargs)
+                psycopg2_conn = pool.getconn(conn_args)
+            else:
+                psycopg2_conn = psycopg2.connect(**conn_args)
         return psycopg2_conn
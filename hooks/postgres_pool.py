@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Worker-level PostgreSQL connection pool
+
+Connections are shared by every hook (and so every operator) running in the same worker process
+that points to the same (host, port, database, user). Pooled connections are regular psycopg2
+connections whose `close()` returns them to the pool instead of closing the socket, so code using
+`contextlib.closing` (ex: `DbApiHook.run` and `DbApiHook.insert_rows`) works unchanged.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+logging = logging.getLogger(__name__)
+
+POOL_MIN_SIZE = 0
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_CHECKOUT_TIMEOUT = 60
+POOL_HEALTH_CHECK_INTERVAL = 30
+
+
+class PoolError(psycopg2.Error):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection returned to its pool when closed
+    """
+
+    pool = None
+    last_used = None
+
+    def close(self):
+        if self.pool is not None and not self.closed:
+            self.pool.putconn(self)
+        else:
+            super(PooledConnection, self).close()
+
+    def close_socket(self):
+        self.pool = None
+        if not self.closed:
+            super(PooledConnection, self).close()
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of connections to a single database user
+
+    :param min_size: connections kept open even when idle for longer than idle_timeout
+    :type min_size: int
+    :param max_size: maximum number of open connections (idle + checked out)
+    :type max_size: int
+    :param idle_timeout: seconds an idle connection is kept before being closed
+    :type idle_timeout: int
+    :param checkout_timeout: seconds to wait for a free connection when pool is exhausted
+    :type checkout_timeout: int
+    :param health_check_interval: idle seconds after which a connection is pinged before checkout
+    :type health_check_interval: int
+    """
+
+    def __init__(self,
+                 min_size=POOL_MIN_SIZE,
+                 max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 checkout_timeout=POOL_CHECKOUT_TIMEOUT,
+                 health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def getconn(self, conn_args):
+        """
+        Check out a healthy connection, opening a new one if needed
+
+        :param conn_args: psycopg2.connect arguments used to open new connections
+        :type conn_args: dict
+        :rtype: PooledConnection
+        """
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            with self._cond:
+                self._evict_idle()
+                conn = None
+                if self._idle:
+                    conn = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolError('Connection pool exhausted ({} connections)'.format(self.max_size))
+                    self._cond.wait(remaining)
+                    continue
+
+            if conn is None:
+                return self._open(conn_args)
+            if self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        """
+        Reset session state and give a connection back to the pool
+
+        :param conn: connection checked out from this pool
+        :type conn: PooledConnection
+        """
+        if not self._reset(conn):
+            self._discard(conn)
+            return
+        conn.last_used = time.time()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close_socket()
+
+    def _open(self, conn_args):
+        try:
+            conn = psycopg2.connect(connection_factory=PooledConnection, **conn_args)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        conn.pool = self
+        conn.last_used = time.time()
+        return conn
+
+    def _discard(self, conn):
+        conn.close_socket()
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _evict_idle(self):
+        # Called with lock held. Oldest connections are at the beginning of the idle list.
+        now = time.time()
+        while self._idle and self._size > self.min_size \
+                and now - self._idle[0].last_used > self.idle_timeout:
+            conn = self._idle.pop(0)
+            self._size -= 1
+            conn.close_socket()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.time() - conn.last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logging.warning('Discarding broken pooled connection: {}'.format(str(e)))
+            return False
+
+    @staticmethod
+    def _reset(conn):
+        if conn.closed:
+            return False
+        try:
+            # Rollback pending transaction and restore default session characteristics
+            conn.reset()
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute('DISCARD ALL')
+            conn.autocommit = False
+            return True
+        except psycopg2.Error as e:
+            logging.warning('Unable to reset pooled connection: {}'.format(str(e)))
+            return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port, dbname, user, **pool_kwargs):
+    """
+    Return the process-wide pool for a (host, port, database, user), creating it on first use
+
+    :rtype: ConnectionPool
+    """
+    key = (host, port, dbname, user)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(**pool_kwargs)
+            _pools[key] = pool
+        return pool
+
+
+def close_all_pools():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.closeall()
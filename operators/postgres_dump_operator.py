@@ -3,19 +3,35 @@ import logging
 import os
 import ast
 import hashlib
+import json
+import re
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 
-from aws_plugin import AwsSecretsManagerHook, AwsKmsHook
-
-from bash_plugin import BashHook
-from airflow.utils import apply_defaults
-from airflow.hooks.S3_hook import S3Hook
-from airflow.operators import BaseOperator
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
+from postgres_plugin.utils.compression import CompressingWriter, CODECS
+from postgres_plugin.utils.encryption import EnvelopeEncryptor, EncryptingWriter, encryption_metadata
+from postgres_plugin.utils.metrics import task_metrics
+from postgres_plugin.utils.streams import HashingWriter
+from postgres_plugin.utils.s3 import S3MultipartWriter, S3_PART_SIZE, S3_UPLOAD_CONCURRENCY
+
 logging = logging.getLogger(__name__)
 
+DUMP_CHUNK_SIZE = 1024 * 1024
+
+# Directory format dumps: pg_dump verbose message for a finished item and extensions of its data file
+FINISHED_ITEM_PATTERN = re.compile(r'finished item (\d+) ')
+DUMP_FILE_EXTENSIONS = ('.dat.gz', '.dat', '.dat.lz4', '.dat.zst')
+
 
 class PostgresDumpOperator(BaseOperator):
     """
@@ -33,13 +49,46 @@ class PostgresDumpOperator(BaseOperator):
     :type s3_key_name: str
     :param ssl_cert_path: Path to a public SSL certificate to use in dump encription.
     :type ssl_cert_path: str
+    :param streaming: Run dump, hashes, encryption and upload in a single pass, without temporary files.
+        pg_dump output is encrypted with a KMS data key (AES-GCM envelope encryption) and
+        uploaded as a S3 multipart upload. MD5 files are written from in-memory digests.
+    :type streaming: bool
+    :param s3_part_size: Size in bytes of each multipart upload part in streaming mode
+    :type s3_part_size: int
+    :param s3_upload_concurrency: Number of parts uploaded concurrently in streaming mode
+    :type s3_upload_concurrency: int
+    :param parallel_jobs: Run a directory format dump with `pg_dump -Fd -j parallel_jobs`. Each table file
+        is encrypted and uploaded to `<s3_key_name>.dir/<file>.encrypted` as soon as pg_dump finishes it,
+        and `<s3_key_name>.manifest` lists the files with their checksums. The dump can be restored with
+        `pg_restore -j`.
+    :type parallel_jobs: int
+    :param file_upload_concurrency: Number of dump files encrypted and uploaded concurrently in parallel mode
+    :type file_upload_concurrency: int
+    :param encryption: How the dump file is encrypted when not streaming: `kms` (whole file through
+        AwsKmsHook) or `envelope` (KMS data key and local AES-GCM frames, like streaming and parallel modes)
+    :type encryption: str
+    :param encryption_workers: Number of threads encrypting frames concurrently (default: number of cores)
+    :type encryption_workers: int
+    :param compression: Codec compressing the dump before envelope encryption, while pg_dump is running:
+        `gzip`, `pgzip` (block-parallel gzip), `zstd` or `lz4`. Used by streaming, parallel and `envelope`
+        encryption modes and recorded in S3 object metadata. In parallel mode it replaces pg_dump compression.
+    :type compression: str
+    :param compression_level: Codec compression level (codec default if None)
+    :type compression_level: int
+    :param compression_threads: Worker threads of `pgzip` and `zstd` codecs (default: number of cores)
+    :type compression_threads: int
     :return: None
+
+    Phase timings (secret_fetch, dump, md5, compress, kms, encrypt, upload) and byte counters are sent
+    to StatsD and pushed to XCom (`metrics` key).
     """
 
     template_fields = ['s3_key_name',]
     aws_secret_key = None
     s3_key_name = '{instance_identifier}/{db_name}/{year}/{month}/{dump_name}'
     dump_file_md5 = None
+    encryption_modes = ('kms', 'envelope')
+    metrics = None
 
     @apply_defaults
     def __init__(self,
@@ -48,6 +97,17 @@ class PostgresDumpOperator(BaseOperator):
                  s3_bucket_name,
                  aws_kms_key_arn,
                  dump_extra_parameters='',
+                 streaming=False,
+                 s3_part_size=S3_PART_SIZE,
+                 s3_upload_concurrency=S3_UPLOAD_CONCURRENCY,
+                 aws_conn_id='aws_default',
+                 parallel_jobs=None,
+                 file_upload_concurrency=4,
+                 encryption='kms',
+                 encryption_workers=None,
+                 compression=None,
+                 compression_level=None,
+                 compression_threads=None,
                  *args, **kwargs):
         super(PostgresDumpOperator, self).__init__(*args, **kwargs)
         self.secret_name = secret_name
@@ -56,26 +116,64 @@ class PostgresDumpOperator(BaseOperator):
         self.s3_bucket_name = s3_bucket_name
         self.aws_kms_key_arn = aws_kms_key_arn
         self.dump_extra_parameters = dump_extra_parameters
+        self.streaming = streaming
+        self.s3_part_size = s3_part_size
+        self.s3_upload_concurrency = s3_upload_concurrency
+        self.aws_conn_id = aws_conn_id
+        self.parallel_jobs = parallel_jobs
+        self.file_upload_concurrency = file_upload_concurrency
+        if encryption not in self.encryption_modes:
+            raise AirflowException('Invalid encryption [{}], expected one of {}'.format(
+                encryption, self.encryption_modes))
+        self.encryption = encryption
+        self.encryption_workers = encryption_workers
+        if compression is not None and compression not in CODECS:
+            raise AirflowException('Invalid compression [{}], expected one of {}'.format(compression, CODECS))
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
 
     def execute(self, context):
+        with task_metrics(self, context):
+            return self.dump()
 
+    def dump(self):
+        """
+        Dump, encrypt and upload database (file, streaming or parallel mode)
+
+        :return: dump file name or S3 key name
+        :rtype: str
+        """
         logging.info('Looking for AWS Secret Manager key')
+        from aws_plugin import AwsSecretsManagerHook
+
         secret_manager = AwsSecretsManagerHook(aws_secret_name=self.secret_name)
-        self.aws_secret_key = ast.literal_eval(secret_manager.get_secret())
+        with self.metrics.phase('secret_fetch'):
+            self.aws_secret_key = ast.literal_eval(secret_manager.get_secret())
+
+        if self.parallel_jobs:
+            return self.parallel_dump()
+
+        if self.streaming:
+            return self.stream_dump()
 
         # generate dumpfile from database
-        dump_file_name = self.extract_dump()
+        with self.metrics.phase('dump'):
+            dump_file_name = self.extract_dump()
         logging.info('Dump file: {}'.format(dump_file_name))
+        self.metrics.incr('bytes_dumped', os.stat(dump_file_name).st_size)
 
         # Calculate dump md5
-        dump_file_md5 = self.calculate_file_hash(dump_file_name)
+        with self.metrics.phase('md5'):
+            dump_file_md5 = self.calculate_file_hash(dump_file_name)
 
         # Encrypt file using public SSL cert
         encrypted_file = self.encrypt_dump(dump_file_name)
         logging.info('Encrypted file: {}'.format(encrypted_file))
 
         # Calculate encrypted md5
-        encrypted_file_md5 = self.calculate_file_hash(encrypted_file)
+        with self.metrics.phase('md5'):
+            encrypted_file_md5 = self.calculate_file_hash(encrypted_file)
 
         # list of files to save on S3
         files_to_transfer = [
@@ -85,8 +183,10 @@ class PostgresDumpOperator(BaseOperator):
         ]
 
         # Send file to S3
-        send_to_s3 = self.send_files_to_s3(files_to_transfer)
+        with self.metrics.phase('upload'):
+            send_to_s3 = self.send_files_to_s3(files_to_transfer)
         logging.info('Send to S3 result: {}'.format(send_to_s3))
+        self.metrics.incr('bytes_uploaded', os.stat(encrypted_file).st_size)
 
         # Clear files
         self.delete_file(dump_file_name)
@@ -113,14 +213,7 @@ class PostgresDumpOperator(BaseOperator):
         os.environ['PGPASSWORD'] = self.aws_secret_key['password']
 
         # Command to dump database
-        bash_command = "pg_dump -v -Ft -h {host} -U {user} -d {dbname} -f {filename} {dump_extra_parameters}".format(
-            host=self.aws_secret_key['host'],
-            user=self.aws_secret_key['username'],
-            dbname=self.db_name,
-            password=self.aws_secret_key['host'],
-            filename=dump_file.name,
-            dump_extra_parameters=self.dump_extra_parameters
-        )
+        bash_command = self.dump_command(output_file=dump_file.name)
 
         # Execute bash command to extract database dump
         self.execute_bash(bash_command)
@@ -137,6 +230,8 @@ class PostgresDumpOperator(BaseOperator):
         :return: Bash command return
         :rtype: str
         """
+        from bash_plugin import BashHook
+
         return BashHook(bash_command=bash_command, task_id=self.task_id).execute()
 
     def send_files_to_s3(self, files_to_transfer):
@@ -148,14 +243,10 @@ class PostgresDumpOperator(BaseOperator):
         :return: S3 file uploaded
         :rtype: str
         """
+        from airflow.hooks.S3_hook import S3Hook
+
         dest_s3 = S3Hook()
-        self.s3_key_name = self.s3_key_name.format(
-            instance_identifier=self.aws_secret_key['dbInstanceIdentifier'],
-            db_name=self.db_name,
-            year=datetime.now().strftime("%Y"),
-            month=datetime.now().strftime("%m"),
-            dump_name='dump_{}_{}.dmp'.format(self.db_name, datetime.now().strftime("%Y%m%d_%H%M%S"))
-        )
+        self.format_s3_key_name()
 
         logging.info('Dump file name: [{}]'.format(self.s3_key_name))
         logging.info('Start transfer files to S3 bucket [{}]'.format(self.s3_bucket_name))
@@ -177,6 +268,283 @@ class PostgresDumpOperator(BaseOperator):
 
         return files
 
+    def format_s3_key_name(self):
+        """
+        Fill S3 key name placeholders (instance, database, date and dump name)
+
+        :return: S3 key name
+        :rtype: str
+        """
+        self.s3_key_name = self.s3_key_name.format(
+            instance_identifier=self.aws_secret_key['dbInstanceIdentifier'],
+            db_name=self.db_name,
+            year=datetime.now().strftime("%Y"),
+            month=datetime.now().strftime("%m"),
+            dump_name='dump_{}_{}.dmp'.format(self.db_name, datetime.now().strftime("%Y%m%d_%H%M%S"))
+        )
+        return self.s3_key_name
+
+    def dump_command(self, output_format='t', output_file=None, jobs=None):
+        """
+        pg_dump command line. Output goes to stdout when no output file is given.
+
+        :rtype: str
+        """
+        return "pg_dump -v -F{format} {jobs} {compress} -h {host} -U {user} -d {dbname} {filename} " \
+               "{dump_extra_parameters}".format(
+                   format=output_format,
+                   jobs='-j {}'.format(jobs) if jobs else '',
+                   # Directory format files are compressed by pg_dump unless a codec is used
+                   compress='-Z 0' if output_format == 'd' and self.compression else '',
+                   host=self.aws_secret_key['host'],
+                   user=self.aws_secret_key['username'],
+                   dbname=self.db_name,
+                   filename='-f {}'.format(output_file) if output_file else '',
+                   dump_extra_parameters=self.dump_extra_parameters)
+
+    def stream_dump(self):
+        """
+        pg_dump stdout -> plaintext md5 -> encryption -> ciphertext md5 -> S3 multipart upload,
+        in a single pass with bounded buffers.
+
+        :return: S3 key name of the encrypted dump
+        :rtype: str
+        """
+        from airflow.contrib.hooks.aws_hook import AwsHook
+        from airflow.hooks.S3_hook import S3Hook
+
+        dest_s3 = S3Hook()
+        self.format_s3_key_name()
+        encrypted_key_name = '{}.encrypted'.format(self.s3_key_name)
+        logging.info('Streaming dump to [{}/{}]'.format(self.s3_bucket_name, encrypted_key_name))
+
+        kms_client = AwsHook(aws_conn_id=self.aws_conn_id).get_client_type('kms')
+
+        env = dict(os.environ, PGPASSWORD=self.aws_secret_key['password'])
+        process = subprocess.Popen(shlex.split(self.dump_command()), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, env=env)
+        stderr_thread = threading.Thread(target=self.log_stream, args=(process.stderr,))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+        def check_dump():
+            # Final frame is only written after pg_dump succeeded, so a failed dump never looks complete
+            if process.wait() != 0:
+                raise AirflowException('pg_dump exited with code {}'.format(process.returncode))
+
+        writer = S3MultipartWriter(dest_s3.get_conn(),
+                                   bucket_name=self.s3_bucket_name,
+                                   key=encrypted_key_name,
+                                   part_size=self.s3_part_size,
+                                   concurrency=self.s3_upload_concurrency,
+                                   extra_args={'Metadata': self.s3_metadata()})
+        try:
+            with writer, self.metrics.phase('dump'):
+                dump_size, dump_md5, encrypted_md5 = self.encrypt_stream(kms_client, process.stdout, writer,
+                                                                         before_finalize=check_dump)
+            self.metrics.add_time('upload', writer.elapsed)
+            self.metrics.incr('bytes_dumped', dump_size)
+            self.metrics.incr('bytes_uploaded', writer.bytes_written)
+        except Exception as e:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            logging.error('Error trying to stream dump: [{}]'.format(str(e)))
+            raise AirflowException(str(e))
+        finally:
+            process.stdout.close()
+            stderr_thread.join()
+
+        logging.info('Dump size: {}Mb, encrypted: {}Mb'.format(dump_size >> 20, writer.bytes_written >> 20))
+        logging.info('Dump MD5: [{}], encrypted MD5: [{}]'.format(dump_md5, encrypted_md5))
+
+        for ext, digest in (('.md5', dump_md5), ('.encrypted.md5', encrypted_md5)):
+            dest_s3.load_string(digest,
+                                key='{}{}'.format(self.s3_key_name, ext),
+                                bucket_name=self.s3_bucket_name,
+                                replace=True,
+                                encrypt=False)
+
+        files = dest_s3.list_keys(self.s3_bucket_name, prefix=self.s3_key_name)
+        logging.info('S3 files: [{}]'.format(files))
+        logging.info('Done.')
+
+        return encrypted_key_name
+
+    def s3_metadata(self):
+        """
+        S3 metadata of envelope encrypted objects
+        """
+        metadata = encryption_metadata(self.aws_kms_key_arn)
+        if self.compression:
+            metadata['compression'] = self.compression
+        return metadata
+
+    def encrypt_stream(self, kms_client, source, fileobj, before_finalize=None):
+        """
+        Envelope encrypt a binary stream into a file object, computing plaintext and ciphertext MD5.
+        Stream is compressed before encryption when a compression codec is set.
+
+        :param kms_client: boto3 KMS client used to generate the data key
+        :param source: object with a `read(size)` method
+        :param fileobj: writable file object receiving ciphertext
+        :param before_finalize: callable run before the final frame is written, may raise to abort
+        :return: plaintext size, plaintext md5 and ciphertext md5
+        :rtype: tuple
+        """
+        plain_md5 = hashlib.md5()
+        md5_elapsed = 0.0
+        size = 0
+        hashing_writer = HashingWriter(fileobj)
+        with self.metrics.phase('kms'):
+            encryptor = EnvelopeEncryptor(kms_client, self.aws_kms_key_arn)
+        with EncryptingWriter(hashing_writer, encryptor, workers=self.encryption_workers) as encrypting_writer:
+            sink = encrypting_writer
+            if self.compression:
+                sink = CompressingWriter(encrypting_writer, self.compression,
+                                         level=self.compression_level,
+                                         threads=self.compression_threads)
+            for chunk in iter(lambda: source.read(DUMP_CHUNK_SIZE), b''):
+                size += len(chunk)
+                started_at = time.time()
+                plain_md5.update(chunk)
+                md5_elapsed += time.time() - started_at
+                sink.write(chunk)
+            if before_finalize is not None:
+                before_finalize()
+            if sink is not encrypting_writer:
+                sink.close()
+                self.metrics.add_time('compress', sink.elapsed)
+                self.metrics.incr('bytes_compressed', sink.bytes_out)
+        self.metrics.add_time('md5', md5_elapsed + hashing_writer.elapsed)
+        self.metrics.add_time('encrypt', encrypting_writer.elapsed)
+        return size, plain_md5.hexdigest(), hashing_writer.hexdigest()
+
+    @staticmethod
+    def log_stream(stream, callback=None):
+        for line in iter(stream.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            logging.info(line)
+            if callback is not None:
+                callback(line)
+        stream.close()
+
+    def parallel_dump(self):
+        """
+        Directory format dump with parallel jobs. Table files are encrypted and uploaded concurrently
+        as soon as pg_dump reports them finished, then a manifest with per-file checksums is written.
+
+        :return: S3 key name of the manifest
+        :rtype: str
+        """
+        from airflow.contrib.hooks.aws_hook import AwsHook
+        from airflow.hooks.S3_hook import S3Hook
+
+        dest_s3 = S3Hook()
+        self.format_s3_key_name()
+        s3_client = dest_s3.get_conn()
+        kms_client = AwsHook(aws_conn_id=self.aws_conn_id).get_client_type('kms')
+        work_dir = mkdtemp(prefix=self.task_id)
+        dump_dir = os.path.join(work_dir, 'dump')
+        logging.info('Dump temporary directory: [{}]'.format(dump_dir))
+
+        uploads = {}
+        uploads_lock = threading.Lock()
+        executor = ThreadPoolExecutor(max_workers=self.file_upload_concurrency)
+
+        def upload(file_name):
+            with uploads_lock:
+                if file_name in uploads or not os.path.exists(os.path.join(dump_dir, file_name)):
+                    return
+                uploads[file_name] = executor.submit(self.upload_dump_file, s3_client, kms_client,
+                                                     dump_dir, file_name)
+
+        def on_log_line(line):
+            # pg_dump reports "finished item <dump id> TABLE DATA ..." when a table file is complete
+            match = FINISHED_ITEM_PATTERN.search(line)
+            if match:
+                for extension in DUMP_FILE_EXTENSIONS:
+                    upload('{}{}'.format(match.group(1), extension))
+
+        env = dict(os.environ, PGPASSWORD=self.aws_secret_key['password'])
+        command = self.dump_command(output_format='d', output_file=dump_dir, jobs=self.parallel_jobs)
+        try:
+            process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            stderr_thread = threading.Thread(target=self.log_stream, args=(process.stderr, on_log_line))
+            stderr_thread.daemon = True
+            stderr_thread.start()
+            process.stdout.close()
+            with self.metrics.phase('dump'):
+                returncode = process.wait()
+                stderr_thread.join()
+            if returncode != 0:
+                raise AirflowException('pg_dump exited with code {}'.format(returncode))
+
+            # Remaining files: table of contents, large objects...
+            for file_name in sorted(os.listdir(dump_dir)):
+                upload(file_name)
+
+            files = []
+            for file_name, future in sorted(uploads.items()):
+                files.append(future.result())
+        except Exception as e:
+            logging.error('Error trying to run parallel dump: [{}]'.format(str(e)))
+            raise AirflowException(str(e))
+        finally:
+            executor.shutdown(wait=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        manifest_key_name = '{}.manifest'.format(self.s3_key_name)
+        manifest = {
+            'format': 'directory',
+            'jobs': self.parallel_jobs,
+            'compression': self.compression,
+            'files': files,
+        }
+        dest_s3.load_string(json.dumps(manifest, indent=2),
+                            key=manifest_key_name,
+                            bucket_name=self.s3_bucket_name,
+                            replace=True,
+                            encrypt=False)
+        logging.info('Manifest [{}]: {} files, {}Mb'.format(
+            manifest_key_name, len(files), sum(f['size'] for f in files) >> 20))
+        logging.info('Done.')
+
+        return manifest_key_name
+
+    def upload_dump_file(self, s3_client, kms_client, dump_dir, file_name):
+        """
+        Encrypt and upload one file of a directory format dump, then remove it from local disk
+
+        :return: manifest entry with file name, key, sizes and checksums
+        :rtype: dict
+        """
+        file_path = os.path.join(dump_dir, file_name)
+        key_name = '{}.dir/{}.encrypted'.format(self.s3_key_name, file_name)
+
+        writer = S3MultipartWriter(s3_client,
+                                   bucket_name=self.s3_bucket_name,
+                                   key=key_name,
+                                   part_size=self.s3_part_size,
+                                   concurrency=self.s3_upload_concurrency,
+                                   extra_args={'Metadata': self.s3_metadata()})
+        with writer, open(file_path, 'rb') as f:
+            size, file_md5, encrypted_md5 = self.encrypt_stream(kms_client, f, writer)
+        self.metrics.add_time('upload', writer.elapsed)
+        self.metrics.incr('bytes_dumped', size)
+        self.metrics.incr('bytes_uploaded', writer.bytes_written)
+
+        self.delete_file(file_path)
+        logging.info('Dump file [{}] uploaded as [{}]'.format(file_name, key_name))
+        return {
+            'file': file_name,
+            'key': key_name,
+            'size': size,
+            'md5': file_md5,
+            'encrypted_size': writer.bytes_written,
+            'encrypted_md5': encrypted_md5,
+        }
+
     def encrypt_dump(self, dump_file_name):
         """
         Encrypt given dumpfile
@@ -186,17 +554,27 @@ class PostgresDumpOperator(BaseOperator):
         :return: Encrypted file name (path)
         :rtype: str
         """
+        from airflow.contrib.hooks.aws_hook import AwsHook
+        from aws_plugin import AwsKmsHook
 
         encrypted_file = NamedTemporaryFile(prefix=self.task_id, delete=False)
 
+        if self.encryption == 'envelope':
+            kms_client = AwsHook(aws_conn_id=self.aws_conn_id).get_client_type('kms')
+            with open(dump_file_name, 'rb') as f:
+                self.encrypt_stream(kms_client, f, encrypted_file)
+            encrypted_file.close()
+            return encrypted_file.name
+
         try:
-            AwsKmsHook(aws_kms_key_arn=self.aws_kms_key_arn,
-                       aws_conn_id='default',
-                       task_id=self.task_id)\
-                .encrypt_file(
-                    source_file_name=dump_file_name,
-                    target_file_name=encrypted_file.name
-                )
+            with self.metrics.phase('encrypt'):
+                AwsKmsHook(aws_kms_key_arn=self.aws_kms_key_arn,
+                           aws_conn_id='default',
+                           task_id=self.task_id)\
+                    .encrypt_file(
+                        source_file_name=dump_file_name,
+                        target_file_name=encrypted_file.name
+                    )
         except Exception as e:
             logging.error('Error trying to fetch query: [{}]'.format(str(e)))
             raise AirflowException(str(e))
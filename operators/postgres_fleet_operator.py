@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Run the same SQL on many databases, each one with its own AWS Secrets Manager credentials.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowException
+
+from postgres_plugin.utils.metrics import task_metrics
+
+
+class PostgresFleetOperator(BaseOperator):
+    """
+    Executes sql code on a fleet of Postgres databases concurrently.
+    Each target is a AWS Secrets Manager secret (RDS format) holding its credentials.
+
+    Targets run in a thread pool, each one fetching its own credentials and using its own connection,
+    so a fleet run takes about as long as its slowest target. Every target is run even when some fail;
+    the task fails at the end if any target failed (unless `fail_on_error` is False).
+
+    Returns (so pushes to XCom) one result per target:
+    `{"secret_name", "status" ("success" or "failed"), "attempts", "duration", "rowcount", "rows", "error"}`
+
+    :param sql: the sql code to be executed on every target
+    :type sql: Can receive a str representing a sql statement,
+        a list of str (sql statements), or reference to a template file.
+        Template reference are recognized by str ending in '.sql'
+    :param aws_secret_names: secrets of the target databases
+    :type aws_secret_names: list
+    :param aws_secret_prefix: run on every secret whose name starts with this prefix (listed at run time)
+    :type aws_secret_prefix: string
+    :param aws_conn_id: reference to a specific aws connection
+    :type aws_conn_id: string
+    :param database: name of database which overwrite defined one in secrets
+    :type database: string
+    :param parameters: query parameters
+    :param autocommit: run statements in autocommit mode (ex: VACUUM), instead of one transaction per target
+    :type autocommit: bool
+    :param concurrency: number of targets run at the same time
+    :type concurrency: int
+    :param target_timeout: seconds allowed for each statement on a target (server side `statement_timeout`),
+        also used as connection timeout
+    :type target_timeout: int
+    :param target_retries: retries of a failed target before reporting it as failed
+    :type target_retries: int
+    :param target_retry_delay: seconds before first retry of a target, doubled at each retry
+    :type target_retry_delay: int
+    :param fetch_results: include rows returned by the last statement in target results
+    :type fetch_results: bool
+    :param fail_on_error: fail the task if any target failed
+    :type fail_on_error: bool
+    """
+
+    template_fields = ('sql', 'aws_secret_names', 'aws_secret_prefix')
+    template_ext = ('.sql',)
+    ui_color = '#ededed'
+    metrics = None
+
+    @apply_defaults
+    def __init__(
+            self,
+            sql,
+            aws_secret_names=None,
+            aws_secret_prefix=None,
+            aws_conn_id='aws_default',
+            database=None,
+            parameters=None,
+            autocommit=False,
+            concurrency=16,
+            target_timeout=None,
+            target_retries=1,
+            target_retry_delay=5,
+            fetch_results=False,
+            fail_on_error=True,
+            **kwargs):
+        super(PostgresFleetOperator, self).__init__(**kwargs)
+        if not (aws_secret_names or aws_secret_prefix):
+            raise AirflowException('One of aws_secret_names or aws_secret_prefix is required')
+        self.sql = sql
+        self.aws_secret_names = aws_secret_names
+        self.aws_secret_prefix = aws_secret_prefix
+        self.aws_conn_id = aws_conn_id
+        self.database = database
+        self.parameters = parameters
+        self.autocommit = autocommit
+        self.concurrency = concurrency
+        self.target_timeout = target_timeout
+        self.target_retries = target_retries
+        self.target_retry_delay = target_retry_delay
+        self.fetch_results = fetch_results
+        self.fail_on_error = fail_on_error
+
+    def execute(self, context):
+        with task_metrics(self, context) as metrics:
+            secret_names = self.list_secret_names()
+            self.log.info('Executing query on {} databases (concurrency {}): {}'.format(
+                len(secret_names), self.concurrency, self.sql))
+
+            results = []
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                futures = dict((executor.submit(self.run_target, secret_name), secret_name)
+                               for secret_name in secret_names)
+                for done, future in enumerate(as_completed(futures), 1):
+                    result = future.result()
+                    results.append(result)
+                    metrics.incr('targets_{}'.format(result['status']))
+                    self.log.info('[{}] {} in {:.1f}s after {} attempt(s) ({}/{} databases){}'.format(
+                        result['secret_name'], result['status'], result['duration'], result['attempts'],
+                        done, len(secret_names), ': {}'.format(result['error']) if result['error'] else ''))
+
+        results.sort(key=lambda result: result['secret_name'])
+        failures = [result for result in results if result['status'] != 'success']
+        slowest = max(results, key=lambda result: result['duration']) if results else None
+        self.log.info('{} of {} databases succeeded{}'.format(
+            len(results) - len(failures), len(results),
+            ', slowest: [{}] {:.1f}s'.format(slowest['secret_name'], slowest['duration']) if slowest else ''))
+
+        if failures and self.fail_on_error:
+            # Results are still pushed to XCom before failing
+            task_instance = context.get('ti') if context else None
+            if task_instance is not None:
+                task_instance.xcom_push(key='return_value', value=results)
+            raise AirflowException('{} of {} databases failed: {}'.format(
+                len(failures), len(results),
+                ', '.join('{}: {}'.format(result['secret_name'], result['error']) for result in failures)))
+        return results
+
+    def list_secret_names(self):
+        """
+        Target secret names, listing secrets by prefix if needed
+
+        :rtype: list
+        """
+        secret_names = list(self.aws_secret_names or [])
+        if self.aws_secret_prefix:
+            from airflow.contrib.hooks.aws_hook import AwsHook
+            client = AwsHook(aws_conn_id=self.aws_conn_id).get_client_type('secretsmanager')
+            paginator = client.get_paginator('list_secrets')
+            for page in paginator.paginate(Filters=[{'Key': 'name', 'Values': [self.aws_secret_prefix]}]):
+                secret_names.extend(secret['Name'] for secret in page['SecretList']
+                                    if secret['Name'].startswith(self.aws_secret_prefix))
+        return sorted(set(secret_names))
+
+    def get_hook(self, secret_name):
+        conn_kwargs = {}
+        if self.target_timeout:
+            conn_kwargs['connect_timeout'] = self.target_timeout
+            conn_kwargs['options'] = '-c statement_timeout={}'.format(int(self.target_timeout * 1000))
+        from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+        return PostgresWithSecretsManagerCredentialsHook(
+            aws_conn_id=self.aws_conn_id,
+            aws_secret_name=secret_name,
+            schema=self.database,
+            conn_kwargs=conn_kwargs,
+            metrics=self.metrics
+        )
+
+    def run_target(self, secret_name):
+        """
+        Run sql on one target, with retries. Never raises: errors are reported in the result.
+
+        :rtype: dict
+        """
+        started_at = time.time()
+        result = {
+            'secret_name': secret_name,
+            'status': 'failed',
+            'attempts': 0,
+            'duration': 0.0,
+            'rowcount': None,
+            'rows': None,
+            'error': None,
+        }
+        while True:
+            result['attempts'] += 1
+            try:
+                with self.metrics.phase('target'):
+                    result['rowcount'], result['rows'] = self.run_sql(self.get_hook(secret_name))
+                result['status'] = 'success'
+                result['error'] = None
+                break
+            except Exception as e:  # pylint: disable=broad-except
+                result['error'] = str(e).strip()
+                if result['attempts'] > self.target_retries:
+                    break
+                delay = self.target_retry_delay * 2 ** (result['attempts'] - 1)
+                self.log.warning('[{}] attempt {} failed, retrying in {}s: {}'.format(
+                    secret_name, result['attempts'], delay, result['error']))
+                time.sleep(delay)
+        result['duration'] = round(time.time() - started_at, 3)
+        return result
+
+    def run_sql(self, hook):
+        """
+        Run statements on a target in one transaction (or in autocommit mode)
+
+        :return: row count and rows (if fetch_results) of the last statement
+        :rtype: tuple
+        """
+        statements = [self.sql] if isinstance(self.sql, str) else self.sql
+        conn = hook.get_conn()
+        try:
+            conn.autocommit = self.autocommit
+            with conn.cursor() as cursor:
+                rows = None
+                for statement in statements:
+                    cursor.execute(statement, self.parameters)
+                rowcount = cursor.rowcount
+                if self.fetch_results and cursor.description is not None:
+                    # Rows must be JSON serializable to be pushed to XCom
+                    rows = json.loads(json.dumps(cursor.fetchall(), default=str))
+            if not self.autocommit:
+                conn.commit()
+        except Exception:
+            if not conn.closed and not self.autocommit:
+                conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return rowcount, rows
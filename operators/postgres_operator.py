@@ -4,10 +4,25 @@ Execute some query on PostgreSQL database using Secrets Manager to retrieve data
 
 """
 # pylint: disable=import-error,missing-docstring,too-few-public-methods
+import time
+import uuid
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowException
 
-from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+from postgres_plugin.utils.batches import iter_pages, read_parameter_sets, multi_statement, prepare_statement, \
+    deallocate_statement, execute_page, BATCH_PAGE_SIZE, BATCH_METHODS
+from postgres_plugin.utils.checkpoints import TableCheckpoint, checkpoint_run_key
+from postgres_plugin.utils.metrics import task_metrics
+from postgres_plugin.utils.profiling import task_profiler, profile_statement, PROFILE_METHODS
+from postgres_plugin.utils.streams import BoundedPipe, ProducerThread, PIPE_MAX_CHUNKS
+from postgres_plugin.utils.merge import create_staging_table, drop_staging_table, merge_staging_table, \
+    STAGING_TEMPORARY, STAGING_TABLE_TYPES
+from postgres_plugin.utils.partitions import render_query, export_snapshot, import_snapshot, \
+    key_range_boundaries, key_ranges, key_range_query
 
 
 class PostgresWithSecretsManagerCredentialsOperator(BaseOperator):
@@ -25,12 +40,60 @@ class PostgresWithSecretsManagerCredentialsOperator(BaseOperator):
         Template reference are recognized by str ending in '.sql'
     :param database: name of database which overwrite defined one in connection
     :type database: string
+    :param use_pool: reuse connections from the worker-level connection pool
+    :type use_pool: bool
+    :param parameter_sets: run `sql` (a single statement) once per parameter set, in page-sized round
+        trips inside one transaction. A list, any iterable (consumed lazily, page by page) or a callable
+        receiving the task context and returning one (ex: reading XCom).
+    :type parameter_sets: iterable or callable
+    :param parameter_sets_file: read parameter sets lazily from this file instead: one JSON list or object
+        per line, or CSV rows for `.csv` files
+    :type parameter_sets_file: str
+    :param batch_method: how a page of parameter sets is sent: `batch` (statements joined by
+        psycopg2 `execute_batch`), `values` (`sql` has a single `VALUES %s`, expanded to a multi-row
+        VALUES by `execute_values`) or `prepared` (`sql` is prepared server-side once, with `$1, $2...`
+        placeholders, and pages of `EXECUTE` are sent by `execute_batch`; parameter sets must be sequences)
+    :type batch_method: str
+    :param page_size: parameter sets sent per round trip
+    :type page_size: int
+    :param commit_every: parameter sets between commits (default: a single transaction)
+    :type commit_every: int
+    :param single_round_trip: when `sql` is a list of statements, send them as one multi-statement
+        command (one round trip, one transaction) instead of one round trip per statement
+    :type single_round_trip: bool
+    :param deferrable: free the worker slot while the query runs: the query is run by the triggerer
+        (Airflow 2.2+) on an asynchronous connection and the task resumes when it ends. Statements of
+        a list are run one after another in autocommit (or as one multi-statement command with
+        single_round_trip). Parameters must be JSON serializable.
+    :type deferrable: bool
+    :param poll_interval: seconds between two checks of the query backend in `pg_stat_activity`
+        in deferrable mode
+    :type poll_interval: int
+    :param query_timeout: seconds after which the query is cancelled with `pg_cancel_backend`
+        in deferrable mode
+    :type query_timeout: int
+    :param profile_threshold: capture the JSON plan of statements slower than this many seconds, and
+        the `pg_stat_statements` deltas of the task (not available in deferrable mode). Statement plans
+        are not captured with parameter_sets; plans of single round trip commands are only captured
+        with `auto_explain`.
+    :type profile_threshold: float
+    :param profile_method: how plans of slow statements are captured: `explain` (follow-up EXPLAIN,
+        plan only), `explain_analyze` (follow-up EXPLAIN ANALYZE: read only queries are run again and
+        rolled back, only for queries without non-transactional side effects such as `setval`) or
+        `auto_explain` (plan of the actual execution, requires the privilege to set auto_explain
+        settings, else falls back to `explain`)
+    :type profile_method: str
+
+    Phase timings and counters are sent to StatsD and pushed to XCom (`metrics` key). Profiling
+    reports are logged and pushed to XCom (`profile` key).
     """
 
-    template_fields = ('sql',)
+    template_fields = ('sql', 'parameter_sets_file')
     template_ext = ('.sql',)
     ui_color = '#ededed'
     hook = None
+    metrics = None
+    profiler = None
 
     @apply_defaults
     def __init__(
@@ -42,8 +105,27 @@ class PostgresWithSecretsManagerCredentialsOperator(BaseOperator):
             parameters=None,
             database=None,
             host=None,
+            use_pool=False,
+            parameter_sets=None,
+            parameter_sets_file=None,
+            batch_method='batch',
+            page_size=BATCH_PAGE_SIZE,
+            commit_every=None,
+            single_round_trip=False,
+            deferrable=False,
+            poll_interval=60,
+            query_timeout=None,
+            profile_threshold=None,
+            profile_method='explain',
             **kwargs):
         super(PostgresWithSecretsManagerCredentialsOperator, self).__init__(**kwargs)
+        if batch_method not in BATCH_METHODS:
+            raise AirflowException('Invalid batch_method [{}], expected one of {}'.format(batch_method, BATCH_METHODS))
+        if profile_method not in PROFILE_METHODS:
+            raise AirflowException('Invalid profile_method [{}], expected one of {}'.format(
+                profile_method, PROFILE_METHODS))
+        if profile_threshold is not None and deferrable:
+            raise AirflowException('profile_threshold is not available in deferrable mode')
         self.sql = sql
         self.aws_conn_id = aws_conn_id
         self.aws_secret_name = aws_secret_name
@@ -51,16 +133,173 @@ class PostgresWithSecretsManagerCredentialsOperator(BaseOperator):
         self.parameters = parameters
         self.database = database
         self.host = host
+        self.use_pool = use_pool
+        self.parameter_sets = parameter_sets
+        self.parameter_sets_file = parameter_sets_file
+        self.batch_method = batch_method
+        self.page_size = page_size
+        self.commit_every = commit_every
+        self.single_round_trip = single_round_trip
+        self.deferrable = deferrable
+        self.poll_interval = poll_interval
+        self.query_timeout = query_timeout
+        self.profile_threshold = profile_threshold
+        self.profile_method = profile_method
 
     def execute(self, context):
         self.log.info('Executing query: {}'.format(self.sql))
-        self.hook = PostgresWithSecretsManagerCredentialsHook(
-            aws_conn_id=self.aws_conn_id,
-            aws_secret_name=self.aws_secret_name,
-            schema=self.database,
-            host=self.host
-        )
-        self.hook.run(self.sql, self.autocommit, parameters=self.parameters)
+        if self.deferrable:
+            self.defer_query()
+        from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+        with task_metrics(self, context) as metrics, task_profiler(self, context) as profiler:
+            self.hook = PostgresWithSecretsManagerCredentialsHook(
+                aws_conn_id=self.aws_conn_id,
+                aws_secret_name=self.aws_secret_name,
+                schema=self.database,
+                host=self.host,
+                use_pool=self.use_pool,
+                metrics=metrics
+            )
+            if profiler is not None:
+                profiler.watch(self.hook)
+            if self.parameter_sets is not None or self.parameter_sets_file:
+                self.execute_many(self.get_parameter_sets(context))
+            elif self.single_round_trip and not isinstance(self.sql, str):
+                self.log.info('Sending {} statements in a single round trip'.format(len(self.sql)))
+                with metrics.phase('query'):
+                    if profiler is not None:
+                        # A follow-up EXPLAIN can't take several statements
+                        self.run_profiled([multi_statement(self.sql)], explain=False)
+                    else:
+                        self.hook.run(multi_statement(self.sql), self.autocommit, parameters=self.parameters)
+                metrics.incr('statements', len(self.sql))
+            elif profiler is not None:
+                with metrics.phase('query'):
+                    self.run_profiled([self.sql] if isinstance(self.sql, str) else self.sql)
+            else:
+                with metrics.phase('query'):
+                    self.hook.run(self.sql, self.autocommit, parameters=self.parameters)
+
+    def run_profiled(self, statements, explain=True):
+        """
+        Run statements one by one like `hook.run`, profiling the slow ones
+        """
+        conn = self.hook.get_conn()
+        try:
+            self.profiler.prepare(conn)
+            self.hook.set_autocommit(conn, self.autocommit)
+            with closing(conn.cursor()) as cursor:
+                for statement in statements:
+                    with self.profiler.statement(cursor, statement, self.parameters, explain):
+                        if self.parameters is not None:
+                            cursor.execute(statement, self.parameters)
+                        else:
+                            cursor.execute(statement)
+            if not self.hook.get_autocommit(conn):
+                conn.commit()
+        finally:
+            conn.close()
+
+    def defer_query(self):
+        """
+        Hand the query over to a PostgresQueryTrigger and suspend the task
+        """
+        if not hasattr(self, 'defer'):
+            raise AirflowException('deferrable mode requires Airflow 2.2 or later')
+        from postgres_plugin.triggers.postgres_trigger import PostgresQueryTrigger
+
+        sql = self.sql
+        if self.single_round_trip and not isinstance(self.sql, str):
+            sql = multi_statement(self.sql)
+        elif not isinstance(self.sql, str):
+            # Run one by one by the trigger: a multi-statement command is an implicit transaction block,
+            # where commands such as VACUUM are not allowed
+            sql = list(self.sql)
+        # Unique tag of the query connection, used to find the backend after a triggerer restart
+        application_name = 'airflow_{}'.format(uuid.uuid4().hex)
+        self.log.info('Deferring query to triggerer (application_name [{}])'.format(application_name))
+        self.defer(trigger=PostgresQueryTrigger(sql=sql,
+                                                aws_secret_name=self.aws_secret_name,
+                                                application_name=application_name,
+                                                aws_conn_id=self.aws_conn_id,
+                                                database=self.database,
+                                                host=self.host,
+                                                parameters=self.parameters,
+                                                poll_interval=self.poll_interval,
+                                                timeout=self.query_timeout),
+                   method_name='execute_complete')
+
+    def execute_complete(self, context, event=None):
+        """
+        Resume the task when the deferred query ends
+        """
+        with task_metrics(self, context) as metrics:
+            metrics.add_time('query', event.get('duration') or 0)
+            if event['status'] != 'success':
+                self.log.error('Query on backend {} {}: {}'.format(event.get('pid'), event['status'], event['message']))
+                raise AirflowException('Deferred query {}: {}'.format(event['status'], event['message']))
+            if event.get('rowcount') is not None and event['rowcount'] >= 0:
+                metrics.incr('rows', event['rowcount'])
+            self.log.info('Query on backend {} done in {:.1f}s: {}'.format(
+                event.get('pid'), event['duration'], event.get('message')))
+
+    def get_parameter_sets(self, context):
+        """
+        Parameter sets iterable, from file, callable or given value
+        """
+        if self.parameter_sets_file:
+            return read_parameter_sets(self.parameter_sets_file)
+        if callable(self.parameter_sets):
+            return self.parameter_sets(context)
+        return self.parameter_sets
+
+    def execute_many(self, parameter_sets):
+        """
+        Run sql for every parameter set, one round trip per page, committing every `commit_every`
+        parameter sets (or once at the end)
+
+        :return: number of parameter sets
+        :rtype: int
+        """
+        if not isinstance(self.sql, str):
+            raise AirflowException('parameter_sets require a single sql statement')
+
+        conn = self.hook.get_conn()
+        cursor = conn.cursor()
+        statement = self.sql.strip().rstrip(';')
+        total = 0
+        uncommitted = 0
+        try:
+            if self.batch_method == 'prepared':
+                statement = prepare_statement(cursor, statement)
+            for page in iter_pages(parameter_sets, self.page_size):
+                with self.metrics.phase('execute'):
+                    rows = execute_page(cursor, self.batch_method, statement, page)
+                self.metrics.incr('pages')
+                self.metrics.incr('parameter_sets', len(page))
+                if rows is not None and rows >= 0:
+                    self.metrics.incr('rows', rows)
+                total += len(page)
+                uncommitted += len(page)
+                if self.commit_every and uncommitted >= self.commit_every:
+                    with self.metrics.phase('commit'):
+                        conn.commit()
+                    uncommitted = 0
+                    self.log.info('{} parameter sets executed'.format(total))
+            if self.batch_method == 'prepared':
+                deallocate_statement(cursor, statement)
+            with self.metrics.phase('commit'):
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            self.log.error('Error after {} parameter sets: [{}]'.format(total, str(e)))
+            raise AirflowException(str(e))
+        finally:
+            cursor.close()
+            conn.close()
+
+        self.log.info('{} parameter sets executed'.format(total))
+        return total
 
 
 class PostgresToPostgresOperator(BaseOperator):
@@ -77,11 +316,86 @@ class PostgresToPostgresOperator(BaseOperator):
         Template reference are recognized by str ending in '.sql'
     :param parameters: a parameters dict that is substituted at query runtime.
     :type parameters: dict
+    :param transfer_mode: how rows are moved between databases:
+        `insert` (fetch all rows and insert them) or
+        `copy` (stream `COPY (sql) TO STDOUT` into `COPY pg_table FROM STDIN`) or
+        `batch` (read through a server-side cursor and write multi-row INSERTs batch by batch)
+    :type transfer_mode: string
+    :param copy_format: COPY format used by `copy` transfer mode (`text` or `binary`)
+    :type copy_format: string
+    :param copy_buffer_chunks: number of COPY chunks buffered in memory between source and destination
+    :type copy_buffer_chunks: int
+    :param batch_size: rows fetched from the server-side cursor and inserted per statement in `batch` mode
+    :type batch_size: int
+    :param commit_every: rows inserted between destination commits in `batch` mode
+    :type commit_every: int
+    :param target_fields: destination columns, in the same order as query columns, for `batch` mode
+    :type target_fields: list
+    :param row_transform: callable applied to each source row before insert in `batch` mode
+    :type row_transform: callable
+    :param partition_column: source query column used to split the transfer in key ranges
+        transferred concurrently (`copy` and `batch` modes only)
+    :type partition_column: string
+    :param parallelism: number of partitions transferred concurrently, each one with its own connections
+    :type parallelism: int
+    :param partition_count: number of key ranges the transfer is split in (default: parallelism).
+        More partitions than parallelism make smaller units of work to resume from.
+    :type partition_count: int
+    :param partition_boundaries: how key ranges are computed on source: `minmax` (equal width ranges
+        between min and max values, for numeric and date/time columns) or `quantile` (ranges with about the same
+        number of rows, any sortable column)
+    :type partition_boundaries: string
+
+    :param load_mode: `append` inserts rows in pg_table, `merge` loads them into a staging table and
+        applies them with a single `INSERT ... ON CONFLICT (merge_key_columns) DO UPDATE`
+        (`copy` and `batch` modes only, pg_table must be a plain table name)
+    :type load_mode: string
+    :param merge_key_columns: conflict columns of pg_table (must have a unique index) in `merge` load mode
+    :type merge_key_columns: list
+    :param merge_dedup: keep only the last row of each key from staging data before merging
+    :type merge_dedup: bool
+    :param staging_table_type: `temporary` or `unlogged` staging table in `merge` load mode
+    :type staging_table_type: string
+    :param checkpoint_table: control table of the destination database recording completed partitions
+        (or the whole transfer when not partitioned) in the same transaction as their rows.
+        A retry reuses the partition boundaries of the first try, skips completed partitions
+        and pg_preoperator. Created if it doesn't exist, cleared when the task succeeds
+        (`copy` and `batch` modes only).
+    :type checkpoint_table: string
+    :param profile_threshold: capture the JSON plan of source queries slower than this many seconds
+        (COPY duration in `copy` mode, fetch time in `batch` mode), and the `pg_stat_statements`
+        deltas of the source database
+    :type profile_threshold: float
+    :param profile_method: how plans of slow statements are captured: `explain` (follow-up EXPLAIN,
+        plan only), `explain_analyze` (follow-up EXPLAIN ANALYZE: read only queries are run again and
+        rolled back, only for queries without non-transactional side effects such as `setval`) or
+        `auto_explain` (plan of the actual execution, requires the privilege to set auto_explain
+        settings, else falls back to `explain`)
+    :type profile_method: string
+
+    When partitioned, all source reads share the snapshot exported by a coordinator connection,
+    so partitions are consistent with each other. Each partition commits on its own, so
+    pg_preoperator should make the transfer idempotent (ex: truncating pg_table).
+    With a checkpoint_table, each partition commits once with its checkpoint in `append` load mode
+    (commit_every is ignored), so a failed partition leaves no rows behind. Partitions resumed by a
+    retry read a newer snapshot than the ones completed before.
+
+    Connection dicts accept `aws_conn_id`, `aws_secret_name`, `database`, `host` and
+    `use_pool` (reuse connections from the worker-level connection pool).
+
+    Phase timings (connect, fetch, copy, insert, merge...) and row/byte counters are sent to StatsD
+    and pushed to XCom (`metrics` key). Profiling reports are pushed to XCom (`profile` key).
     """
 
     template_fields = ('sql', 'parameters', 'pg_table', 'pg_preoperator', 'pg_postoperator')
     template_ext = ('.sql',)
     ui_color = '#ededed'
+    transfer_modes = ('insert', 'copy', 'batch')
+    copy_formats = ('text', 'binary')
+    partition_boundaries_methods = ('minmax', 'quantile')
+    load_modes = ('append', 'merge')
+    metrics = None
+    profiler = None
 
     @apply_defaults
     def __init__(
@@ -93,8 +407,49 @@ class PostgresToPostgresOperator(BaseOperator):
             pg_preoperator=None,
             pg_postoperator=None,
             parameters=None,
+            transfer_mode='insert',
+            copy_format='text',
+            copy_buffer_chunks=PIPE_MAX_CHUNKS,
+            batch_size=10000,
+            commit_every=100000,
+            target_fields=None,
+            row_transform=None,
+            partition_column=None,
+            parallelism=1,
+            partition_count=None,
+            partition_boundaries='minmax',
+            load_mode='append',
+            merge_key_columns=None,
+            merge_dedup=False,
+            staging_table_type=STAGING_TEMPORARY,
+            checkpoint_table=None,
+            profile_threshold=None,
+            profile_method='explain',
             *args, **kwargs):
         super(PostgresToPostgresOperator, self).__init__(*args, **kwargs)
+        if transfer_mode not in self.transfer_modes:
+            raise AirflowException('Invalid transfer_mode [{}], expected one of {}'.format(
+                transfer_mode, self.transfer_modes))
+        if copy_format not in self.copy_formats:
+            raise AirflowException('Invalid copy_format [{}], expected one of {}'.format(
+                copy_format, self.copy_formats))
+        if partition_column and transfer_mode == 'insert':
+            raise AirflowException('partition_column requires `copy` or `batch` transfer_mode')
+        if partition_boundaries not in self.partition_boundaries_methods:
+            raise AirflowException('Invalid partition_boundaries [{}], expected one of {}'.format(
+                partition_boundaries, self.partition_boundaries_methods))
+        if load_mode not in self.load_modes:
+            raise AirflowException('Invalid load_mode [{}], expected one of {}'.format(load_mode, self.load_modes))
+        if load_mode == 'merge' and (transfer_mode == 'insert' or not merge_key_columns):
+            raise AirflowException('merge load_mode requires merge_key_columns and `copy` or `batch` transfer_mode')
+        if staging_table_type not in STAGING_TABLE_TYPES:
+            raise AirflowException('Invalid staging_table_type [{}], expected one of {}'.format(
+                staging_table_type, STAGING_TABLE_TYPES))
+        if checkpoint_table and transfer_mode == 'insert':
+            raise AirflowException('checkpoint_table requires `copy` or `batch` transfer_mode')
+        if profile_method not in PROFILE_METHODS:
+            raise AirflowException('Invalid profile_method [{}], expected one of {}'.format(
+                profile_method, PROFILE_METHODS))
         self.sql = sql
         self.pg_table = pg_table
         self.src_postgres_conn = src_postgres_conn
@@ -102,47 +457,360 @@ class PostgresToPostgresOperator(BaseOperator):
         self.pg_preoperator = pg_preoperator
         self.pg_postoperator = pg_postoperator
         self.parameters = parameters
+        self.transfer_mode = transfer_mode
+        self.copy_format = copy_format
+        self.copy_buffer_chunks = copy_buffer_chunks
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.target_fields = target_fields
+        self.row_transform = row_transform
+        self.partition_column = partition_column
+        self.parallelism = parallelism
+        self.partition_count = partition_count or parallelism
+        self.partition_boundaries = partition_boundaries
+        self.load_mode = load_mode
+        self.merge_key_columns = merge_key_columns
+        self.merge_dedup = merge_dedup
+        self.staging_table_type = staging_table_type
+        self.checkpoint_table = checkpoint_table
+        self.profile_threshold = profile_threshold
+        self.profile_method = profile_method
+
+    def get_hook(self, postgres_conn):
+        """
+        Build a hook from a connection dict (credentials from AWS Secrets Manager)
+
+        :param postgres_conn: connection dict
+        :type postgres_conn: dict
+        :rtype: PostgresWithSecretsManagerCredentialsHook
+        """
+        from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+        return PostgresWithSecretsManagerCredentialsHook(
+            aws_conn_id=postgres_conn['aws_conn_id'],
+            aws_secret_name=postgres_conn['aws_secret_name'],
+            schema=postgres_conn.get("database"),
+            host=postgres_conn.get("host"),
+            use_pool=postgres_conn.get("use_pool", False),
+            metrics=self.metrics
+        )
+
+    def get_source_conn(self, src_pg, partition=None):
+        """
+        Open a source connection. Partitioned reads are made inside a read only transaction
+        using the snapshot exported by the coordinator connection.
+        """
+        conn = src_pg.get_conn()
+        if self.profiler is not None:
+            self.profiler.prepare(conn)
+        if partition is not None:
+            import_snapshot(conn, partition['snapshot'])
+        return conn
+
+    def source_query(self, cursor, partition=None):
+        """
+        Rendered source query, restricted to the key range of a partition when given
+        """
+        query = render_query(cursor, self.sql, self.parameters)
+        if partition is None or partition['lower'] is None:
+            return query
+        return key_range_query(cursor, query, self.partition_column, partition)
+
+    def merge_staging(self, dest_cursor, staging_table):
+        """
+        Apply staging rows to pg_table and empty staging table
+        """
+        with self.metrics.phase('merge'):
+            rows = merge_staging_table(dest_cursor, self.pg_table, staging_table, self.merge_key_columns,
+                                       columns=self.target_fields, dedup=self.merge_dedup)
+        self.metrics.incr('rows_merged', rows)
+        self.log.info('{} rows merged into [{}]'.format(rows, self.pg_table))
+        dest_cursor.execute('TRUNCATE {}'.format(staging_table))
+        return rows
+
+    def drop_staging(self, dest_conn, staging_table):
+        """
+        Drop staging table after a failure (a rollback doesn't drop it if it was already committed)
+        """
+        try:
+            with dest_conn.cursor() as cursor:
+                drop_staging_table(cursor, staging_table)
+            dest_conn.commit()
+        except Exception as e:  # pylint: disable=broad-except
+            self.log.warning('Unable to drop staging table [{}]: {}'.format(staging_table, str(e)))
 
     def execute(self, context):
         self.log.info('Executing: ' + str(self.sql))
 
-        # Source Postgres connection info (from AWS Secrets Manager)
-        src_pg = PostgresWithSecretsManagerCredentialsHook(
-            aws_conn_id=self.src_postgres_conn['aws_conn_id'],
-            aws_secret_name=self.src_postgres_conn['aws_secret_name'],
-            schema=self.src_postgres_conn.pop("database", None),
-            host=self.src_postgres_conn.pop("host", None)
-        )
+        with task_metrics(self, context) as metrics, task_profiler(self, context) as profiler:
+            src_pg = self.get_hook(self.src_postgres_conn)
+            dest_pg = self.get_hook(self.dest_postgres_conn)
+            if profiler is not None:
+                profiler.watch(src_pg)
 
-        # Destination Postgres connection info (from AWS Secrets Manager)
-        dest_pg = PostgresWithSecretsManagerCredentialsHook(
-            aws_conn_id=self.dest_postgres_conn['aws_conn_id'],
-            aws_secret_name=self.dest_postgres_conn['aws_secret_name'],
-            schema=self.src_postgres_conn.pop("database", None),
-            host=self.src_postgres_conn.pop("host", None)
-        )
+            checkpoint = None
+            plan, completed = None, {}
+            if self.checkpoint_table:
+                checkpoint = TableCheckpoint(dest_pg, self.checkpoint_table, checkpoint_run_key(self, context))
+                plan, completed = checkpoint.load()
 
-        self.log.info("Transferring Postgres query results into other Postgres database.")
-        conn = src_pg.get_conn()
-        cursor = conn.cursor()
-        cursor.execute(self.sql, self.parameters)
+            if completed:
+                self.log.info("Resuming from checkpoint, skipping Postgres preoperator")
+            elif self.pg_preoperator:
+                self.log.info("Executint Postgres preoperator")
+                with metrics.phase('preoperator'):
+                    dest_pg.run(self.pg_preoperator)
+
+            self.log.info("Transferring Postgres query results into other Postgres database ({} mode).".format(
+                self.transfer_mode))
+            transfer = getattr(self, 'transfer_{}'.format(self.transfer_mode))
+            if self.partition_column:
+                total_rows = self.transfer_partitioned(src_pg, dest_pg, transfer, checkpoint, plan, completed)
+            elif self.checkpoint_unit() in completed:
+                total_rows = completed[self.checkpoint_unit()]['rows']
+                self.log.info("Rows already transferred by a previous try")
+            elif checkpoint is not None:
+                total_rows = transfer(src_pg, dest_pg, checkpoint=checkpoint)
+            else:
+                total_rows = transfer(src_pg, dest_pg)
+
+            if total_rows == 0:
+                self.log.info("No rows fetched")
+            else:
+                self.log.info("{} rows transferred".format(total_rows))
+
+                if self.pg_postoperator:
+                    self.log.info("Running Postgres postoperator")
+                    with metrics.phase('postoperator'):
+                        dest_pg.run(self.pg_postoperator)
 
-        if self.pg_preoperator:
-            self.log.info("Executint Postgres preoperator")
-            dest_pg.run(self.pg_preoperator)
+            if checkpoint is not None:
+                checkpoint.clear()
 
-        fetched_cursor = cursor.fetchall()
+        self.log.info("Done.")
+
+    def transfer_insert(self, src_pg, dest_pg):
+        conn = self.get_source_conn(src_pg)
+        cursor = conn.cursor()
+        with profile_statement(self.profiler, cursor, self.sql, self.parameters), self.metrics.phase('fetch'):
+            cursor.execute(self.sql, self.parameters)
+            fetched_cursor = cursor.fetchall()
         total_rows = len(fetched_cursor)
+        cursor.close()
+        conn.close()
 
         if total_rows == 0:
-            self.log.info("No rows fetched")
-            return
+            return 0
 
         self.log.info("Inserting rows into Postgres")
-        dest_pg.insert_rows(table=self.pg_table, rows=fetched_cursor)
+        with self.metrics.phase('insert'):
+            dest_pg.insert_rows(table=self.pg_table, rows=fetched_cursor)
+        self.metrics.incr('rows', total_rows)
+        return total_rows
 
-        if self.pg_postoperator:
-            self.log.info("Running Postgres postoperator")
-            dest_pg.run(self.pg_postoperator)
+    @staticmethod
+    def checkpoint_unit(partition=None):
+        return 'all' if partition is None else 'partition-{}'.format(partition['index'])
 
-        self.log.info("Done.")
+    def transfer_partitioned(self, src_pg, dest_pg, transfer, checkpoint=None, plan=None, completed=None):
+        """
+        Split source query in key ranges and transfer them concurrently, skipping the ones
+        completed by a previous try (boundaries are then read from checkpoint plan)
+        """
+        completed = completed or {}
+        coordinator_conn = src_pg.get_conn()
+        try:
+            snapshot = export_snapshot(coordinator_conn)
+            self.log.info('Exported source snapshot [{}]'.format(snapshot))
+
+            cursor = coordinator_conn.cursor()
+            if plan is not None:
+                boundaries = plan['boundaries']
+                self.log.info('Using partition boundaries of checkpoint')
+            else:
+                boundaries = key_range_boundaries(cursor, render_query(cursor, self.sql, self.parameters),
+                                                  self.partition_column, self.partition_count,
+                                                  method=self.partition_boundaries)
+                if checkpoint is not None:
+                    checkpoint.save_plan({'boundaries': boundaries})
+            if boundaries:
+                partitions = key_ranges(boundaries)
+            else:
+                # No row with a non NULL key: a single unbounded partition still transfers NULL key rows
+                partitions = [dict(index=0, lower=None, upper=None, last=True)]
+            total_rows = sum(completed[self.checkpoint_unit(partition)]['rows'] for partition in partitions
+                             if self.checkpoint_unit(partition) in completed)
+            partitions = [partition for partition in partitions if self.checkpoint_unit(partition) not in completed]
+            for partition in partitions:
+                partition['snapshot'] = snapshot
+            self.log.info('Transferring {} partitions on [{}] with parallelism {} ({} completed before)'.format(
+                len(partitions), self.partition_column, self.parallelism, len(completed)))
+
+            failures = []
+            with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+                futures = dict((executor.submit(transfer, src_pg, dest_pg, partition, checkpoint), partition)
+                               for partition in partitions)
+                for done, future in enumerate(as_completed(futures), 1):
+                    partition = futures[future]
+                    try:
+                        rows = future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        failures.append((partition, e))
+                        self.log.error('Partition {} [{}, {}] failed: {}'.format(
+                            partition['index'], partition['lower'], partition['upper'], str(e)))
+                        for pending in futures:
+                            pending.cancel()
+                        continue
+                    total_rows += rows
+                    self.log.info('Partition {} [{}, {}] done: {} rows ({}/{} partitions, {} rows)'.format(
+                        partition['index'], partition['lower'], partition['upper'], rows,
+                        done, len(partitions), total_rows))
+        finally:
+            coordinator_conn.rollback()
+            coordinator_conn.close()
+
+        if failures:
+            raise AirflowException('{} of {} partitions failed: {}'.format(
+                len(failures), len(partitions),
+                ', '.join('{}: {}'.format(partition['index'], str(e)) for partition, e in failures)))
+        return total_rows
+
+    def transfer_copy(self, src_pg, dest_pg, partition=None, checkpoint=None):
+        src_conn = self.get_source_conn(src_pg, partition)
+        src_cursor = src_conn.cursor()
+        dest_conn = dest_cursor = None
+        pipe = producer = None
+        try:
+            dest_conn = dest_pg.get_conn()
+            dest_cursor = dest_conn.cursor()
+
+            copy_options = 'FORMAT {}'.format(self.copy_format)
+            query = self.source_query(src_cursor, partition)
+            copy_to = 'COPY ({}) TO STDOUT WITH ({})'.format(query, copy_options)
+            staging_table = None
+            copy_target = self.pg_table
+            if self.load_mode == 'merge':
+                staging_table = create_staging_table(dest_cursor, self.pg_table, self.staging_table_type)
+                copy_target = staging_table
+                if self.target_fields:
+                    copy_target = '{} ({})'.format(staging_table, ', '.join(self.target_fields))
+            copy_from = 'COPY {} FROM STDIN WITH ({})'.format(copy_target, copy_options)
+
+            pipe = BoundedPipe(max_chunks=self.copy_buffer_chunks)
+            producer = ProducerThread(target=lambda f: src_cursor.copy_expert(copy_to, f),
+                                      pipe=pipe,
+                                      name='{}-copy-to'.format(self.task_id))
+            producer.start()
+            with profile_statement(self.profiler, src_cursor, query):
+                with self.metrics.phase('copy'):
+                    dest_cursor.copy_expert(copy_from, pipe)
+                # Source cursor is free again once COPY TO has returned
+                producer.join()
+            total_rows = dest_cursor.rowcount
+            if staging_table:
+                self.merge_staging(dest_cursor, staging_table)
+                drop_staging_table(dest_cursor, staging_table)
+            if checkpoint is not None:
+                checkpoint.mark_done(self.checkpoint_unit(partition), {'rows': total_rows}, cursor=dest_cursor)
+            dest_conn.commit()
+        except Exception as e:
+            if pipe is not None:
+                pipe.abort()
+            if dest_conn is not None:
+                dest_conn.rollback()
+            error = producer.error if producer is not None and producer.error else e
+            self.log.error('Error trying to COPY rows: [{}]'.format(str(error)))
+            raise AirflowException(str(error))
+        finally:
+            if producer is not None:
+                producer.join()
+            src_cursor.close()
+            src_conn.close()
+            if dest_cursor is not None:
+                dest_cursor.close()
+            if dest_conn is not None:
+                dest_conn.close()
+
+        self.log.info('{} Mb streamed from source to destination'.format(pipe.bytes_written >> 20))
+        self.metrics.incr('rows', total_rows)
+        self.metrics.incr('bytes_transferred', pipe.bytes_written)
+        return total_rows
+
+    def transfer_batch(self, src_pg, dest_pg, partition=None, checkpoint=None):
+        import psycopg2.extras
+
+        src_conn = self.get_source_conn(src_pg, partition)
+        # Named cursor keeps result set on server side, only `batch_size` rows are held in memory
+        src_cursor = src_conn.cursor(name='{}_transfer'.format(self.task_id).replace('.', '_'))
+        src_cursor.itersize = self.batch_size
+        dest_conn = dest_cursor = None
+
+        total_rows = 0
+        uncommitted_rows = 0
+        fetch_time = 0.0
+        staging_table = None
+        try:
+            dest_conn = dest_pg.get_conn()
+            dest_cursor = dest_conn.cursor()
+            insert_target = self.pg_table
+            if self.load_mode == 'merge':
+                staging_table = create_staging_table(dest_cursor, self.pg_table, self.staging_table_type)
+                insert_target = staging_table
+            insert_sql = 'INSERT INTO {} {} VALUES %s'.format(
+                insert_target,
+                '({})'.format(', '.join(self.target_fields)) if self.target_fields else '')
+
+            query = self.source_query(src_conn.cursor(), partition)
+            src_cursor.execute(query)
+            while True:
+                started_at = time.time()
+                with self.metrics.phase('fetch'):
+                    rows = src_cursor.fetchmany(self.batch_size)
+                fetch_time += time.time() - started_at
+                if not rows:
+                    break
+                if self.row_transform is not None:
+                    with self.metrics.phase('transform'):
+                        rows = [self.row_transform(row) for row in rows]
+
+                with self.metrics.phase('insert'):
+                    psycopg2.extras.execute_values(dest_cursor, insert_sql, rows, page_size=self.batch_size)
+                self.metrics.incr('rows', len(rows))
+                total_rows += len(rows)
+                uncommitted_rows += len(rows)
+                # Appended rows are only committed with their checkpoint: a retry must not insert them again
+                if uncommitted_rows >= self.commit_every and (checkpoint is None or staging_table):
+                    if staging_table:
+                        self.merge_staging(dest_cursor, staging_table)
+                    with self.metrics.phase('commit'):
+                        dest_conn.commit()
+                    uncommitted_rows = 0
+
+                elapsed = time.time() - started_at
+                self.log.info('Batch of {} rows in {:.2f}s ({:.0f} rows/s), {} rows transferred'.format(
+                    len(rows), elapsed, len(rows) / elapsed if elapsed else 0, total_rows))
+            if self.profiler is not None:
+                # Closing the server-side cursor ends the query, auto_explain sends its plan then
+                src_cursor.close()
+                self.profiler.check(src_conn.cursor(), query, fetch_time)
+            if staging_table:
+                self.merge_staging(dest_cursor, staging_table)
+                drop_staging_table(dest_cursor, staging_table)
+            if checkpoint is not None:
+                checkpoint.mark_done(self.checkpoint_unit(partition), {'rows': total_rows}, cursor=dest_cursor)
+            dest_conn.commit()
+        except Exception as e:
+            if dest_conn is not None:
+                dest_conn.rollback()
+                if staging_table:
+                    self.drop_staging(dest_conn, staging_table)
+            self.log.error('Error trying to transfer rows: [{}]'.format(str(e)))
+            raise AirflowException(str(e))
+        finally:
+            src_cursor.close()
+            src_conn.close()
+            if dest_cursor is not None:
+                dest_cursor.close()
+            if dest_conn is not None:
+                dest_conn.close()
+
+        return total_rows
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+import logging
+import ast
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tempfile import mkdtemp
+
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from airflow.exceptions import AirflowException
+
+from postgres_plugin.utils.encryption import DecryptingReader
+from postgres_plugin.utils.metrics import task_metrics
+from postgres_plugin.utils.streams import HashingReader, StreamReader
+
+logging = logging.getLogger(__name__)
+
+RESTORE_CHUNK_SIZE = 1024 * 1024
+
+
+class PostgresRestoreOperator(BaseOperator):
+    """
+    Restore a database dump written to S3 by PostgresDumpOperator (envelope encrypted: streaming,
+    parallel or `envelope` encryption modes).
+    A AWS credential using Secrets Manager service must be used to store target database password.
+
+    Single object dumps (`<s3_key_name>.encrypted`) are streamed from S3, decrypted, decompressed and
+    piped into `pg_restore` without temporary files. The last chunk is only sent to pg_restore once the
+    `.encrypted.md5` and `.md5` digests of the whole stream have been checked, so with
+    `single_transaction` a corrupted dump is rolled back instead of half restored.
+
+    Directory format dumps (`<s3_key_name>.manifest`, written by `parallel_jobs` dumps) are downloaded
+    concurrently to a temporary directory, each file being decrypted, decompressed and checked against
+    the manifest checksums, then restored with `pg_restore -j parallel_jobs`. The temporary directory
+    needs as much space as the uncompressed dump.
+
+    :param db_name: Database to restore into
+    :type db_name: str
+    :param secret_name: Secret name (path) from AWS Secrets Manager of the target database
+        (same format as PostgresDumpOperator)
+    :type secret_name: str
+    :param s3_bucket_name: S3 bucket holding the dump
+    :type s3_bucket_name: str
+    :param s3_key_name: Dump key name, without `.encrypted` or `.manifest` extension (accepted too)
+    :type s3_key_name: str
+    :param aws_conn_id: AWS connection used to read S3 and to call KMS
+    :type aws_conn_id: str
+    :param parallel_jobs: Number of pg_restore jobs for directory format dumps
+    :type parallel_jobs: int
+    :param file_download_concurrency: Number of dump files downloaded concurrently for directory format dumps
+    :type file_download_concurrency: int
+    :param compression: Codec the dump was compressed with before encryption. Read from S3 object metadata
+        or manifest when not given (`envelope` file dumps don't record it).
+    :type compression: str
+    :param single_transaction: Restore single object dumps with `pg_restore --single-transaction`
+    :type single_transaction: bool
+    :param verify_checksums: Fail when `.md5` and `.encrypted.md5` files are missing (digests are
+        always checked when present)
+    :type verify_checksums: bool
+    :param restore_extra_parameters: Extra pg_restore parameters (ex: `--clean --if-exists --no-owner`)
+    :type restore_extra_parameters: str
+    :return: Restored dump key name
+
+    Phase timings (secret_fetch, download, restore) and byte counters are sent to StatsD and pushed to
+    XCom (`metrics` key).
+    """
+
+    template_fields = ['s3_key_name']
+    aws_secret_key = None
+    metrics = None
+
+    @apply_defaults
+    def __init__(self,
+                 db_name,
+                 secret_name,
+                 s3_bucket_name,
+                 s3_key_name,
+                 aws_conn_id='aws_default',
+                 parallel_jobs=4,
+                 file_download_concurrency=4,
+                 compression=None,
+                 single_transaction=True,
+                 verify_checksums=True,
+                 restore_extra_parameters='',
+                 *args, **kwargs):
+        super(PostgresRestoreOperator, self).__init__(*args, **kwargs)
+        self.db_name = db_name
+        self.secret_name = secret_name
+        self.s3_bucket_name = s3_bucket_name
+        self.s3_key_name = s3_key_name
+        self.aws_conn_id = aws_conn_id
+        self.parallel_jobs = parallel_jobs
+        self.file_download_concurrency = file_download_concurrency
+        self.compression = compression
+        self.single_transaction = single_transaction
+        self.verify_checksums = verify_checksums
+        self.restore_extra_parameters = restore_extra_parameters
+
+    def execute(self, context):
+        with task_metrics(self, context):
+            return self.restore()
+
+    def restore(self):
+        """
+        Restore a single object or a directory format dump
+
+        :return: dump key name
+        :rtype: str
+        """
+        from airflow.contrib.hooks.aws_hook import AwsHook
+        from airflow.hooks.S3_hook import S3Hook
+        from aws_plugin import AwsSecretsManagerHook
+
+        logging.info('Looking for AWS Secret Manager key')
+        secret_manager = AwsSecretsManagerHook(aws_secret_name=self.secret_name)
+        with self.metrics.phase('secret_fetch'):
+            self.aws_secret_key = ast.literal_eval(secret_manager.get_secret())
+
+        s3 = S3Hook(aws_conn_id=self.aws_conn_id)
+        kms_client = AwsHook(aws_conn_id=self.aws_conn_id).get_client_type('kms')
+        key_name = self.s3_key_name
+        for extension in ('.encrypted', '.manifest'):
+            if key_name.endswith(extension):
+                key_name = key_name[:-len(extension)]
+
+        manifest_key_name = '{}.manifest'.format(key_name)
+        if s3.check_for_key(manifest_key_name, self.s3_bucket_name):
+            self.restore_directory(s3, kms_client, manifest_key_name)
+        else:
+            self.restore_stream(s3, kms_client, key_name)
+        logging.info('Done.')
+        return key_name
+
+    def restore_command(self, input_dir=None, jobs=None):
+        """
+        pg_restore command line. Input is read from stdin when no directory is given.
+
+        :rtype: str
+        """
+        return "pg_restore -v {format} {jobs} {single_transaction} -h {host} -U {user} -d {dbname} " \
+               "{restore_extra_parameters} {input_dir}".format(
+                   format='-Fd' if input_dir else '-Ft',
+                   jobs='-j {}'.format(jobs) if jobs else '',
+                   single_transaction='--single-transaction' if self.single_transaction and not jobs else '',
+                   host=self.aws_secret_key['host'],
+                   user=self.aws_secret_key['username'],
+                   dbname=self.db_name,
+                   restore_extra_parameters=self.restore_extra_parameters,
+                   input_dir=input_dir or '')
+
+    def start_restore(self, input_dir=None, jobs=None):
+        env = dict(os.environ, PGPASSWORD=self.aws_secret_key['password'])
+        process = subprocess.Popen(shlex.split(self.restore_command(input_dir=input_dir, jobs=jobs)),
+                                   stdin=None if input_dir else subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        log_thread = threading.Thread(target=self.log_stream, args=(process.stdout,))
+        log_thread.daemon = True
+        log_thread.start()
+        return process, log_thread
+
+    @staticmethod
+    def log_stream(stream):
+        for line in iter(stream.readline, b''):
+            logging.info(line.decode('utf-8', 'replace').rstrip())
+        stream.close()
+
+    def read_digest(self, s3, key_name):
+        """
+        Digest stored in a `.md5` file, None if it doesn't exist (and checksums are optional)
+
+        :rtype: str
+        """
+        if not s3.check_for_key(key_name, self.s3_bucket_name):
+            if self.verify_checksums:
+                raise AirflowException('Checksum file [{}] not found'.format(key_name))
+            logging.warning('Checksum file [{}] not found, not verified'.format(key_name))
+            return None
+        return s3.read_key(key_name, self.s3_bucket_name).strip()
+
+    @staticmethod
+    def check_digest(name, expected, actual):
+        if expected is not None and expected != actual:
+            raise AirflowException('{} MD5 mismatch: expected [{}], got [{}]'.format(name, expected, actual))
+
+    def decrypted_reader(self, body, kms_client, compression):
+        """
+        S3 body -> ciphertext md5 -> decryption -> decompression
+
+        :return: hashing reader (ciphertext digest) and plaintext reader
+        :rtype: tuple
+        """
+        hashing_reader = HashingReader(body)
+        reader = StreamReader(DecryptingReader(hashing_reader, kms_client),
+                              compression='gzip' if compression == 'pgzip' else compression,
+                              chunk_size=RESTORE_CHUNK_SIZE)
+        return hashing_reader, reader
+
+    def restore_stream(self, s3, kms_client, key_name):
+        """
+        S3 object -> ciphertext md5 -> decryption -> decompression -> plaintext md5 -> pg_restore stdin
+        """
+        encrypted_key_name = '{}.encrypted'.format(key_name)
+        expected_md5 = self.read_digest(s3, '{}.md5'.format(key_name))
+        expected_encrypted_md5 = self.read_digest(s3, '{}.encrypted.md5'.format(key_name))
+
+        s3_object = s3.get_key(encrypted_key_name, self.s3_bucket_name)
+        response = s3_object.get()
+        compression = self.compression or response.get('Metadata', {}).get('compression')
+        logging.info('Streaming dump [{}/{}] (compression: {}) into pg_restore'.format(
+            self.s3_bucket_name, encrypted_key_name, compression))
+        body = response['Body']
+        hashing_reader, reader = self.decrypted_reader(body, kms_client, compression)
+
+        plain_md5 = hashlib.md5()
+        size = 0
+        process, log_thread = self.start_restore()
+        try:
+            with self.metrics.phase('restore'):
+                # A chunk is held back until the next one is read, so the last chunk is only sent
+                # once the whole dump has been checked
+                pending = None
+                for chunk in iter(lambda: reader.read(RESTORE_CHUNK_SIZE), b''):
+                    if pending is not None:
+                        process.stdin.write(pending)
+                    plain_md5.update(chunk)
+                    size += len(chunk)
+                    pending = chunk
+                if hashing_reader.read(RESTORE_CHUNK_SIZE):
+                    raise AirflowException('Unexpected data after the final encrypted frame')
+                self.check_digest('Encrypted dump', expected_encrypted_md5, hashing_reader.hexdigest())
+                self.check_digest('Dump', expected_md5, plain_md5.hexdigest())
+                if pending is not None:
+                    process.stdin.write(pending)
+                process.stdin.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise AirflowException('pg_restore exited with code {}'.format(returncode))
+        except ValueError as e:
+            # Raised by DecryptingReader on non envelope encrypted data or failed frame authentication
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            raise AirflowException('Unable to decrypt [{}]: {} (dumps encrypted in `kms` mode must be '
+                                   'decrypted with AwsKmsHook first)'.format(encrypted_key_name, str(e)))
+        except Exception as e:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            logging.error('Error trying to restore dump: [{}]'.format(str(e)))
+            raise AirflowException(str(e))
+        finally:
+            body.close()
+            log_thread.join()
+
+        self.metrics.incr('bytes_downloaded', hashing_reader.bytes_read)
+        self.metrics.incr('bytes_restored', size)
+        logging.info('Dump restored: {}Mb ({}Mb encrypted)'.format(size >> 20, hashing_reader.bytes_read >> 20))
+
+    def restore_directory(self, s3, kms_client, manifest_key_name):
+        """
+        Download, decrypt and check every file of a directory format dump, then run a parallel pg_restore
+        """
+        manifest = json.loads(s3.read_key(manifest_key_name, self.s3_bucket_name))
+        compression = self.compression or manifest.get('compression')
+        s3_client = s3.get_conn()
+        work_dir = mkdtemp(prefix=self.task_id)
+        dump_dir = os.path.join(work_dir, 'dump')
+        os.mkdir(dump_dir)
+        logging.info('Downloading {} dump files listed in [{}] to [{}]'.format(
+            len(manifest['files']), manifest_key_name, dump_dir))
+        try:
+            failures = []
+            with self.metrics.phase('download'), \
+                    ThreadPoolExecutor(max_workers=self.file_download_concurrency) as executor:
+                futures = dict((executor.submit(self.download_dump_file, s3_client, kms_client, compression,
+                                                dump_dir, entry), entry)
+                               for entry in manifest['files'])
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        logging.error('Dump file [{}] failed: {}'.format(futures[future]['file'], str(e)))
+                        failures.append((futures[future], e))
+            if failures:
+                raise AirflowException('{} of {} dump files failed: {}'.format(
+                    len(failures), len(manifest['files']),
+                    ', '.join('{}: {}'.format(entry['file'], str(e)) for entry, e in failures)))
+
+            process, log_thread = self.start_restore(input_dir=dump_dir, jobs=self.parallel_jobs)
+            with self.metrics.phase('restore'):
+                returncode = process.wait()
+                log_thread.join()
+            if returncode != 0:
+                raise AirflowException('pg_restore exited with code {}'.format(returncode))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def download_dump_file(self, s3_client, kms_client, compression, dump_dir, entry):
+        """
+        Download, decrypt and decompress one file of a directory format dump, checking manifest checksums
+        """
+        body = s3_client.get_object(Bucket=self.s3_bucket_name, Key=entry['key'])['Body']
+        hashing_reader, reader = self.decrypted_reader(body, kms_client, compression)
+        plain_md5 = hashlib.md5()
+        try:
+            with open(os.path.join(dump_dir, entry['file']), 'wb') as f:
+                for chunk in iter(lambda: reader.read(RESTORE_CHUNK_SIZE), b''):
+                    plain_md5.update(chunk)
+                    f.write(chunk)
+        finally:
+            body.close()
+        self.check_digest(entry['key'], entry.get('encrypted_md5'), hashing_reader.hexdigest())
+        self.check_digest(entry['file'], entry.get('md5'), plain_md5.hexdigest())
+        self.metrics.incr('bytes_downloaded', hashing_reader.bytes_read)
+        self.metrics.incr('bytes_restored', entry['size'])
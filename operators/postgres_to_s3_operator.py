@@ -1,21 +1,102 @@
 # -*- coding: utf-8 -*-
 import logging
-import gzip
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tempfile import NamedTemporaryFile
 
-from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
-from postgres_plugin import PostgresWithSecretsManagerCredentialsHook
+from postgres_plugin.utils.parquet import write_parquet, PARQUET_ROW_GROUP_SIZE, PARQUET_COMPRESSION
+from postgres_plugin.utils.compression import CompressingWriter, CODECS
+from postgres_plugin.utils.encryption import EnvelopeEncryptor, EncryptingWriter, encryption_metadata
+from postgres_plugin.utils.bulk_load import secondary_indexes, foreign_keys, drop_indexes, drop_foreign_keys, \
+    add_foreign_key, tune_session, BULK_LOAD_MAINTENANCE_WORK_MEM, BULK_LOAD_INDEX_WORKERS
+from postgres_plugin.utils.checkpoints import S3Checkpoint, TableCheckpoint, checkpoint_run_key
+from postgres_plugin.utils.metrics import task_metrics
+from postgres_plugin.utils.profiling import task_profiler, profile_statement, PROFILE_METHODS
+from postgres_plugin.utils.merge import create_staging_table, drop_staging_table, merge_staging_table, \
+    STAGING_TEMPORARY, STAGING_TABLE_TYPES
+from postgres_plugin.utils.streams import StreamReader, guess_compression
+from postgres_plugin.utils.s3 import S3MultipartWriter, S3_PART_SIZE, S3_UPLOAD_CONCURRENCY
+from postgres_plugin.utils.partitions import export_snapshot, import_snapshot, key_range_boundaries, \
+    key_ranges, key_range_query, ctid_ranges, ctid_filter
 
 
 class PostgresToS3Operator(BaseOperator):
+    """
+    Export a PostgreSQL query result to a S3 file via COPY command
+
+    :param streaming: pipe COPY output (and compression) straight into a S3 multipart upload,
+        without temporary files
+    :type streaming: bool
+    :param s3_part_size: size in bytes of each multipart upload part in streaming mode
+    :type s3_part_size: int
+    :param s3_upload_concurrency: number of parts uploaded concurrently in streaming mode
+    :type s3_upload_concurrency: int
+    :param shards: number of S3 objects (`<key>_part-0000<ext>`...) exported in parallel, each one by
+        its own connection reading the same exported snapshot. A `<key>.manifest` JSON object lists
+        the parts with their row counts and byte sizes. Implies streaming mode.
+    :type shards: int
+    :param shard_column: query column used to split the export in key ranges
+    :type shard_column: str
+    :param shard_boundaries: how key ranges are computed: `minmax` or `quantile`
+    :type shard_boundaries: str
+    :param shard_table: when shard_column is not given, export is split by ranges of heap pages (ctid)
+        of this table. `sql` must then contain a `{shard_filter}` placeholder in the WHERE clause
+        applied to this table (ex: `SELECT * FROM my_table WHERE {shard_filter}`).
+    :type shard_table: str
+    :param shard_checkpoint: record the shard ranges and the uploaded shards in a `<key>.checkpoint`
+        S3 object, so a retry only exports the missing shards (with the ranges of the first try).
+        The checkpoint is deleted once the manifest is written.
+    :type shard_checkpoint: bool
+    :param output_format: `csv` (PostgreSQL text COPY output, optionally compressed) or `parquet`
+        (rows streamed from a server-side cursor into Parquet row groups, requires pyarrow).
+        Parquet output is always streamed to S3.
+    :type output_format: str
+    :param parquet_row_group_size: rows per Parquet row group, bounds memory usage
+    :type parquet_row_group_size: int
+    :param parquet_compression: Parquet compression codec (snappy, gzip, zstd, lz4, brotli or none)
+    :type parquet_compression: str
+    :param encryption_kms_key_arn: envelope encrypt exported objects with a data key generated by this
+        KMS key (AES-GCM frames, same format as PostgresDumpOperator). Implies streaming mode.
+    :type encryption_kms_key_arn: str
+    :param encryption_aws_conn_id: AWS connection used to call KMS
+    :type encryption_aws_conn_id: str
+    :param encryption_workers: number of threads encrypting frames concurrently (default: number of cores)
+    :type encryption_workers: int
+    :param compression: codec compressing COPY output while it is produced: `gzip`, `pgzip`
+        (block-parallel gzip), `zstd` or `lz4`. `compress_file=True` is the same as `gzip`.
+    :type compression: str
+    :param compression_level: codec compression level (codec default if None)
+    :type compression_level: int
+    :param compression_threads: worker threads of `pgzip` and `zstd` codecs (default: number of cores)
+    :type compression_threads: int
+    :param profile_threshold: capture the JSON plan of the query (of each shard) when its export takes
+        longer than this many seconds, and the `pg_stat_statements` deltas of the source database.
+        In streaming mode the export time includes waits on S3 uploads.
+    :type profile_threshold: float
+    :param profile_method: how plans of slow statements are captured: `explain` (follow-up EXPLAIN,
+        plan only), `explain_analyze` (follow-up EXPLAIN ANALYZE: read only queries are run again and
+        rolled back, only for queries without non-transactional side effects such as `setval`) or
+        `auto_explain` (plan of the actual execution, requires the privilege to set auto_explain
+        settings, else falls back to `explain`)
+    :type profile_method: str
+
+    Phase timings (secret_fetch, connect, copy, compress, kms, encrypt, upload) and row/byte counters
+    are sent to StatsD and pushed to XCom (`metrics` key). Profiling reports are pushed to XCom
+    (`profile` key).
+    """
 
     template_fields = ('sql', 'dest_s3_key_name')
     template_ext = ('.sql',)
     ui_color = '#ededed'
+    output_formats = ('csv', 'parquet')
+    metrics = None
+    profiler = None
+    run_key = None
 
     @apply_defaults
     def __init__(
@@ -29,6 +110,25 @@ class PostgresToS3Operator(BaseOperator):
             dest_s3_conn_id='postgres_default',
             delete_temporary_file=True,
             compress_file=False,
+            streaming=False,
+            s3_part_size=S3_PART_SIZE,
+            s3_upload_concurrency=S3_UPLOAD_CONCURRENCY,
+            shards=1,
+            shard_column=None,
+            shard_boundaries='minmax',
+            shard_table=None,
+            shard_checkpoint=False,
+            output_format='csv',
+            parquet_row_group_size=PARQUET_ROW_GROUP_SIZE,
+            parquet_compression=PARQUET_COMPRESSION,
+            encryption_kms_key_arn=None,
+            encryption_aws_conn_id='aws_default',
+            encryption_workers=None,
+            compression=None,
+            compression_level=None,
+            compression_threads=None,
+            profile_threshold=None,
+            profile_method='explain',
             *args, **kwargs):
         super(PostgresToS3Operator, self).__init__(*args, **kwargs)
         self.sql = sql
@@ -40,26 +140,100 @@ class PostgresToS3Operator(BaseOperator):
         self.dest_s3_encrypt = dest_s3_encrypt
         self.delete_temporary_file = delete_temporary_file
         self.compress_file = compress_file
+        self.streaming = streaming
+        self.s3_part_size = s3_part_size
+        self.s3_upload_concurrency = s3_upload_concurrency
+        self.shards = shards
+        self.shard_column = shard_column
+        self.shard_boundaries = shard_boundaries
+        self.shard_table = shard_table
+        self.shard_checkpoint = shard_checkpoint
+        if shards > 1 and not (shard_column or shard_table):
+            raise AirflowException('Sharded export requires shard_column or shard_table')
+        if output_format not in self.output_formats:
+            raise AirflowException('Invalid output_format [{}], expected one of {}'.format(
+                output_format, self.output_formats))
+        self.output_format = output_format
+        self.parquet_row_group_size = parquet_row_group_size
+        self.parquet_compression = parquet_compression
+        self.encryption_kms_key_arn = encryption_kms_key_arn
+        self.encryption_aws_conn_id = encryption_aws_conn_id
+        self.encryption_workers = encryption_workers
+        if compression is not None and compression not in CODECS:
+            raise AirflowException('Invalid compression [{}], expected one of {}'.format(compression, CODECS))
+        self.compression = compression or ('gzip' if compress_file else None)
+        self.compression_level = compression_level
+        self.compression_threads = compression_threads
+        if profile_method not in PROFILE_METHODS:
+            raise AirflowException('Invalid profile_method [{}], expected one of {}'.format(
+                profile_method, PROFILE_METHODS))
+        self.profile_threshold = profile_threshold
+        self.profile_method = profile_method
         self.execution_date = kwargs.get('execution_date')
 
     def execute(self, context):
         logging.info('Extracting query: ' + str(self.sql))
 
+        self.run_key = checkpoint_run_key(self, context)
+        with task_metrics(self, context), task_profiler(self, context):
+            self.export()
+        logging.info('Done.')
+
+    def export(self):
+        """
+        Export query result to S3 (single object, streamed object or shards)
+        """
+        from airflow.hooks.S3_hook import S3Hook
+        from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+
         src_pgsql = PostgresWithSecretsManagerCredentialsHook(
             aws_conn_id=self.src_postgres_conn['aws_conn_id'],
             aws_secret_name=self.src_postgres_conn['aws_secret_name'],
-            schema=self.src_postgres_conn['database']
+            schema=self.src_postgres_conn['database'],
+            use_pool=self.src_postgres_conn.get('use_pool', False),
+            metrics=self.metrics
         )
+        if self.profiler is not None:
+            self.profiler.watch(src_pgsql)
+        dest_s3 = S3Hook(aws_conn_id=self.dest_s3_conn_id)
+
+        if self.shards > 1:
+            self.export_shards(src_pgsql, dest_s3)
+            return
+
         src_conn = src_pgsql.get_conn()
-        cursor = src_conn.cursor()
+        try:
+            if self.profiler is not None:
+                self.profiler.prepare(src_conn)
+            cursor = src_conn.cursor()
+            if self.streaming or self.output_format == 'parquet' or self.encryption_kms_key_arn:
+                self.stream_to_s3(cursor, dest_s3)
+            else:
+                self.export_file(cursor, dest_s3)
+        finally:
+            src_conn.close()
 
-        dest_s3 = S3Hook(aws_conn_id=self.dest_s3_conn_id)
+    def export_file(self, cursor, dest_s3):
+        """
+        COPY query result to a temporary file (compressed while COPY is running), then upload it to S3
 
+        :param cursor: source database cursor
+        :param dest_s3: destination S3 hook
+        :type dest_s3: S3Hook
+        """
         with NamedTemporaryFile(mode='wb', delete=self.delete_temporary_file) as f_plain:
 
             logging.info('Starting COPY to [{}].'.format(f_plain.name))
             try:
-                cursor.copy_to(f_plain, '({})'.format(self.sql), null='')
+                # Output is compressed while COPY is running, no second pass over the file
+                f_out = self.compressing_writer(f_plain) if self.compression else f_plain
+                with profile_statement(self.profiler, cursor, self.sql), self.metrics.phase('copy'):
+                    cursor.copy_to(f_out, '({})'.format(self.sql), null='')
+                    if self.compression:
+                        f_out.close()
+                self.metrics.incr('rows', cursor.rowcount)
+                if self.compression:
+                    self.record_compression(f_out)
             except Exception as e:
                 logging.error('Error trying to fetch query: [{}]'.format(str(e)))
                 raise AirflowException(str(e))
@@ -67,36 +241,308 @@ class PostgresToS3Operator(BaseOperator):
             f_plain.flush()
             logging.info('File created.')
 
-            f_compressed = NamedTemporaryFile(mode='wb', delete=self.delete_temporary_file)
-            if self.compress_file:
-                logging.info('Start to compress file [{}]'.format(f_compressed.name))
-                with open(f_plain.name, 'rb') as src, gzip.open(f_compressed.name, 'wb') as dst:
-                    dst.writelines(src)
-
             logging.info('Starting to transfer file to S3 bucket [{}]'.format(self.dest_s3_bucket_name))
             logging.info('File path on S3 [{}]'.format(self.dest_s3_key_name))
-            dest_s3.load_file(f_compressed.name if self.compress_file else f_plain.name,
-                              key=self.dest_s3_key_name,
-                              bucket_name=self.dest_s3_bucket_name,
-                              replace=self.dest_s3_replace,
-                              encrypt=self.dest_s3_encrypt)
+            with self.metrics.phase('upload'):
+                dest_s3.load_file(f_plain.name,
+                                  key=self.dest_s3_key_name,
+                                  bucket_name=self.dest_s3_bucket_name,
+                                  replace=self.dest_s3_replace,
+                                  encrypt=self.dest_s3_encrypt)
+            self.metrics.incr('bytes_uploaded', f_plain.tell())
 
             # list s3 file
             files = dest_s3.list_keys(self.dest_s3_bucket_name, prefix=self.dest_s3_key_name)
             logging.info('S3 file: [{}]'.format(files))
 
-            logging.info('Done.')
+    def stream_to_s3(self, cursor, dest_s3):
+        """
+        COPY query result through optional compression into a S3 multipart upload
+
+        :param cursor: source database cursor
+        :param dest_s3: destination S3 hook
+        :type dest_s3: S3Hook
+        """
+        if not self.dest_s3_replace and dest_s3.check_for_key(self.dest_s3_key_name, self.dest_s3_bucket_name):
+            raise ValueError('The key {} already exists.'.format(self.dest_s3_key_name))
+
+        logging.info('Streaming COPY to S3 bucket [{}]'.format(self.dest_s3_bucket_name))
+        logging.info('File path on S3 [{}]'.format(self.dest_s3_key_name))
+        try:
+            uploaded_bytes, rows = self.write_to_s3(cursor, self.sql.strip().rstrip(';'),
+                                                    dest_s3.get_conn(), self.dest_s3_key_name)
+        except Exception as e:
+            logging.error('Error trying to stream query to S3: [{}]'.format(str(e)))
+            raise AirflowException(str(e))
+
+        logging.info('{} rows, {}Mb uploaded to S3.'.format(rows, uploaded_bytes >> 20))
+
+    def write_to_s3(self, cursor, query, s3_client, key):
+        """
+        Stream query result to a S3 object, as COPY text output or as Parquet
+
+        :return: uploaded bytes and exported rows
+        :rtype: tuple
+        """
+        extra_args = None
+        if self.encryption_kms_key_arn:
+            extra_args = {'Metadata': encryption_metadata(self.encryption_kms_key_arn)}
+        writer = S3MultipartWriter(s3_client,
+                                   bucket_name=self.dest_s3_bucket_name,
+                                   key=key,
+                                   part_size=self.s3_part_size,
+                                   concurrency=self.s3_upload_concurrency,
+                                   encrypt=self.dest_s3_encrypt,
+                                   extra_args=extra_args)
+        with writer:
+            if not self.encryption_kms_key_arn:
+                rows = self.write_query(cursor, query, writer)
+            else:
+                from airflow.contrib.hooks.aws_hook import AwsHook
+                kms_client = AwsHook(aws_conn_id=self.encryption_aws_conn_id).get_client_type('kms')
+                with self.metrics.phase('kms'):
+                    encryptor = EnvelopeEncryptor(kms_client, self.encryption_kms_key_arn)
+                # Closed (final frame written, or worker threads stopped on error) before the upload
+                # is completed or aborted
+                with EncryptingWriter(writer, encryptor, workers=self.encryption_workers) as sink:
+                    rows = self.write_query(cursor, query, sink)
+                self.metrics.add_time('encrypt', sink.elapsed)
+        self.metrics.add_time('upload', writer.elapsed)
+        self.metrics.incr('bytes_uploaded', writer.bytes_written)
+        return writer.bytes_written, rows
+
+    def write_query(self, cursor, query, writer):
+        """
+        Write query result to a file object, as COPY text output (optionally compressed) or as Parquet
+
+        :return: exported rows
+        :rtype: int
+        """
+        if self.output_format == 'parquet':
+            # Server-side cursor so only one row group is held in memory
+            parquet_cursor = cursor.connection.cursor(name='{}_parquet'.format(self.task_id).replace('.', '_'))
+            parquet_cursor.itersize = self.parquet_row_group_size
+            with profile_statement(self.profiler, cursor, query):
+                with self.metrics.phase('parquet'):
+                    parquet_cursor.execute(query)
+                    rows = write_parquet(parquet_cursor, writer,
+                                         row_group_size=self.parquet_row_group_size,
+                                         compression=self.parquet_compression)
+                # Closing the server-side cursor ends the query, auto_explain sends its plan then
+                parquet_cursor.close()
+            self.metrics.incr('rows', rows)
+            return rows
+
+        f_out = self.compressing_writer(writer) if self.compression else writer
+        with profile_statement(self.profiler, cursor, query), self.metrics.phase('copy'):
+            cursor.copy_expert("COPY ({}) TO STDOUT WITH NULL ''".format(query), f_out)
+            if self.compression:
+                f_out.close()
+        self.metrics.incr('rows', cursor.rowcount)
+        if self.compression:
+            self.record_compression(f_out)
+        return cursor.rowcount
+
+    def compressing_writer(self, fileobj):
+        return CompressingWriter(fileobj, self.compression,
+                                 level=self.compression_level,
+                                 threads=self.compression_threads)
+
+    def record_compression(self, writer):
+        self.metrics.add_time('compress', writer.elapsed)
+        self.metrics.incr('bytes_exported', writer.bytes_in)
+        self.metrics.incr('bytes_compressed', writer.bytes_out)
+
+    def shard_key_name(self, index):
+        """
+        S3 key of a shard: `_part-NNNN` suffix is added before key extension (ex: `data_part-0001.csv.gz`)
+        """
+        path, _, basename = self.dest_s3_key_name.rpartition('/')
+        name, dot, extension = basename.partition('.')
+        return '{}{}{}_part-{:04d}{}{}'.format(path, '/' if path else '', name, index, dot, extension)
+
+    def export_shards(self, src_pgsql, dest_s3):
+        """
+        Export query in parallel shards sharing the same snapshot and write a manifest listing them
+        """
+        if not self.shard_column and '{shard_filter}' not in self.sql:
+            # Every shard would export the whole result
+            raise AirflowException('Sharding by shard_table requires a {shard_filter} placeholder in sql')
+        manifest_key = '{}.manifest'.format(self.dest_s3_key_name)
+        if not self.dest_s3_replace and dest_s3.check_for_key(manifest_key, self.dest_s3_bucket_name):
+            raise ValueError('The key {} already exists.'.format(manifest_key))
+
+        s3_client = dest_s3.get_conn()
+        checkpoint = None
+        plan, completed = None, {}
+        if self.shard_checkpoint:
+            checkpoint = S3Checkpoint(s3_client, self.dest_s3_bucket_name,
+                                      '{}.checkpoint'.format(self.dest_s3_key_name),
+                                      self.run_key, encrypt=self.dest_s3_encrypt)
+            plan, completed = checkpoint.load()
+
+        coordinator_conn = src_pgsql.get_conn()
+        try:
+            snapshot = export_snapshot(coordinator_conn)
+            logging.info('Exported source snapshot [{}]'.format(snapshot))
+            cursor = coordinator_conn.cursor()
+            query = self.sql.strip().rstrip(';')
+            if plan is not None:
+                shards = plan['shards']
+                logging.info('Using shard ranges of checkpoint')
+            else:
+                if self.shard_column:
+                    shards = key_ranges(key_range_boundaries(cursor, query, self.shard_column, self.shards,
+                                                             method=self.shard_boundaries))
+                    if not shards:
+                        shards = [dict(index=0, lower=None, upper=None, last=True)]
+                else:
+                    shards = ctid_ranges(cursor, self.shard_table, self.shards)
+                if checkpoint is not None:
+                    checkpoint.save_plan({'shards': shards})
+            # Shards uploaded by a previous try are kept as they are
+            parts = [completed[unit] for unit in sorted(completed)]
+            pending_shards = [shard for shard in shards if 'shard-{}'.format(shard['index']) not in completed]
+            for shard in pending_shards:
+                shard['snapshot'] = snapshot
+            logging.info('Exporting {} shards to S3 bucket [{}] ({} uploaded before)'.format(
+                len(pending_shards), self.dest_s3_bucket_name, len(parts)))
+
+            failures = []
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                futures = dict((executor.submit(self.export_shard, src_pgsql, s3_client, query, shard), shard)
+                               for shard in pending_shards)
+                for done, future in enumerate(as_completed(futures), 1):
+                    shard = futures[future]
+                    try:
+                        parts.append(future.result())
+                    except Exception as e:  # pylint: disable=broad-except
+                        logging.error('Shard {} failed: {}'.format(shard['index'], str(e)))
+                        failures.append((shard, e))
+                        continue
+                    if checkpoint is not None:
+                        checkpoint.mark_done('shard-{}'.format(shard['index']), parts[-1])
+                    logging.info('Shard {} done: {} rows, {}Mb ({}/{} shards)'.format(
+                        shard['index'], parts[-1]['rows'], parts[-1]['bytes'] >> 20, done, len(pending_shards)))
+        finally:
+            coordinator_conn.rollback()
+            coordinator_conn.close()
+
+        if failures:
+            raise AirflowException('{} of {} shards failed: {}'.format(
+                len(failures), len(pending_shards),
+                ', '.join('{}: {}'.format(shard['index'], str(e)) for shard, e in failures)))
+
+        parts.sort(key=lambda part: part['key'])
+        manifest = {
+            'parts': parts,
+            'rows': sum(part['rows'] for part in parts),
+            'bytes': sum(part['bytes'] for part in parts),
+        }
+        dest_s3.load_string(json.dumps(manifest, indent=2),
+                            key=manifest_key,
+                            bucket_name=self.dest_s3_bucket_name,
+                            replace=True,
+                            encrypt=self.dest_s3_encrypt)
+        logging.info('Manifest [{}]: {} parts, {} rows, {}Mb'.format(
+            manifest_key, len(parts), manifest['rows'], manifest['bytes'] >> 20))
+        if checkpoint is not None:
+            checkpoint.clear()
+        return manifest
+
+    def export_shard(self, src_pgsql, s3_client, query, shard):
+        conn = src_pgsql.get_conn()
+        try:
+            if self.profiler is not None:
+                self.profiler.prepare(conn)
+            import_snapshot(conn, shard['snapshot'])
+            cursor = conn.cursor()
+            if self.shard_column:
+                if shard['lower'] is not None:
+                    query = key_range_query(cursor, query, self.shard_column, shard)
+            else:
+                query = query.replace('{shard_filter}', ctid_filter(shard))
+            key = self.shard_key_name(shard['index'])
+            uploaded_bytes, rows = self.write_to_s3(cursor, query, s3_client, key)
+        finally:
+            conn.close()
+        return {
+            'key': key,
+            'url': 's3://{}/{}'.format(self.dest_s3_bucket_name, key),
+            'rows': rows,
+            'bytes': uploaded_bytes,
+        }
 
 
 class S3ToPostgresOperator(BaseOperator):
     """
     Download a file from S3 bucket and import to PostgreSQL database via COPY command
 
+    :param streaming: stream S3 object body straight into COPY, without loading it in memory
+        or writing it to a temporary file
+    :type streaming: bool
+    :param s3_compression: compression of S3 object in streaming mode: None, `gzip`, `zstd`, `lz4`
+        or `auto` (guessed from key extension)
+    :type s3_compression: str
+    :param skip_header: skip first line of the file
+    :type skip_header: bool
+    :param s3_prefix: load every object under this prefix instead of a single `s3_key_name`
+        (manifest, checkpoint and md5 objects written alongside exports are skipped)
+    :type s3_prefix: str
+    :param s3_manifest_key: load every object listed in this manifest (as written by sharded
+        PostgresToS3Operator exports, or a Redshift manifest) instead of a single `s3_key_name`.
+        Listed objects must be in `s3_bucket_name`.
+    :type s3_manifest_key: str
+    :param load_concurrency: number of objects loaded concurrently, each one on its own connection
+    :type load_concurrency: int
+    :param file_retries: number of retries of a failed object before failing the task
+    :type file_retries: int
+    :param load_tracking_table: table recording loaded objects, written in the same transaction as
+        their COPY, so a rerun skips objects already loaded. Created if it doesn't exist.
+    :type load_tracking_table: str
+    :param checkpoint_table: control table recording the objects loaded by this task run, in the same
+        transaction as their COPY. Unlike load_tracking_table, it only lasts until the task succeeds:
+        a retry skips loaded objects and pg_preoperator, while the next run loads everything again.
+        Created if it doesn't exist (s3_prefix and s3_manifest_key loads only).
+    :type checkpoint_table: str
+    :param load_mode: `append` copies rows into dest_table_name, `merge` copies them into a staging
+        table and applies them with a single `INSERT ... ON CONFLICT (merge_key_columns) DO UPDATE`.
+        Merge implies streaming mode.
+    :type load_mode: str
+    :param merge_key_columns: conflict columns of dest_table_name (must have a unique index)
+    :type merge_key_columns: list
+    :param merge_dedup: keep only the last row of each key from staging data before merging
+    :type merge_dedup: bool
+    :param staging_table_type: `temporary` or `unlogged` staging table in `merge` load mode
+    :type staging_table_type: str
+    :param bulk_load: bulk-load profile: secondary indexes and foreign keys of dest_table_name are
+        dropped before loading (their definitions are logged) and rebuilt afterwards, loading sessions
+        use `synchronous_commit=off` and a larger `maintenance_work_mem`, and the table is analyzed at
+        the end. If the load fails, indexes and foreign keys are rebuilt before the task fails.
+        Unique indexes and indexes backing constraints are kept. pg_postoperator runs before indexes
+        are rebuilt.
+    :type bulk_load: bool
+    :param bulk_load_maintenance_work_mem: `maintenance_work_mem` of bulk-load sessions
+    :type bulk_load_maintenance_work_mem: str
+    :param bulk_load_index_workers: number of connections rebuilding indexes concurrently
+    :type bulk_load_index_workers: int
+    :param bulk_load_freeze: truncate dest_table_name and load it with `COPY ... FREEZE` in the same
+        transaction, so rows are written already frozen and no later vacuum rewrites them
+        (bulk_load, `append` mode and single s3_key_name only). A failed load rolls back the truncate.
+    :type bulk_load_freeze: bool
+
+    Phase timings (secret_fetch, connect, download, copy, merge, drop_indexes, index_rebuild,
+    foreign_keys, analyze) and row/byte counters are sent to
+    StatsD and pushed to XCom (`metrics` key).
     """
 
-    template_fields = ('dest_table_name', 's3_key_name', 'pg_preoperator', 'pg_postoperator')
+    template_fields = ('dest_table_name', 's3_key_name', 's3_prefix', 's3_manifest_key',
+                       'pg_preoperator', 'pg_postoperator')
     template_ext = ('.sql',)
     ui_color = '#ededed'
+    metadata_suffixes = ('.manifest', '.checkpoint', '.md5')
+    metrics = None
+    run_key = None
 
     @apply_defaults
     def __init__(
@@ -106,9 +552,26 @@ class S3ToPostgresOperator(BaseOperator):
             dest_table_columns,
             s3_conn_id,
             s3_bucket_name,
-            s3_key_name,
+            s3_key_name=None,
             pg_preoperator=None,
             pg_postoperator=None,
+            streaming=False,
+            s3_compression='auto',
+            skip_header=True,
+            s3_prefix=None,
+            s3_manifest_key=None,
+            load_concurrency=4,
+            file_retries=2,
+            load_tracking_table=None,
+            checkpoint_table=None,
+            load_mode='append',
+            merge_key_columns=None,
+            merge_dedup=False,
+            staging_table_type=STAGING_TEMPORARY,
+            bulk_load=False,
+            bulk_load_maintenance_work_mem=BULK_LOAD_MAINTENANCE_WORK_MEM,
+            bulk_load_index_workers=BULK_LOAD_INDEX_WORKERS,
+            bulk_load_freeze=False,
             *args, **kwargs):
         super(S3ToPostgresOperator, self).__init__(*args, **kwargs)
         self.postgres_conn = postgres_conn
@@ -119,20 +582,182 @@ class S3ToPostgresOperator(BaseOperator):
         self.s3_conn_id = s3_conn_id
         self.s3_bucket_name = s3_bucket_name
         self.s3_key_name = s3_key_name
+        self.streaming = streaming
+        self.s3_compression = s3_compression
+        self.skip_header = skip_header
+        self.s3_prefix = s3_prefix
+        self.s3_manifest_key = s3_manifest_key
+        self.load_concurrency = load_concurrency
+        self.file_retries = file_retries
+        self.load_tracking_table = load_tracking_table
+        self.checkpoint_table = checkpoint_table
+        if not (s3_key_name or s3_prefix or s3_manifest_key):
+            raise AirflowException('One of s3_key_name, s3_prefix or s3_manifest_key is required')
+        if checkpoint_table and not (s3_prefix or s3_manifest_key):
+            raise AirflowException('checkpoint_table requires s3_prefix or s3_manifest_key')
+        if load_mode not in ('append', 'merge'):
+            raise AirflowException('Invalid load_mode [{}], expected `append` or `merge`'.format(load_mode))
+        if load_mode == 'merge' and not merge_key_columns:
+            raise AirflowException('merge load_mode requires merge_key_columns')
+        if staging_table_type not in STAGING_TABLE_TYPES:
+            raise AirflowException('Invalid staging_table_type [{}], expected one of {}'.format(
+                staging_table_type, STAGING_TABLE_TYPES))
+        if bulk_load_freeze and not (bulk_load and load_mode == 'append' and not (s3_prefix or s3_manifest_key)):
+            raise AirflowException('bulk_load_freeze requires bulk_load, `append` load_mode and a single s3_key_name')
+        self.load_mode = load_mode
+        self.merge_key_columns = merge_key_columns
+        self.merge_dedup = merge_dedup
+        self.staging_table_type = staging_table_type
+        self.bulk_load = bulk_load
+        self.bulk_load_maintenance_work_mem = bulk_load_maintenance_work_mem
+        self.bulk_load_index_workers = bulk_load_index_workers
+        self.bulk_load_freeze = bulk_load_freeze
         self.execution_date = kwargs.get('execution_date')
 
+    def get_hook(self):
+        from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+        return PostgresWithSecretsManagerCredentialsHook(
+            aws_conn_id=self.postgres_conn['aws_conn_id'],
+            aws_secret_name=self.postgres_conn['aws_secret_name'],
+            schema=self.postgres_conn['database'],
+            use_pool=self.postgres_conn.get('use_pool', False),
+            metrics=self.metrics
+        )
+
     def execute(self, context):
 
         logging.info('Downloading file from S3 and inserting into PostgreSQL via COPY command')
 
+        self.run_key = checkpoint_run_key(self, context)
+        with task_metrics(self, context):
+            self.load()
+        logging.info('Done.')
+
+    def load(self):
+        """
+        Load S3 object(s) into destination table, with bulk-load profile if enabled
+        """
+        from airflow.hooks.S3_hook import S3Hook
+
         s3 = S3Hook(aws_conn_id=self.s3_conn_id)
+        if not self.bulk_load:
+            self.load_objects(s3)
+            return
+
+        pgsql = self.get_hook()
+        dropped = self.prepare_bulk_load(pgsql)
+        try:
+            self.load_objects(s3)
+        except Exception:
+            logging.error('Load failed, restoring indexes and foreign keys of [{}]'.format(self.dest_table_name))
+            try:
+                self.restore_bulk_load(pgsql, dropped)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Unable to restore [{}]: {}'.format(self.dest_table_name, str(e)))
+            raise
+        self.restore_bulk_load(pgsql, dropped)
+
+        logging.info('Analyzing [{}]'.format(self.dest_table_name))
+        with self.metrics.phase('analyze'):
+            pgsql.run('ANALYZE {}'.format(self.dest_table_name), autocommit=True)
+
+    def prepare_bulk_load(self, pgsql):
+        """
+        Capture and drop secondary indexes and foreign keys of destination table, in one transaction
+
+        :return: dropped `indexes` and `foreign_keys` (names and definitions)
+        :rtype: dict
+        """
+        conn = pgsql.get_conn()
+        try:
+            with conn.cursor() as cursor:
+                dropped = {
+                    'indexes': secondary_indexes(cursor, self.dest_table_name),
+                    'foreign_keys': foreign_keys(cursor, self.dest_table_name),
+                }
+                # Logged so they can be created by hand if the worker dies before restoring them
+                for _, definition in dropped['indexes']:
+                    logging.info('Dropping index: {}'.format(definition))
+                for name, definition in dropped['foreign_keys']:
+                    logging.info('Dropping foreign key: {} {}'.format(name, definition))
+                with self.metrics.phase('drop_indexes'):
+                    drop_foreign_keys(cursor, self.dest_table_name, dropped['foreign_keys'])
+                    drop_indexes(cursor, dropped['indexes'])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return dropped
+
+    def restore_bulk_load(self, pgsql, dropped):
+        """
+        Rebuild dropped indexes in parallel connections, then add dropped foreign keys back.
+        Every index and foreign key is attempted, even when some of them fail.
+        """
+        failures = []
+        if dropped['indexes']:
+            logging.info('Rebuilding {} indexes of [{}] with {} connections'.format(
+                len(dropped['indexes']), self.dest_table_name, self.bulk_load_index_workers))
+            with ThreadPoolExecutor(max_workers=self.bulk_load_index_workers) as executor:
+                futures = dict((executor.submit(self.create_index, pgsql, definition), name)
+                               for name, definition in dropped['indexes'])
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        logging.error('Index [{}] failed: {}'.format(futures[future], str(e)))
+                        failures.append((futures[future], e))
+
+        for name, definition in dropped['foreign_keys']:
+            conn = pgsql.get_conn()
+            conn.autocommit = True
+            try:
+                with self.metrics.phase('foreign_keys'), conn.cursor() as cursor:
+                    tune_session(cursor, self.bulk_load_maintenance_work_mem)
+                    add_foreign_key(cursor, self.dest_table_name, name, definition)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Foreign key [{}] failed: {}'.format(name, str(e)))
+                failures.append((name, e))
+            finally:
+                conn.close()
+
+        if failures:
+            raise AirflowException('{} of {} indexes and foreign keys of [{}] failed: {}'.format(
+                len(failures), len(dropped['indexes']) + len(dropped['foreign_keys']), self.dest_table_name,
+                ', '.join('{}: {}'.format(name, str(e)) for name, e in failures)))
+
+    def create_index(self, pgsql, definition):
+        conn = pgsql.get_conn()
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                tune_session(cursor, self.bulk_load_maintenance_work_mem)
+                with self.metrics.phase('index_rebuild'):
+                    cursor.execute(definition)
+        finally:
+            conn.close()
+
+    def load_objects(self, s3):
+        """
+        Load S3 object(s) into destination table
+        """
+        if self.s3_prefix or self.s3_manifest_key:
+            self.load_many_from_s3(s3)
+            return
+
+        if self.streaming or self.load_mode == 'merge':
+            self.stream_from_s3(s3)
+            return
 
         with NamedTemporaryFile(mode='w') as temp_file_s3:
 
             logging.info('S3 file to read: [{}/{}]'.format(self.s3_bucket_name, self.s3_key_name))
             logging.info('Writing S3 file to [{}].'.format(temp_file_s3.name))
             try:
-                temp_file_s3.write(s3.read_key(self.s3_key_name, self.s3_bucket_name))
+                with self.metrics.phase('download'):
+                    temp_file_s3.write(s3.read_key(self.s3_key_name, self.s3_bucket_name))
             except Exception as e:
                 logging.error('Error: {}'.format(str(e)))
                 logging.error('Error: {}'.format(str(type(e))))
@@ -143,32 +768,43 @@ class S3ToPostgresOperator(BaseOperator):
             with open(temp_file_s3.name, 'r') as file_read:
 
                 # Skip first row
-                next(file_read)
+                if self.skip_header:
+                    next(file_read)
 
-                pgsql = PostgresWithSecretsManagerCredentialsHook(
-                    aws_conn_id=self.postgres_conn['aws_conn_id'],
-                    aws_secret_name=self.postgres_conn['aws_secret_name'],
-                    schema=self.postgres_conn['database']
-                )
+                pgsql = self.get_hook()
                 pgsql_conn = pgsql.get_conn()
-                pgsql_conn.autocommit = True
+                # COPY FREEZE requires the truncate in the same transaction
+                pgsql_conn.autocommit = not self.bulk_load_freeze
                 pgsql_cursor = pgsql_conn.cursor()
+                if self.bulk_load:
+                    tune_session(pgsql_cursor, self.bulk_load_maintenance_work_mem)
 
                 if self.pg_preoperator is not None:
                     logging.info('Running pg_preoperator query.')
-                    pgsql.run(self.pg_preoperator)
+                    with self.metrics.phase('preoperator'):
+                        pgsql.run(self.pg_preoperator)
 
                 try:
 
                     logging.info('Start to copy file to database')
 
                     logging.info('Destination table: [{}]'.format(self.dest_table_name))
-                    pgsql_cursor.copy_from(file=file_read,
-                                           table=self.dest_table_name,
-                                           columns=self.dest_table_columns)
-                    pgsql_conn.commit()
+                    with self.metrics.phase('copy'):
+                        if self.bulk_load_freeze:
+                            pgsql_cursor.execute('TRUNCATE {}'.format(self.dest_table_name))
+                            pgsql_cursor.copy_expert(self.copy_statement(self.dest_table_name, freeze=True),
+                                                     file_read)
+                        else:
+                            pgsql_cursor.copy_from(file=file_read,
+                                                   table=self.dest_table_name,
+                                                   columns=self.dest_table_columns)
+                        pgsql_conn.commit()
+                    self.metrics.incr('rows', pgsql_cursor.rowcount)
+                    self.metrics.incr('bytes_read', file_read.tell())
 
                 except Exception as e:
+                    if not pgsql_conn.autocommit:
+                        pgsql_conn.rollback()
                     logging.error('Error trying to load file to db: [{}]'.format(str(e)))
                     raise AirflowException(str(e))
 
@@ -176,8 +812,235 @@ class S3ToPostgresOperator(BaseOperator):
                     logging.info('Running pg_postoperator query [{}].'.format(self.pg_postoperator))
                     logging.info('Post operator result: {}'.format(pgsql.get_first(self.pg_postoperator)[0]))
 
+                pgsql_conn.close()
                 logging.info('File Uploaded to database.')
 
-            logging.info('Done.')
+    def columns_list(self):
+        columns = self.dest_table_columns
+        if isinstance(columns, str):
+            columns = [column.strip() for column in columns.split(',')]
+        return list(columns or [])
+
+    def copy_statement(self, table_name, freeze=False):
+        columns = self.columns_list()
+        return 'COPY {}{} FROM STDIN{}'.format(table_name, ' ({})'.format(', '.join(columns)) if columns else '',
+                                               ' WITH (FREEZE)' if freeze else '')
+
+    def stream_from_s3(self, s3):
+        """
+        Stream S3 object body, decompressed on the fly, into a COPY FROM STDIN
+        """
+        pgsql = self.get_hook()
+        pgsql_conn = pgsql.get_conn()
+        try:
+            # COPY FREEZE requires the truncate in the same transaction
+            pgsql_conn.autocommit = not self.bulk_load_freeze
+            if self.bulk_load:
+                with pgsql_conn.cursor() as cursor:
+                    tune_session(cursor, self.bulk_load_maintenance_work_mem)
+
+            if self.pg_preoperator is not None:
+                logging.info('Running pg_preoperator query.')
+                with self.metrics.phase('preoperator'):
+                    pgsql.run(self.pg_preoperator)
+
+            logging.info('Destination table: [{}]'.format(self.dest_table_name))
+            try:
+                if self.bulk_load_freeze:
+                    with pgsql_conn.cursor() as cursor:
+                        cursor.execute('TRUNCATE {}'.format(self.dest_table_name))
+                rows = self.copy_s3_key(s3, self.s3_key_name, pgsql_conn, freeze=self.bulk_load_freeze)
+                pgsql_conn.commit()
+            except Exception as e:
+                if not pgsql_conn.autocommit:
+                    pgsql_conn.rollback()
+                logging.error('Error trying to load file to db: [{}]'.format(str(e)))
+                raise AirflowException(str(e))
+            logging.info('{} rows loaded.'.format(rows))
+
+            if self.pg_postoperator is not None:
+                logging.info('Running pg_postoperator query [{}].'.format(self.pg_postoperator))
+                logging.info('Post operator result: {}'.format(pgsql.get_first(self.pg_postoperator)[0]))
+        finally:
+            pgsql_conn.close()
+        logging.info('File Uploaded to database.')
+
+    def copy_s3_key(self, s3, key_name, pgsql_conn, freeze=False):
+        """
+        COPY one S3 object into destination table
+
+        :return: loaded rows
+        :rtype: int
+        """
+        compression = guess_compression(key_name) if self.s3_compression == 'auto' else self.s3_compression
+        logging.info('Streaming S3 file [{}/{}] (compression: {})'.format(self.s3_bucket_name, key_name, compression))
+        body = s3.get_key(key_name, self.s3_bucket_name).get()['Body']
+        reader = StreamReader(body, compression=compression, skip_header=self.skip_header)
+        try:
+            with pgsql_conn.cursor() as cursor:
+                if self.load_mode == 'merge':
+                    staging_table = create_staging_table(cursor, self.dest_table_name, self.staging_table_type)
+                    try:
+                        with self.metrics.phase('copy'):
+                            cursor.copy_expert(self.copy_statement(staging_table), reader)
+                        rows = cursor.rowcount
+                        with self.metrics.phase('merge'):
+                            merged_rows = merge_staging_table(cursor, self.dest_table_name, staging_table,
+                                                              self.merge_key_columns, columns=self.columns_list(),
+                                                              dedup=self.merge_dedup)
+                        self.metrics.incr('rows_merged', merged_rows)
+                        logging.info('{} rows merged into [{}]'.format(merged_rows, self.dest_table_name))
+                    finally:
+                        if not pgsql_conn.closed and pgsql_conn.autocommit:
+                            drop_staging_table(cursor, staging_table)
+                    if not pgsql_conn.autocommit:
+                        drop_staging_table(cursor, staging_table)
+                else:
+                    with self.metrics.phase('copy'):
+                        cursor.copy_expert(self.copy_statement(self.dest_table_name, freeze=freeze), reader)
+                    rows = cursor.rowcount
+        finally:
+            body.close()
+        logging.info('{}Mb read from S3 file [{}]'.format(reader.bytes_read >> 20, key_name))
+        self.metrics.incr('rows', rows)
+        self.metrics.incr('bytes_read', reader.bytes_read)
+        return rows
+
+    def list_s3_keys(self, s3):
+        """
+        Keys to load, from manifest or prefix listing
+
+        :rtype: list
+        """
+        if self.s3_manifest_key:
+            manifest = json.loads(s3.read_key(self.s3_manifest_key, self.s3_bucket_name))
+            if 'parts' in manifest:
+                return [part['key'] for part in manifest['parts']]
+            # Redshift manifest: {"entries": [{"url": "s3://bucket/key"}]}
+            keys = []
+            for url in (entry['url'] for entry in manifest['entries']):
+                bucket_name, _, key = url[len('s3://'):].partition('/')
+                if bucket_name != self.s3_bucket_name:
+                    raise AirflowException('Manifest [{}] entry [{}] is not in bucket [{}]: objects of a '
+                                           'manifest must be in s3_bucket_name'.format(
+                                               self.s3_manifest_key, url, self.s3_bucket_name))
+                keys.append(key)
+            return keys
+
+        keys = s3.list_keys(self.s3_bucket_name, prefix=self.s3_prefix) or []
+        return sorted(key for key in keys if not key.endswith('/') and not key.endswith(self.metadata_suffixes))
+
+    def loaded_s3_keys(self, pgsql):
+        """
+        Keys already loaded according to load tracking table (created if it doesn't exist)
+
+        :rtype: set
+        """
+        if not self.load_tracking_table:
+            return set()
+        pgsql.run('CREATE TABLE IF NOT EXISTS {} ('
+                  'bucket_name text NOT NULL, '
+                  'key_name text NOT NULL, '
+                  'table_name text NOT NULL, '
+                  'rows bigint, '
+                  'loaded_at timestamptz NOT NULL DEFAULT now(), '
+                  'PRIMARY KEY (bucket_name, key_name, table_name))'.format(self.load_tracking_table),
+                  autocommit=True)
+        records = pgsql.get_records(
+            'SELECT key_name FROM {} WHERE bucket_name = %s AND table_name = %s'.format(self.load_tracking_table),
+            parameters=(self.s3_bucket_name, self.dest_table_name))
+        return set(record[0] for record in records)
+
+    def load_many_from_s3(self, s3):
+        """
+        Load many S3 objects concurrently, skipping the ones already loaded
+        """
+        pgsql = self.get_hook()
 
+        checkpoint = None
+        completed = {}
+        if self.checkpoint_table:
+            checkpoint = TableCheckpoint(pgsql, self.checkpoint_table, self.run_key)
+            _, completed = checkpoint.load()
 
+        keys = self.list_s3_keys(s3)
+        loaded_keys = self.loaded_s3_keys(pgsql)
+        pending_keys = [key for key in keys if key not in loaded_keys and key not in completed]
+        logging.info('{} S3 files found, {} already loaded, {} to load'.format(
+            len(keys), len(keys) - len(pending_keys), len(pending_keys)))
+
+        if completed:
+            logging.info('Resuming from checkpoint, skipping pg_preoperator query.')
+        elif self.pg_preoperator is not None:
+            logging.info('Running pg_preoperator query.')
+            with self.metrics.phase('preoperator'):
+                pgsql.run(self.pg_preoperator, autocommit=True)
+
+        total_rows = sum(unit['rows'] for unit in completed.values())
+        failures = []
+        if pending_keys:
+            with ThreadPoolExecutor(max_workers=self.load_concurrency) as executor:
+                futures = dict((executor.submit(self.load_s3_key_with_retries, s3, pgsql, key, checkpoint), key)
+                               for key in pending_keys)
+                for done, future in enumerate(as_completed(futures), 1):
+                    key = futures[future]
+                    try:
+                        rows = future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        logging.error('S3 file [{}] failed: {}'.format(key, str(e)))
+                        failures.append((key, e))
+                        continue
+                    total_rows += rows
+                    logging.info('S3 file [{}] loaded: {} rows ({}/{} files)'.format(
+                        key, rows, done, len(pending_keys)))
+
+        if failures:
+            raise AirflowException('{} of {} S3 files failed: {}'.format(
+                len(failures), len(pending_keys), ', '.join('{}: {}'.format(key, str(e)) for key, e in failures)))
+
+        logging.info('{} rows loaded.'.format(total_rows))
+
+        if self.pg_postoperator is not None:
+            logging.info('Running pg_postoperator query [{}].'.format(self.pg_postoperator))
+            logging.info('Post operator result: {}'.format(pgsql.get_first(self.pg_postoperator)[0]))
+
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    def load_s3_key_with_retries(self, s3, pgsql, key_name, checkpoint=None):
+        """
+        Load one S3 object in its own transaction, recording it in load tracking table and checkpoint
+
+        :return: loaded rows
+        :rtype: int
+        """
+        attempt = 0
+        while True:
+            pgsql_conn = pgsql.get_conn()
+            try:
+                if self.bulk_load:
+                    with pgsql_conn.cursor() as cursor:
+                        tune_session(cursor, self.bulk_load_maintenance_work_mem)
+                rows = self.copy_s3_key(s3, key_name, pgsql_conn)
+                if self.load_tracking_table:
+                    with pgsql_conn.cursor() as cursor:
+                        cursor.execute(
+                            'INSERT INTO {} (bucket_name, key_name, table_name, rows) '
+                            'VALUES (%s, %s, %s, %s)'.format(self.load_tracking_table),
+                            (self.s3_bucket_name, key_name, self.dest_table_name, rows))
+                if checkpoint is not None:
+                    with pgsql_conn.cursor() as cursor:
+                        checkpoint.mark_done(key_name, {'rows': rows}, cursor=cursor)
+                pgsql_conn.commit()
+                return rows
+            except Exception as e:  # pylint: disable=broad-except
+                pgsql_conn.rollback()
+                attempt += 1
+                if attempt > self.file_retries:
+                    raise
+                logging.warning('S3 file [{}] failed (attempt {}/{}), retrying: {}'.format(
+                    key_name, attempt, self.file_retries + 1, str(e)))
+                self.metrics.incr('file_retries')
+                time.sleep(2 ** attempt)
+            finally:
+                pgsql_conn.close()
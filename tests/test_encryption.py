@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import io
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from postgres_plugin.utils.encryption import EnvelopeEncryptor, EncryptingWriter, DecryptingReader
+
+FRAME_SIZE = 16
+
+
+class FakeKmsClient(object):
+    """
+    KMS client wrapping data keys by reversing them
+    """
+
+    def generate_data_key(self, KeyId, KeySpec):  # pylint: disable=invalid-name,unused-argument
+        key = os.urandom(32)
+        return {'Plaintext': key, 'CiphertextBlob': key[::-1]}
+
+    def decrypt(self, CiphertextBlob):  # pylint: disable=invalid-name
+        return {'Plaintext': CiphertextBlob[::-1]}
+
+
+def encrypt(data, workers=1, chunk_size=7):
+    output = io.BytesIO()
+    encryptor = EnvelopeEncryptor(FakeKmsClient(), 'key-arn', frame_size=FRAME_SIZE)
+    with EncryptingWriter(output, encryptor, workers=workers) as writer:
+        for start in range(0, len(data), chunk_size):
+            writer.write(data[start:start + chunk_size])
+    return output.getvalue()
+
+
+def decrypt(ciphertext, read_size=-1):
+    reader = DecryptingReader(io.BytesIO(ciphertext), FakeKmsClient())
+    if read_size < 0:
+        return reader.read()
+    chunks = []
+    while True:
+        chunk = reader.read(read_size)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+@pytest.mark.parametrize('size', [0, 1, FRAME_SIZE - 1, FRAME_SIZE, FRAME_SIZE + 1, 3 * FRAME_SIZE, 100])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_round_trip(size, workers):
+    data = os.urandom(size)
+    ciphertext = encrypt(data, workers=workers)
+    assert decrypt(ciphertext) == data
+    assert decrypt(ciphertext, read_size=5) == data
+
+
+def test_writer_counts_plaintext_and_ciphertext():
+    output = io.BytesIO()
+    encryptor = EnvelopeEncryptor(FakeKmsClient(), 'key-arn', frame_size=FRAME_SIZE)
+    with EncryptingWriter(output, encryptor) as writer:
+        writer.write(b'x' * 40)
+    assert writer.tell() == 40
+    assert writer.bytes_written == len(output.getvalue())
+
+
+@pytest.mark.parametrize('size', [0, FRAME_SIZE, 3 * FRAME_SIZE, 50])
+def test_truncated_stream_is_rejected(size):
+    ciphertext = encrypt(os.urandom(size))
+    for cut in (1, 17, len(ciphertext) // 2):
+        with pytest.raises(ValueError, match='Truncated'):
+            decrypt(ciphertext[:len(ciphertext) - cut])
+
+
+def test_missing_final_frame_is_rejected():
+    ciphertext = encrypt(os.urandom(3 * FRAME_SIZE))
+    # Each frame: flag (1) + length (4) + ciphertext (frame + 16 bytes GCM tag)
+    frame = 1 + 4 + FRAME_SIZE + 16
+    final_frame_start = len(ciphertext) - frame
+    with pytest.raises(ValueError, match='Truncated'):
+        decrypt(ciphertext[:final_frame_start])
+
+
+def test_tampered_frame_is_rejected():
+    ciphertext = bytearray(encrypt(os.urandom(2 * FRAME_SIZE)))
+    ciphertext[-1] ^= 1
+    with pytest.raises(InvalidTag):
+        decrypt(bytes(ciphertext))
+
+
+def test_not_encrypted_stream_is_rejected():
+    with pytest.raises(ValueError, match='Not an envelope encrypted stream'):
+        decrypt(b'plain text data')
+
+
+def test_writer_stops_workers_on_error():
+    output = io.BytesIO()
+    encryptor = EnvelopeEncryptor(FakeKmsClient(), 'key-arn', frame_size=FRAME_SIZE)
+    with pytest.raises(RuntimeError):
+        with EncryptingWriter(output, encryptor, workers=4) as writer:
+            writer.write(b'x' * 10 * FRAME_SIZE)
+            raise RuntimeError('query failed')
+    assert writer.closed
+    assert not writer._pending  # pylint: disable=protected-access
+    with pytest.raises(RuntimeError):
+        writer._executor.submit(len, b'')  # pylint: disable=protected-access
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import datetime
+import random
+from decimal import Decimal
+
+import pytest
+
+from postgres_plugin.utils.partitions import key_range_boundaries, key_ranges
+
+
+class FakeCursor(object):
+    """
+    Cursor answering the min/max query of `key_range_boundaries`
+    """
+
+    def __init__(self, lower, upper):
+        self.row = (lower, upper)
+
+    def execute(self, sql, parameters=None):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+
+def ranges_of(lower, upper, parallelism):
+    return key_ranges(key_range_boundaries(FakeCursor(lower, upper), 'SELECT id FROM t', 'id', parallelism))
+
+
+def containing(ranges, key):
+    return [key_range['index'] for key_range in ranges
+            if key_range['lower'] <= key and (key <= key_range['upper'] if key_range['last']
+                                              else key < key_range['upper'])]
+
+
+@pytest.mark.parametrize('lower,upper', [
+    (2 ** 60 + 200, 2 ** 60 + 10 ** 6),
+    (2 ** 60 + 200, 2 ** 62 - 1),
+    (-2 ** 62, 2 ** 62),
+    (0, 10),
+    (5, 7),
+])
+@pytest.mark.parametrize('parallelism', [1, 3, 8, 16])
+def test_integer_ranges_cover_every_key(lower, upper, parallelism):
+    ranges = ranges_of(lower, upper, parallelism)
+    assert ranges[0]['lower'] == lower
+    assert ranges[-1]['upper'] == upper
+    assert all(isinstance(key_range['lower'], int) for key_range in ranges)
+
+    keys = {lower, lower + 1, upper - 1, upper}
+    for key_range in ranges:
+        keys.update(key for key in (key_range['lower'] - 1, key_range['lower'], key_range['lower'] + 1)
+                    if lower <= key <= upper)
+    rng = random.Random(0)
+    keys.update(rng.randint(lower, upper) for _ in range(200))
+    for key in keys:
+        assert len(containing(ranges, key)) == 1, key
+
+
+def test_single_value():
+    ranges = ranges_of(2 ** 60, 2 ** 60, 4)
+    assert len(ranges) == 1
+    assert containing(ranges, 2 ** 60) == [0]
+
+
+def test_no_rows():
+    assert key_range_boundaries(FakeCursor(None, None), 'SELECT id FROM t', 'id', 4) == []
+
+
+@pytest.mark.parametrize('lower,upper', [
+    (Decimal('0.1'), Decimal('100.7')),
+    (datetime.date(2020, 1, 1), datetime.date(2020, 12, 31)),
+    (datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2, 3, 4, 5)),
+])
+def test_non_integer_ranges_keep_exact_bounds(lower, upper):
+    ranges = ranges_of(lower, upper, 3)
+    assert ranges[0]['lower'] == lower
+    assert ranges[-1]['upper'] == upper
+    assert containing(ranges, lower) == [0]
+    assert containing(ranges, upper) == [len(ranges) - 1]
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Triggerer-side execution of long running queries, for deferrable operators (Airflow 2.2+).
+
+The trigger fetches credentials from AWS Secrets Manager, runs the query on an asynchronous psycopg2
+connection and waits on its socket from the triggerer event loop, so a single triggerer process can
+follow hundreds of queries. While waiting, the backend is watched in `pg_stat_activity` and cancelled
+with `pg_cancel_backend` when the timeout is reached or when the trigger is cancelled.
+
+Connections are tagged with a unique `application_name`. If the triggerer dies while a query runs,
+the trigger is restarted by another triggerer, which cancels the orphan backend and submits the query
+again (like a task retry would).
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import asyncio
+import logging
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+
+from postgres_plugin.hooks.postgres_hook import PostgresWithSecretsManagerCredentialsHook
+
+logging = logging.getLogger(__name__)
+
+QUERY_POLL_INTERVAL = 60
+
+
+async def wait_connection(conn):
+    """
+    Wait for an asynchronous psycopg2 connection to be ready (connected, or query finished)
+    """
+    loop = asyncio.get_event_loop()
+    fileno = conn.fileno()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fileno, ready)
+            remove = loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fileno, ready)
+            remove = loop.remove_writer
+        else:
+            raise psycopg2.OperationalError('Unexpected connection poll state [{}]'.format(state))
+        try:
+            await future
+        finally:
+            remove(fileno)
+
+
+async def connect(conn_args):
+    conn = psycopg2.connect(async_=True, **conn_args)
+    await wait_connection(conn)
+    return conn
+
+
+async def fetch(conn, sql, parameters=None):
+    cursor = conn.cursor()
+    cursor.execute(sql, parameters)
+    await wait_connection(conn)
+    rows = cursor.fetchall()
+    cursor.close()
+    return rows
+
+
+class PostgresQueryTrigger(BaseTrigger):
+    """
+    Run a query from the triggerer and fire an event when it ends
+
+    Event payload: `status` (`success`, `error` or `timeout`), `pid`, `duration`,
+    `rowcount` and `message`.
+
+    :param sql: query, or list of statements run one after another (each one in its own transaction,
+        so commands such as VACUUM can be given)
+    :type sql: str or list
+    :param aws_secret_name: secret holding database credentials
+    :type aws_secret_name: str
+    :param aws_conn_id: AWS connection used to read the secret
+    :type aws_conn_id: str
+    :param database: database overriding the one in secret
+    :type database: str
+    :param host: host overriding the one in secret
+    :type host: str
+    :param parameters: query parameters (of every statement)
+    :param application_name: unique tag of the query connections
+    :type application_name: str
+    :param poll_interval: seconds between two `pg_stat_activity` checks
+    :type poll_interval: int
+    :param timeout: seconds after which the query is cancelled (no timeout if None)
+    :type timeout: int
+    """
+
+    def __init__(self, sql, aws_secret_name, application_name, aws_conn_id='aws_default', database=None,
+                 host=None, parameters=None, poll_interval=QUERY_POLL_INTERVAL, timeout=None):
+        super(PostgresQueryTrigger, self).__init__()
+        self.sql = sql
+        self.aws_secret_name = aws_secret_name
+        self.application_name = application_name
+        self.aws_conn_id = aws_conn_id
+        self.database = database
+        self.host = host
+        self.parameters = parameters
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def serialize(self):
+        # Credentials are never serialized: the secret is read again by the triggerer
+        return ('postgres_plugin.triggers.postgres_trigger.PostgresQueryTrigger', {
+            'sql': self.sql,
+            'aws_secret_name': self.aws_secret_name,
+            'application_name': self.application_name,
+            'aws_conn_id': self.aws_conn_id,
+            'database': self.database,
+            'host': self.host,
+            'parameters': self.parameters,
+            'poll_interval': self.poll_interval,
+            'timeout': self.timeout,
+        })
+
+    async def get_conn_args(self):
+        hook = PostgresWithSecretsManagerCredentialsHook(
+            aws_conn_id=self.aws_conn_id,
+            aws_secret_name=self.aws_secret_name,
+            schema=self.database,
+            host=self.host
+        )
+        # boto3 is blocking: read the secret outside of the event loop
+        loop = asyncio.get_event_loop()
+        aws_secret_key = await loop.run_in_executor(None, hook.get_secret)
+        conn_args = hook.get_conn_args(aws_secret_key)
+        conn_args['application_name'] = self.application_name
+        return conn_args
+
+    async def cancel_orphans(self, monitor):
+        """
+        Cancel queries left by a previous run of this trigger (ex: triggerer restart)
+        """
+        rows = await fetch(monitor,
+                           "SELECT pid FROM pg_stat_activity WHERE application_name = %s "
+                           "AND pid <> pg_backend_pid() AND state <> 'idle'",
+                           (self.application_name,))
+        for (pid,) in rows:
+            logging.warning('Cancelling orphan backend {} of [{}]'.format(pid, self.application_name))
+            await fetch(monitor, 'SELECT pg_cancel_backend(%s)', (pid,))
+
+    async def wait_query(self, query, pid, monitor, started_at):
+        """
+        Wait for a submitted statement, logging its backend activity every poll_interval
+        and cancelling it when the timeout is reached
+
+        :return: False if the statement was cancelled by the timeout
+        :rtype: bool
+        """
+        while True:
+            wait = self.poll_interval
+            if self.timeout:
+                wait = min(wait, max(self.timeout - (time.time() - started_at), 0))
+            done, _ = await asyncio.wait([query], timeout=wait)
+            if done:
+                return True
+            if self.timeout and time.time() - started_at >= self.timeout:
+                logging.warning('Query timeout ({}s) reached, cancelling backend {}'.format(self.timeout, pid))
+                await fetch(monitor, 'SELECT pg_cancel_backend(%s)', (pid,))
+                try:
+                    await query
+                except psycopg2.extensions.QueryCanceledError:
+                    pass
+                return False
+            for state, wait_event, running in await fetch(
+                    monitor,
+                    'SELECT state, wait_event, now() - query_start FROM pg_stat_activity WHERE pid = %s',
+                    (pid,)):
+                logging.info('Backend {}: {} for {} (wait event: {})'.format(pid, state, running, wait_event))
+
+    async def run(self):
+        started_at = time.time()
+        conn = monitor = None
+        pid = None
+        try:
+            conn_args = await self.get_conn_args()
+            monitor = await connect(conn_args)
+            await self.cancel_orphans(monitor)
+
+            conn = await connect(conn_args)
+            pid = conn.get_backend_pid()
+            cursor = conn.cursor()
+            # Asynchronous connections are in autocommit: each statement runs in its own transaction
+            statements = [self.sql] if isinstance(self.sql, str) else self.sql
+            rowcount = -1
+            for index, statement in enumerate(statements, 1):
+                cursor.execute(statement, self.parameters)
+                query = asyncio.ensure_future(wait_connection(conn))
+                logging.info('Statement {}/{} submitted on backend {}'.format(index, len(statements), pid))
+                if not await self.wait_query(query, pid, monitor, started_at):
+                    yield TriggerEvent({'status': 'timeout', 'pid': pid, 'duration': time.time() - started_at,
+                                        'message': 'Query cancelled after {}s'.format(self.timeout)})
+                    return
+                query.result()
+                if cursor.rowcount >= 0:
+                    rowcount = max(rowcount, 0) + cursor.rowcount
+
+            yield TriggerEvent({'status': 'success', 'pid': pid, 'duration': time.time() - started_at,
+                                'rowcount': rowcount, 'message': cursor.statusmessage})
+        except asyncio.CancelledError:
+            # Task was cleared, marked or killed: don't leave the query running
+            if pid is not None and monitor is not None and not monitor.closed:
+                logging.warning('Trigger cancelled, cancelling backend {}'.format(pid))
+                await fetch(monitor, 'SELECT pg_cancel_backend(%s)', (pid,))
+            raise
+        except Exception as e:  # pylint: disable=broad-except
+            yield TriggerEvent({'status': 'error', 'pid': pid, 'duration': time.time() - started_at,
+                                'message': str(e)})
+        finally:
+            for connection in (conn, monitor):
+                if connection is not None and not connection.closed:
+                    connection.close()
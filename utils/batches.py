@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to run one statement against many parameter sets in page-sized round trips.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import csv
+import json
+import uuid
+from itertools import islice
+
+BATCH_PAGE_SIZE = 1000
+BATCH_METHODS = ('batch', 'values', 'prepared')
+
+
+def iter_pages(iterable, page_size=BATCH_PAGE_SIZE):
+    """
+    Split an iterable (possibly lazy) in lists of at most `page_size` items
+
+    :rtype: generator
+    """
+    iterator = iter(iterable)
+    while True:
+        page = list(islice(iterator, page_size))
+        if not page:
+            return
+        yield page
+
+
+def read_parameter_sets(file_name):
+    """
+    Lazily read parameter sets from a file: one JSON list or object per line, or CSV rows
+    (`.csv` extension, no header)
+
+    :rtype: generator
+    """
+    with open(file_name) as f:
+        if file_name.endswith('.csv'):
+            for row in csv.reader(f):
+                yield row
+            return
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def multi_statement(statements):
+    """
+    Join statements in a single command string, sent in one round trip.
+    PostgreSQL runs a multi-statement command in a single implicit transaction.
+
+    :rtype: str
+    """
+    return ';\n'.join(statement.strip().rstrip(';') for statement in statements if statement.strip())
+
+
+def prepare_statement(cursor, sql, name=None):
+    """
+    Create a server-side prepared statement for `sql` (using $1, $2... placeholders)
+
+    :return: prepared statement name
+    :rtype: str
+    """
+    name = name or 'batch_{}'.format(uuid.uuid4().hex[:12])
+    cursor.execute('PREPARE {} AS {}'.format(name, sql))
+    return name
+
+
+def deallocate_statement(cursor, name):
+    cursor.execute('DEALLOCATE {}'.format(name))
+
+
+def execute_page(cursor, method, sql, page):
+    """
+    Run a page of parameter sets in a single round trip
+
+    :param method: `batch` (statements joined by psycopg2 execute_batch), `values` (sql has a single
+        `VALUES %s` expanded to all rows by execute_values) or `prepared` (sql is a prepared statement name)
+    :return: affected rows (when known)
+    :rtype: int
+    """
+    import psycopg2.extras
+    if method == 'values':
+        psycopg2.extras.execute_values(cursor, sql, page, page_size=len(page))
+        return cursor.rowcount
+    if method == 'prepared':
+        placeholders = ', '.join(['%s'] * len(page[0]))
+        sql = 'EXECUTE {} ({})'.format(sql, placeholders)
+    psycopg2.extras.execute_batch(cursor, sql, page, page_size=len(page))
+    # execute_batch only reports the rowcount of its last statement
+    return None
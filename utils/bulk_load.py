@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk-load profile: load a table without maintaining its secondary indexes and foreign keys,
+then rebuild them.
+
+Secondary indexes are the indexes of the table that don't enforce anything: unique indexes and
+indexes backing a constraint (primary key, unique, exclusion) are kept, so loaded data is still
+checked against them. Foreign keys of the table are dropped and added back `NOT VALID`, then
+validated, which checks the loaded rows in a single pass without blocking writes.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+BULK_LOAD_MAINTENANCE_WORK_MEM = '1GB'
+BULK_LOAD_INDEX_WORKERS = 4
+
+
+def secondary_indexes(cursor, table):
+    """
+    Non unique indexes of a table that don't back a constraint
+
+    :return: index names and definitions (`CREATE INDEX` statements)
+    :rtype: list of tuple
+    """
+    cursor.execute('SELECT i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid) '
+                   'FROM pg_index i '
+                   'WHERE i.indrelid = %s::regclass AND NOT i.indisunique '
+                   'AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid) '
+                   'ORDER BY 1', (table,))
+    return cursor.fetchall()
+
+
+def foreign_keys(cursor, table):
+    """
+    Foreign keys of a table (referencing other tables)
+
+    :return: quoted constraint names and definitions (`FOREIGN KEY (...) REFERENCES ...`)
+    :rtype: list of tuple
+    """
+    cursor.execute("SELECT quote_ident(conname), pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f' ORDER BY conname", (table,))
+    return cursor.fetchall()
+
+
+def drop_indexes(cursor, indexes):
+    for name, _ in indexes:
+        cursor.execute('DROP INDEX {}'.format(name))
+
+
+def drop_foreign_keys(cursor, table, constraints):
+    for name, _ in constraints:
+        cursor.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(table, name))
+
+
+def add_foreign_key(cursor, table, name, definition):
+    """
+    Add a foreign key without checking existing rows, then validate it. If validation fails,
+    the constraint is still enforced on new rows.
+    """
+    cursor.execute('ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID'.format(table, name, definition))
+    cursor.execute('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(table, name))
+
+
+def tune_session(cursor, maintenance_work_mem=BULK_LOAD_MAINTENANCE_WORK_MEM):
+    """
+    Session settings of bulk-load connections. Commits don't wait for WAL flush: a crash may lose the
+    last commits, but never corrupts data.
+    """
+    cursor.execute('SET synchronous_commit = off')
+    cursor.execute('SET maintenance_work_mem = %s', (maintenance_work_mem,))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoints of chunked transfers, so a task retry resumes from the last completed unit
+(key range partition, export shard or input file) instead of starting over.
+
+A checkpoint holds the plan of a task run (ex: partition boundaries, computed once so every attempt
+splits the work the same way) and the completed units with their results. It is scoped to a task run
+(`<dag_id>.<task_id>.<run_id>`) and cleared when the task succeeds.
+
+- `TableCheckpoint` stores it in a control table of the destination database. Units are recorded with
+  the cursor writing their data, in the same transaction, so a unit is either loaded and recorded or
+  neither: retries never load a unit twice.
+- `S3Checkpoint` stores it in a JSON object next to the exported data, updated when a unit's object
+  has been uploaded. Units are whole objects, so exporting one again overwrites it.
+
+XCom is not used: task instance XComs are cleared at the start of each try.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import json
+import logging
+import threading
+
+logging = logging.getLogger(__name__)
+
+CHECKPOINT_PLAN_UNIT = '_plan'
+
+
+def checkpoint_run_key(operator, context):
+    """
+    Key of a task run, shared by all its tries
+
+    :rtype: str
+    """
+    context = context or {}
+    run = context.get('run_id') or context.get('ts') or ''
+    return '{}.{}.{}'.format(operator.dag_id, operator.task_id, run)
+
+
+def dumps(payload):
+    # Key range boundaries may be dates or decimals: kept as strings, PostgreSQL casts them back
+    return json.dumps(payload, default=str)
+
+
+class TableCheckpoint(object):
+    """
+    Checkpoint stored in a control table of the destination database (created if it doesn't exist)
+
+    :param hook: destination database hook
+    :param table: control table name
+    :type table: str
+    :param run_key: task run key (see `checkpoint_run_key`)
+    :type run_key: str
+    """
+
+    def __init__(self, hook, table, run_key):
+        self.hook = hook
+        self.table = table
+        self.run_key = run_key
+
+    def create(self):
+        self.hook.run('CREATE TABLE IF NOT EXISTS {} ('
+                      'run_key text NOT NULL, '
+                      'unit text NOT NULL, '
+                      'payload text, '
+                      'completed_at timestamptz NOT NULL DEFAULT now(), '
+                      'PRIMARY KEY (run_key, unit))'.format(self.table),
+                      autocommit=True)
+
+    def load(self):
+        """
+        :return: plan (None if not saved yet) and payloads of completed units by unit name
+        :rtype: tuple
+        """
+        self.create()
+        records = self.hook.get_records('SELECT unit, payload FROM {} WHERE run_key = %s'.format(self.table),
+                                        parameters=(self.run_key,))
+        units = dict((unit, json.loads(payload) if payload else None) for unit, payload in records)
+        plan = units.pop(CHECKPOINT_PLAN_UNIT, None)
+        if units:
+            logging.info('Checkpoint [{}] found in [{}]: {} units completed'.format(
+                self.run_key, self.table, len(units)))
+        return plan, units
+
+    def upsert_statement(self):
+        return ('INSERT INTO {} (run_key, unit, payload) VALUES (%s, %s, %s) '
+                'ON CONFLICT (run_key, unit) DO UPDATE SET payload = EXCLUDED.payload, '
+                'completed_at = now()'.format(self.table))
+
+    def save_plan(self, plan):
+        self.hook.run(self.upsert_statement(), autocommit=True,
+                      parameters=(self.run_key, CHECKPOINT_PLAN_UNIT, dumps(plan)))
+
+    def mark_done(self, unit, payload=None, cursor=None):
+        """
+        Record a completed unit. With a cursor, the record is part of its transaction (committed with the
+        unit's data), otherwise it is committed on its own.
+        """
+        parameters = (self.run_key, unit, dumps(payload))
+        if cursor is None:
+            self.hook.run(self.upsert_statement(), autocommit=True, parameters=parameters)
+        else:
+            cursor.execute(self.upsert_statement(), parameters)
+
+    def clear(self):
+        self.hook.run('DELETE FROM {} WHERE run_key = %s'.format(self.table), autocommit=True,
+                      parameters=(self.run_key,))
+
+
+class S3Checkpoint(object):
+    """
+    Checkpoint stored in a S3 JSON object: `{"run_key", "plan", "units": {unit: payload}}`
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: bucket of the checkpoint object
+    :type bucket_name: str
+    :param key: checkpoint object key
+    :type key: str
+    :param run_key: task run key (see `checkpoint_run_key`)
+    :type run_key: str
+    :param encrypt: server side encryption of the checkpoint object
+    :type encrypt: bool
+    """
+
+    def __init__(self, s3_client, bucket_name, key, run_key, encrypt=False):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.run_key = run_key
+        self.encrypt = encrypt
+        self.state = {'run_key': run_key, 'plan': None, 'units': {}}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        :return: plan (None if not saved yet) and payloads of completed units by unit name
+        :rtype: tuple
+        """
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.key)['Body'].read()
+        except self.s3_client.exceptions.NoSuchKey:
+            return None, {}
+        state = json.loads(body.decode('utf-8'))
+        if state.get('run_key') != self.run_key:
+            logging.warning('Ignoring checkpoint [{}] of another run ({})'.format(self.key, state.get('run_key')))
+            return None, {}
+        self.state = state
+        logging.info('Checkpoint [{}] found: {} units completed'.format(self.key, len(state['units'])))
+        return state['plan'], dict(state['units'])
+
+    def save(self):
+        extra_args = {'ServerSideEncryption': 'AES256'} if self.encrypt else {}
+        self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=dumps(self.state).encode('utf-8'),
+                                  **extra_args)
+
+    def save_plan(self, plan):
+        with self._lock:
+            self.state['plan'] = json.loads(dumps(plan))
+            self.save()
+
+    def mark_done(self, unit, payload=None):
+        with self._lock:
+            self.state['units'][unit] = json.loads(dumps(payload))
+            self.save()
+
+    def clear(self):
+        self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.key)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming compression codecs used by exports and dumps.
+
+Every codec is exposed as a write-only file object compressing data into another file object while
+it is produced (ex: by COPY or pg_dump):
+    gzip: single-threaded gzip
+    pgzip: block-parallel gzip, blocks are compressed concurrently as independent gzip members
+        (concatenated members are a valid gzip file)
+    zstd: Zstandard with levels and worker threads (requires zstandard)
+    lz4: LZ4 frame (requires lz4)
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import logging
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logging = logging.getLogger(__name__)
+
+CODECS = ('gzip', 'pgzip', 'zstd', 'lz4')
+FILE_EXTENSIONS = {'gzip': '.gz', 'pgzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+PGZIP_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def _gzip_compressobj(level):
+    return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_block(data, level):
+    compressor = _gzip_compressobj(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressingWriter(object):
+    """
+    Write-only file object compressing data into another file object.
+    Closing it writes the codec trailer but doesn't close the underlying file object.
+
+    :param fileobj: writable binary file object receiving compressed data
+    :param codec: one of CODECS
+    :type codec: str
+    :param level: compression level (codec default if None)
+    :type level: int
+    :param threads: worker threads for `zstd` and `pgzip` (default: number of cores)
+    :type threads: int
+    """
+
+    def __init__(self, fileobj, codec, level=None, threads=None):
+        if codec not in CODECS:
+            raise ValueError('Unsupported compression codec [{}], expected one of {}'.format(codec, CODECS))
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+        self.closed = False
+        self._executor = None
+        self._pending = deque()
+        self._buffer = bytearray()
+
+        if codec == 'gzip':
+            self._compressor = _gzip_compressobj(level)
+        elif codec == 'pgzip':
+            self._compressor = None
+            self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        elif codec == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError('zstandard is required for zstd compression: pip install zstandard')
+            self._compressor = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                                        threads=self.threads).compressobj()
+        else:
+            try:
+                import lz4.frame
+            except ImportError:
+                raise ImportError('lz4 is required for lz4 compression: pip install lz4')
+            self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level or 0)
+            self._write(self._compressor.begin())
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        started_at = time.time()
+        self.bytes_in += len(data)
+        if self.codec == 'pgzip':
+            self._buffer.extend(data)
+            while len(self._buffer) >= PGZIP_BLOCK_SIZE:
+                self._submit(bytes(self._buffer[:PGZIP_BLOCK_SIZE]))
+                del self._buffer[:PGZIP_BLOCK_SIZE]
+        else:
+            self._write(self._compressor.compress(bytes(data)))
+        self.elapsed += time.time() - started_at
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_in
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        started_at = time.time()
+        try:
+            if self.codec == 'pgzip':
+                if self._buffer or not self.bytes_in:
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._write(self._pending.popleft().result())
+            else:
+                self._write(self._compressor.flush())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+        self.elapsed += time.time() - started_at
+        self.log_stats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    @property
+    def ratio(self):
+        return float(self.bytes_in) / self.bytes_out if self.bytes_out else 0.0
+
+    def log_stats(self):
+        logging.info('{} compression: {}Mb -> {}Mb (ratio {:.2f}) at {:.1f}Mb/s'.format(
+            self.codec, self.bytes_in >> 20, self.bytes_out >> 20, self.ratio,
+            self.bytes_in / 1048576.0 / self.elapsed if self.elapsed else 0))
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_gzip_block, block, self.level))
+        # Bound memory: write out oldest blocks once enough are in flight
+        while len(self._pending) > self.threads * 2:
+            self._write(self._pending.popleft().result())
+
+    def _write(self, data):
+        if data:
+            self.fileobj.write(data)
+            self.bytes_out += len(data)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming envelope encryption.
+
+A data key is generated by AWS KMS for each artifact and the plaintext is encrypted locally with
+AES-256-GCM in fixed size frames, so data never has to be sent to KMS and can be encrypted as it
+is produced. The KMS-wrapped data key is stored in the artifact header.
+
+Format:
+    header: MAGIC | frame size (uint32) | wrapped key length (uint16) | wrapped key | nonce prefix (4 bytes)
+    frames: final flag (uint8) | ciphertext length (uint32) | ciphertext + GCM tag
+
+Each frame nonce is the nonce prefix followed by the frame index (uint64), and the frame index and
+final flag are authenticated as additional data, so frames can't be reordered, dropped or truncated.
+
+The `cryptography` package is an optional dependency, only needed when encryption is used.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import os
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b'PGENC1'
+ENCRYPTION_FRAME_SIZE = 4 * 1024 * 1024
+KEY_SPEC = 'AES_256'
+
+_HEADER_FORMAT = '>IH'
+_FRAME_HEADER_FORMAT = '>BI'
+_FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER_FORMAT)
+
+
+def import_aesgcm():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise ImportError('cryptography is required to encrypt files: pip install cryptography')
+    return AESGCM
+
+
+def encryption_metadata(kms_key_id):
+    """
+    S3 object metadata describing an envelope encrypted object (the wrapped key is in its header)
+
+    :rtype: dict
+    """
+    return {'encryption': 'aes-256-gcm-envelope', 'kms-key-id': kms_key_id}
+
+
+def frame_nonce(nonce_prefix, index):
+    return nonce_prefix + struct.pack('>Q', index)
+
+
+def frame_aad(index, final):
+    return struct.pack('>QB', index, 1 if final else 0)
+
+
+class EnvelopeEncryptor(object):
+    """
+    AES-GCM frame encryptor using a KMS generated data key (frames are cut and written by EncryptingWriter)
+
+    :param kms_client: boto3 KMS client
+    :param kms_key_id: KMS key id or ARN used to wrap the data key
+    :type kms_key_id: str
+    :param frame_size: plaintext bytes per authenticated frame
+    :type frame_size: int
+    """
+
+    def __init__(self, kms_client, kms_key_id, frame_size=ENCRYPTION_FRAME_SIZE):
+        aesgcm = import_aesgcm()
+        data_key = kms_client.generate_data_key(KeyId=kms_key_id, KeySpec=KEY_SPEC)
+        self.wrapped_key = data_key['CiphertextBlob']
+        self.frame_size = frame_size
+        self.nonce_prefix = os.urandom(4)
+        self._cipher = aesgcm(data_key['Plaintext'])
+
+    def header(self):
+        return MAGIC + struct.pack(_HEADER_FORMAT, self.frame_size, len(self.wrapped_key)) \
+            + self.wrapped_key + self.nonce_prefix
+
+    def encrypt_frame(self, index, data, final=False):
+        ciphertext = self._cipher.encrypt(frame_nonce(self.nonce_prefix, index), bytes(data), frame_aad(index, final))
+        return struct.pack(_FRAME_HEADER_FORMAT, 1 if final else 0, len(ciphertext)) + ciphertext
+
+
+class EncryptingWriter(object):
+    """
+    Write-only file object encrypting data with an EnvelopeEncryptor into another file object.
+    Frames are encrypted concurrently by a thread pool (AES-GCM releases the GIL) and written in order.
+
+    Closing this writer writes the final frame but doesn't close the underlying file object.
+
+    :param fileobj: writable binary file object receiving ciphertext
+    :param encryptor: encryptor holding the data key
+    :type encryptor: EnvelopeEncryptor
+    :param workers: number of frames encrypted concurrently
+    :type workers: int
+    """
+
+    def __init__(self, fileobj, encryptor, workers=None):
+        self.fileobj = fileobj
+        self.encryptor = encryptor
+        self.workers = workers or os.cpu_count() or 1
+        self.bytes_written = 0
+        # Seconds spent encrypting frames, summed over worker threads
+        self.elapsed = 0.0
+        self.closed = False
+        self._position = 0
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._index = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self._write(encryptor.header())
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer.extend(data)
+        self._position += len(data)
+        frame_size = self.encryptor.frame_size
+        # Keep at least one byte buffered so the final frame is only empty for empty input
+        while len(self._buffer) > frame_size:
+            frame = bytes(self._buffer[:frame_size])
+            del self._buffer[:frame_size]
+            self._submit(frame)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        # Plaintext position, as seen by the caller
+        return self._position
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self._buffer), final=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._write(self._pending.popleft().result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            # Stream is abandoned: drop frames not encrypted yet and stop worker threads
+            self.closed = True
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+
+    def _submit(self, frame, final=False):
+        index = self._index
+        self._index += 1
+        if self._executor is None:
+            self._write(self._encrypt_frame(index, frame, final))
+            return
+        self._pending.append(self._executor.submit(self._encrypt_frame, index, frame, final))
+        # Bound memory: write out oldest frames once enough are in flight
+        while len(self._pending) > self.workers * 2:
+            self._write(self._pending.popleft().result())
+
+    def _encrypt_frame(self, index, frame, final):
+        started_at = time.time()
+        data = self.encryptor.encrypt_frame(index, frame, final)
+        with self._lock:
+            self.elapsed += time.time() - started_at
+        return data
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+
+class DecryptingReader(object):
+    """
+    Read-only file object decrypting a stream written by EncryptingWriter.
+    The data key is unwrapped with KMS when the header is read. Raises an error if a frame fails
+    authentication or if the stream ends before the final frame.
+
+    :param raw: object with a `read(size)` method returning ciphertext
+    :param kms_client: boto3 KMS client
+    """
+
+    def __init__(self, raw, kms_client):
+        self.raw = raw
+        self.kms_client = kms_client
+        self.bytes_read = 0
+        self._cipher = None
+        self._nonce_prefix = None
+        self._index = 0
+        self._final = False
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self._final and (size is None or size < 0 or len(self._buffer) < size):
+            self._read_frame()
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_exactly(self, size):
+        chunks = []
+        remaining = size
+        while remaining:
+            chunk = self.raw.read(remaining)
+            if not chunk:
+                raise ValueError('Truncated encrypted stream')
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        self.bytes_read += size
+        return b''.join(chunks)
+
+    def _read_header(self):
+        aesgcm = import_aesgcm()
+        if self._read_exactly(len(MAGIC)) != MAGIC:
+            raise ValueError('Not an envelope encrypted stream')
+        _, wrapped_key_size = struct.unpack(_HEADER_FORMAT, self._read_exactly(struct.calcsize(_HEADER_FORMAT)))
+        wrapped_key = self._read_exactly(wrapped_key_size)
+        self._nonce_prefix = self._read_exactly(4)
+        self._cipher = aesgcm(self.kms_client.decrypt(CiphertextBlob=wrapped_key)['Plaintext'])
+
+    def _read_frame(self):
+        if self._cipher is None:
+            self._read_header()
+        final, size = struct.unpack(_FRAME_HEADER_FORMAT, self._read_exactly(_FRAME_HEADER_SIZE))
+        ciphertext = self._read_exactly(size)
+        self._buffer += self._cipher.decrypt(frame_nonce(self._nonce_prefix, self._index), ciphertext,
+                                             frame_aad(self._index, final))
+        self._index += 1
+        self._final = bool(final)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Staged bulk upsert: load data into a staging table, then apply it to the target table with a
+single set-based `INSERT ... ON CONFLICT DO UPDATE`.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import uuid
+
+STAGING_TEMPORARY = 'temporary'
+STAGING_UNLOGGED = 'unlogged'
+STAGING_TABLE_TYPES = (STAGING_TEMPORARY, STAGING_UNLOGGED)
+
+
+def table_columns(cursor, table):
+    """
+    Quoted names of the columns of a table that can be inserted into, in table order
+    (generated and `GENERATED ALWAYS` identity columns are left out)
+
+    :rtype: list
+    """
+    cursor.execute("SELECT quote_ident(attname) FROM pg_attribute "
+                   "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped "
+                   "AND attgenerated = '' AND attidentity <> 'a' "
+                   "ORDER BY attnum", (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_staging_table(cursor, target_table, staging_table_type=STAGING_TEMPORARY):
+    """
+    Create an empty staging table with the same columns as target table
+
+    :param cursor: destination cursor. Temporary staging tables only exist in its session.
+    :param target_table: table the staging data will be merged into
+    :type target_table: str
+    :param staging_table_type: `temporary` or `unlogged` (created in target table schema)
+    :type staging_table_type: str
+    :return: staging table name
+    :rtype: str
+    """
+    name = 'staging_{}'.format(uuid.uuid4().hex[:12])
+    if staging_table_type == STAGING_UNLOGGED:
+        schema, _, _ = target_table.rpartition('.')
+        staging_table = '{}.{}'.format(schema, name) if schema else name
+        cursor.execute('CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(staging_table, target_table))
+    else:
+        staging_table = name
+        cursor.execute('CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(staging_table, target_table))
+    return staging_table
+
+
+def drop_staging_table(cursor, staging_table):
+    cursor.execute('DROP TABLE IF EXISTS {}'.format(staging_table))
+
+
+def merge_statement(target_table, staging_table, columns, key_columns, dedup=False):
+    """
+    Build the `INSERT ... SELECT ... ON CONFLICT` statement applying staging rows to target table.
+    Target table must have a unique index on key columns.
+
+    :param columns: columns to load (staging and target)
+    :type columns: list
+    :param key_columns: conflict columns
+    :type key_columns: list
+    :param dedup: keep only the last loaded row of each key from staging table
+    :type dedup: bool
+    :rtype: str
+    """
+    column_list = ', '.join(columns)
+    key_list = ', '.join(key_columns)
+    if dedup:
+        select = 'SELECT DISTINCT ON ({keys}) {cols} FROM {staging} ORDER BY {keys}, ctid DESC'.format(
+            keys=key_list, cols=column_list, staging=staging_table)
+    else:
+        select = 'SELECT {} FROM {}'.format(column_list, staging_table)
+
+    # Key columns may be given quoted or not
+    keys = set(key.strip('"') for key in key_columns)
+    update_columns = [column for column in columns if column.strip('"') not in keys]
+    if update_columns:
+        action = 'DO UPDATE SET {}'.format(
+            ', '.join('{col} = EXCLUDED.{col}'.format(col=column) for column in update_columns))
+    else:
+        action = 'DO NOTHING'
+
+    return 'INSERT INTO {target} ({cols}) {select} ON CONFLICT ({keys}) {action}'.format(
+        target=target_table, cols=column_list, select=select, keys=key_list, action=action)
+
+
+def merge_staging_table(cursor, target_table, staging_table, key_columns, columns=None, dedup=False):
+    """
+    Apply staging rows to target table in one statement
+
+    :return: number of inserted or updated rows
+    :rtype: int
+    """
+    if not columns:
+        columns = table_columns(cursor, target_table)
+    cursor.execute(merge_statement(target_table, staging_table, columns, key_columns, dedup=dedup))
+    return cursor.rowcount
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Per-task phase timers and counters.
+
+Operators time each phase of a task (secret fetch, connect, COPY, compression, hashing, encryption,
+upload...) and count rows and bytes. At the end of the task (successful or not) metrics are sent to
+StatsD through Airflow `Stats` and a summary is pushed to XCom under the `metrics` key:
+
+    {
+      "operator": "PostgresToS3Operator",
+      "task_id": "export",
+      "status": "success",
+      "wall_time": 12.3,
+      "phases": {"copy": {"seconds": 10.1, "count": 1}, "upload": {"seconds": 3.2, "count": 5}},
+      "counters": {"rows": 1000000, "bytes_exported": 104857600},
+      "throughput": {"rows_per_sec": 81300.8, "bytes_exported_mb_per_sec": 8.1}
+    }
+
+Phases run by concurrent threads (shards, partitions, S3 parts, encryption frames) are summed,
+so a phase can take longer than the task wall time. In streaming pipelines, the producing phase
+(ex: `copy` or `dump`) includes the time of the writers it feeds, which is also reported on its own
+(`compress`, `md5`, `encrypt`, `upload`).
+
+StatsD names are `postgres_plugin.<operator>.<phase>` (timers, milliseconds) and
+`postgres_plugin.<operator>.<counter>` (counters).
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from airflow.stats import Stats
+except ImportError:  # Airflow 1.10
+    from airflow.settings import Stats
+
+logging = logging.getLogger(__name__)
+
+METRICS_PREFIX = 'postgres_plugin'
+METRICS_XCOM_KEY = 'metrics'
+MB = 1024.0 * 1024.0
+
+
+class TaskMetrics(object):
+    """
+    Thread-safe phase timers and counters of a task
+
+    :param operator: operator name, used in StatsD metric names
+    :type operator: str
+    :param task_id: task id reported in summary
+    :type task_id: str
+    """
+
+    def __init__(self, operator, task_id=None):
+        self.operator = operator
+        self.task_id = task_id
+        self.started_at = time.time()
+        self.phases = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a block of code as phase `name`. Time is added to previous runs of the same phase.
+        """
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started_at)
+
+    def add_time(self, name, seconds, count=1):
+        """
+        Add time measured elsewhere (ex: by a compressing writer) to phase `name`
+        """
+        with self._lock:
+            phase = self.phases.setdefault(name, {'seconds': 0.0, 'count': 0})
+            phase['seconds'] += seconds
+            phase['count'] += count
+
+    def incr(self, name, value=1):
+        """
+        Increment counter `name` (ex: rows, bytes_uploaded)
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, status=None):
+        """
+        :return: task summary with phases, counters and throughput over task wall time
+        :rtype: dict
+        """
+        wall_time = time.time() - self.started_at
+        with self._lock:
+            phases = dict((name, dict(phase)) for name, phase in self.phases.items())
+            counters = dict(self.counters)
+
+        throughput = {}
+        for name, value in counters.items():
+            if not wall_time:
+                continue
+            if name == 'rows':
+                throughput['rows_per_sec'] = round(value / wall_time, 1)
+            elif name.startswith('bytes_'):
+                throughput['{}_mb_per_sec'.format(name)] = round(value / MB / wall_time, 1)
+
+        return {
+            'operator': self.operator,
+            'task_id': self.task_id,
+            'status': status,
+            'wall_time': round(wall_time, 3),
+            'phases': dict((name, {'seconds': round(phase['seconds'], 3), 'count': phase['count']})
+                           for name, phase in phases.items()),
+            'counters': counters,
+            'throughput': throughput,
+        }
+
+    def emit(self, summary):
+        """
+        Send summary to StatsD
+        """
+        prefix = '{}.{}'.format(METRICS_PREFIX, self.operator)
+        Stats.timing('{}.wall_time'.format(prefix), summary['wall_time'] * 1000)
+        for name, phase in summary['phases'].items():
+            Stats.timing('{}.{}'.format(prefix, name), phase['seconds'] * 1000)
+        for name, value in summary['counters'].items():
+            Stats.incr('{}.{}'.format(prefix, name), value)
+        if summary['status']:
+            Stats.incr('{}.{}'.format(prefix, summary['status']))
+
+    def publish(self, context, status=None):
+        """
+        Log summary, send it to StatsD and push it to XCom (when a task instance is in context)
+
+        :return: summary
+        :rtype: dict
+        """
+        summary = self.summary(status)
+        logging.info('Task metrics: {}'.format(', '.join(
+            ['wall_time {:.2f}s'.format(summary['wall_time'])]
+            + ['{} {:.2f}s'.format(name, phase['seconds']) for name, phase in sorted(summary['phases'].items())]
+            + ['{} {}'.format(name, value) for name, value in sorted(summary['counters'].items())])))
+        try:
+            self.emit(summary)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Unable to send metrics to StatsD: {}'.format(str(e)))
+
+        task_instance = (context or {}).get('ti')
+        if task_instance is not None:
+            try:
+                task_instance.xcom_push(key=METRICS_XCOM_KEY, value=summary)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning('Unable to push metrics to XCom: {}'.format(str(e)))
+        return summary
+
+
+@contextmanager
+def task_metrics(operator, context):
+    """
+    Create metrics for an operator run, publishing them when the block exits (with `success` or `failed` status)
+
+        with task_metrics(self, context) as metrics:
+            with metrics.phase('copy'):
+                ...
+
+    :param operator: running operator
+    :param context: task context
+    :rtype: TaskMetrics
+    """
+    metrics = TaskMetrics(operator.__class__.__name__, operator.task_id)
+    operator.metrics = metrics
+    try:
+        yield metrics
+    except Exception:
+        metrics.publish(context, status='failed')
+        raise
+    metrics.publish(context, status='success')
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Write a PostgreSQL cursor to Parquet, one row group at a time.
+
+pyarrow is an optional dependency, only needed when Parquet output is used.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import json
+
+PARQUET_ROW_GROUP_SIZE = 100000
+PARQUET_COMPRESSION = 'snappy'
+
+# PostgreSQL type OIDs
+PG_BOOL = 16
+PG_BYTEA = 17
+PG_INT8 = 20
+PG_INT2 = 21
+PG_INT4 = 23
+PG_OID = 26
+PG_JSON = 114
+PG_FLOAT4 = 700
+PG_FLOAT8 = 701
+PG_NUMERIC = 1700
+PG_DATE = 1082
+PG_TIME = 1083
+PG_TIMESTAMP = 1114
+PG_TIMESTAMPTZ = 1184
+PG_JSONB = 3802
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('pyarrow is required to write Parquet files: pip install pyarrow')
+    return pyarrow, pyarrow.parquet
+
+
+def _to_string(value):
+    if value is None or isinstance(value, type(u'')):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def _to_bytes(value):
+    return None if value is None else bytes(value)
+
+
+def _identity(value):
+    return value
+
+
+def arrow_field(pa, column):
+    """
+    Map a cursor.description column to an Arrow field and a value converter
+
+    :param pa: pyarrow module
+    :param column: cursor.description item
+    :return: (field, converter)
+    """
+    type_code = column[1]
+    simple_types = {
+        PG_BOOL: pa.bool_(),
+        PG_INT2: pa.int16(),
+        PG_INT4: pa.int32(),
+        PG_INT8: pa.int64(),
+        PG_OID: pa.int64(),
+        PG_FLOAT4: pa.float32(),
+        PG_FLOAT8: pa.float64(),
+        PG_DATE: pa.date32(),
+        PG_TIME: pa.time64('us'),
+        PG_TIMESTAMP: pa.timestamp('us'),
+        PG_TIMESTAMPTZ: pa.timestamp('us', tz='UTC'),
+    }
+    if type_code in simple_types:
+        return pa.field(column[0], simple_types[type_code]), _identity
+    if type_code == PG_BYTEA:
+        return pa.field(column[0], pa.binary()), _to_bytes
+    if type_code == PG_NUMERIC and column[4] and column[4] <= 38:
+        # numeric(precision, scale): exact decimal. Unconstrained numeric is kept as string.
+        return pa.field(column[0], pa.decimal128(column[4], column[5] or 0)), _identity
+    return pa.field(column[0], pa.string()), _to_string
+
+
+def write_parquet(cursor, fileobj,
+                  row_group_size=PARQUET_ROW_GROUP_SIZE,
+                  compression=PARQUET_COMPRESSION):
+    """
+    Fetch all rows of an executed cursor and write them to a Parquet file object.
+    Only one row group is held in memory at a time, so cursor should be a server-side (named) cursor.
+
+    :param cursor: executed cursor
+    :param fileobj: writable binary file object
+    :param row_group_size: rows per Parquet row group
+    :type row_group_size: int
+    :param compression: Parquet compression codec (snappy, gzip, zstd, lz4, brotli or none)
+    :type compression: str
+    :return: number of rows written
+    :rtype: int
+    """
+    pa, pq = import_pyarrow()
+
+    rows = cursor.fetchmany(row_group_size)
+    fields, converters = zip(*[arrow_field(pa, column) for column in cursor.description])
+    schema = pa.schema(list(fields))
+
+    total_rows = 0
+    writer = pq.ParquetWriter(fileobj, schema, compression=compression)
+    try:
+        while rows:
+            columns = zip(*rows)
+            arrays = [pa.array([converter(value) for value in values], type=field.type)
+                      for values, field, converter in zip(columns, fields, converters)]
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=row_group_size)
+            total_rows += len(rows)
+            rows = cursor.fetchmany(row_group_size)
+    finally:
+        writer.close()
+    return total_rows
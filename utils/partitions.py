@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to split a query in ranges read concurrently by several connections sharing
+the same exported snapshot.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+
+
+def render_query(cursor, sql, parameters=None):
+    """
+    Render query parameters client side, for statements that don't accept bind parameters (ex: COPY)
+
+    :param cursor: cursor used to quote parameters
+    :param sql: query
+    :type sql: str
+    :param parameters: query parameters
+    :return: query without trailing semicolon
+    :rtype: str
+    """
+    query = cursor.mogrify(sql, parameters)
+    if isinstance(query, bytes):
+        import psycopg2.extensions
+        query = query.decode(psycopg2.extensions.encodings[cursor.connection.encoding])
+    return query.strip().rstrip(';')
+
+
+def export_snapshot(conn):
+    """
+    Start a read only repeatable read transaction and export its snapshot.
+    Transaction must be kept open while other connections import the snapshot.
+
+    :return: snapshot identifier
+    :rtype: str
+    """
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT pg_export_snapshot()')
+        return cursor.fetchone()[0]
+
+
+def import_snapshot(conn, snapshot):
+    """
+    Start a read only repeatable read transaction using a snapshot exported by another connection
+    """
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    with conn.cursor() as cursor:
+        cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+
+
+def key_range_boundaries(cursor, query, column, parallelism, method='minmax'):
+    """
+    Compute boundaries splitting a query result in `parallelism` ranges of a column
+
+    :param cursor: source cursor
+    :param query: rendered query (see `render_query`)
+    :type query: str
+    :param column: column of query used to split it
+    :type column: str
+    :param parallelism: number of ranges
+    :type parallelism: int
+    :param method: `minmax` (equal width ranges between min and max values, for numeric and
+        date/time columns) or `quantile` (ranges with about the same number of rows, any sortable column)
+    :type method: str
+    :return: sorted list of at most `parallelism + 1` distinct boundaries, empty if query has no rows
+    :rtype: list
+    """
+    query = query.replace('%', '%%')
+    if method == 'quantile':
+        fractions = [float(i) / parallelism for i in range(parallelism + 1)]
+        cursor.execute(
+            'SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY {col}) '
+            'FROM ({query}) AS boundaries_query'.format(col=column, query=query),
+            (fractions,))
+        boundaries = cursor.fetchone()[0] or []
+    else:
+        cursor.execute('SELECT min({col}), max({col}) FROM ({query}) AS boundaries_query'.format(
+            col=column, query=query))
+        lower, upper = cursor.fetchone()
+        if lower is None:
+            return []
+        if isinstance(lower, int) and isinstance(upper, int):
+            # Integer math: float steps lose precision past 2^53 and would leave keys out of every range
+            boundaries = [lower + (upper - lower) * i // parallelism for i in range(parallelism)] + [upper]
+        else:
+            step = (upper - lower) / parallelism
+            boundaries = [lower] + [lower + step * i for i in range(1, parallelism)] + [upper]
+
+    # Remove duplicated boundaries (ex: few distinct values), keeping order
+    unique_boundaries = []
+    for boundary in boundaries:
+        if not unique_boundaries or boundary != unique_boundaries[-1]:
+            unique_boundaries.append(boundary)
+    if len(unique_boundaries) == 1:
+        unique_boundaries.append(unique_boundaries[0])
+    return unique_boundaries
+
+
+def key_ranges(boundaries):
+    """
+    Build ranges from sorted boundaries. Last range includes its upper boundary.
+
+    :rtype: list of dict with `index`, `lower`, `upper` and `last` keys
+    """
+    return [dict(index=i, lower=lower, upper=upper, last=i == len(boundaries) - 2)
+            for i, (lower, upper) in enumerate(zip(boundaries[:-1], boundaries[1:]))]
+
+
+def key_range_query(cursor, query, column, key_range):
+    """
+    Restrict a rendered query to a key range. First range also gets rows with NULL keys.
+
+    :rtype: str
+    """
+    where = '{col} >= %(lower)s AND {col} {op} %(upper)s'.format(
+        col=column, op='<=' if key_range['last'] else '<')
+    if key_range['index'] == 0:
+        where = '({}) OR {} IS NULL'.format(where, column)
+    return render_query(
+        cursor,
+        'SELECT * FROM ({}) AS partition_query WHERE {}'.format(query.replace('%', '%%'), where),
+        {'lower': key_range['lower'], 'upper': key_range['upper']})
+
+
+def ctid_ranges(cursor, table, parallelism):
+    """
+    Split a table in `parallelism` ranges of heap pages. Last range has no upper page,
+    so rows added to new pages are not missed.
+
+    :rtype: list of dict with `index`, `lower`, `upper` and `last` keys (pages)
+    """
+    cursor.execute("SELECT pg_relation_size(%s::regclass) / current_setting('block_size')::int", (table,))
+    pages = cursor.fetchone()[0]
+    step = max(-(-pages // parallelism), 1)
+    boundaries = sorted(set([min(i * step, pages) for i in range(parallelism)] + [pages]))
+    if len(boundaries) < 2:
+        boundaries = [0, 1]
+    return key_ranges(boundaries)
+
+
+def ctid_filter(page_range):
+    """
+    WHERE condition selecting the rows stored in a range of heap pages
+
+    :rtype: str
+    """
+    condition = "ctid >= '({},0)'::tid".format(int(page_range['lower']))
+    if not page_range['last']:
+        condition += " AND ctid < '({},0)'::tid".format(int(page_range['upper']))
+    return condition
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in query profiling: plans of statements slower than a threshold, and `pg_stat_statements`
+deltas of a task.
+
+Plans are captured in one of three ways:
+
+- `auto_explain`: the module is loaded in the session with `log_analyze`, `log_buffers` and JSON
+  output, and plans of statements slower than the threshold are sent back to the client as notices
+  (`auto_explain.log_level = notice`, PostgreSQL 12+). This is the plan of the actual execution, at
+  the cost of instrumenting every statement of the session. The settings are reserved to superusers
+  (`rds_superuser` on RDS): when they can't be set, the profiler falls back to `explain`.
+- `explain`: a follow-up `EXPLAIN` of the slow statement (plan only, nothing is run again).
+- `explain_analyze`: same, but read only queries (SELECT, VALUES, TABLE) are run again with ANALYZE
+  and BUFFERS, so the task pays for them twice. The run is rolled back, but side effects that a
+  rollback doesn't undo (ex: `setval`, `nextval`, dblink calls) happen twice: only use it for
+  queries without them.
+
+Follow-up EXPLAINs run in a savepoint (or a transaction of their own in autocommit) that is always
+rolled back, so they leave nothing behind and a failure doesn't abort the transaction of the connection.
+
+`pg_stat_statements` counters of the task's user and database are read when the task starts and
+when it ends (sessions of the same user running meanwhile are included). The report is logged and
+pushed to XCom under the `profile` key:
+
+    {
+      "threshold": 30,
+      "method": "explain",
+      "slow_statements": [
+        {"query": "SELECT ...", "duration": 42.1, "method": "explain", "plan": {...},
+         "shared_blks_hit": 1200, "shared_blks_read": 98000}
+      ],
+      "statement_stats": {
+        "totals": {"calls": 3, "total_time": 45.2, "rows": 1000, "shared_blks_hit": 1500,
+                   "shared_blks_read": 98000, "hit_ratio": 0.015},
+        "statements": [{"queryid": 123, "query": "SELECT ...", "calls": 1, "total_time": 42.0, ...}]
+      }
+    }
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+logging = logging.getLogger(__name__)
+
+PROFILE_XCOM_KEY = 'profile'
+PROFILE_METHODS = ('explain', 'explain_analyze', 'auto_explain')
+PROFILE_TOP_STATEMENTS = 10
+PROFILE_QUERY_MAX_LENGTH = 1000
+STATEMENT_COUNTERS = ('calls', 'total_time', 'rows', 'shared_blks_hit', 'shared_blks_read')
+READ_ONLY_COMMANDS = ('SELECT', 'VALUES', 'TABLE')
+AUTO_EXPLAIN_NOTICE = re.compile(r'duration: ([0-9.]+) ms\s+plan:\s*(\{.*\})', re.DOTALL)
+
+
+def truncate(query):
+    query = ' '.join(query.split())
+    if len(query) > PROFILE_QUERY_MAX_LENGTH:
+        return query[:PROFILE_QUERY_MAX_LENGTH] + '...'
+    return query
+
+
+def plan_buffers(plan):
+    """
+    Shared buffer hits and reads of a JSON plan (EXPLAIN output or auto_explain notice), when
+    it was captured with BUFFERS
+
+    :rtype: dict
+    """
+    if isinstance(plan, list):
+        plan = plan[0] if plan else None
+    top = (plan or {}).get('Plan') or {}
+    if 'Shared Hit Blocks' not in top:
+        return {}
+    return {'shared_blks_hit': top['Shared Hit Blocks'], 'shared_blks_read': top.get('Shared Read Blocks', 0)}
+
+
+class PlanNotices(object):
+    """
+    Notices receiver of a connection (replaces psycopg2 `connection.notices`), keeping the plans
+    sent by auto_explain. Other notices are dropped.
+    """
+
+    def __init__(self):
+        self.plans = []
+
+    def append(self, notice):
+        match = AUTO_EXPLAIN_NOTICE.search(notice)
+        if match is None:
+            return
+        try:
+            plan = json.loads(match.group(2))
+        except ValueError:
+            return
+        self.plans.append({'duration': float(match.group(1)) / 1000, 'plan': plan})
+
+
+def statement_stats(cursor):
+    """
+    `pg_stat_statements` counters of the current user and database
+
+    :return: counters by (queryid, query), None when the extension is not installed
+    :rtype: dict
+    """
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements'")
+    if cursor.fetchone() is None:
+        return None
+    # Column renamed in PostgreSQL 13
+    cursor.execute('SELECT * FROM pg_stat_statements LIMIT 0')
+    columns = [column[0] for column in cursor.description]
+    total_time = 'total_exec_time' if 'total_exec_time' in columns else 'total_time'
+    cursor.execute("SELECT queryid, query, calls, {} / 1000, rows, shared_blks_hit, shared_blks_read "
+                   "FROM pg_stat_statements "
+                   "WHERE userid = (SELECT oid FROM pg_roles WHERE rolname = current_user) "
+                   "AND dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) "
+                   "AND query NOT LIKE '%pg_stat_statements%'".format(total_time))
+    stats = {}
+    for record in cursor.fetchall():
+        # Same statement may have several entries (ex: top level and nested)
+        counters = stats.setdefault((record[0], record[1]), dict((name, 0) for name in STATEMENT_COUNTERS))
+        for name, value in zip(STATEMENT_COUNTERS, record[2:]):
+            counters[name] += value or 0
+    return stats
+
+
+def statement_stats_delta(before, after, top=PROFILE_TOP_STATEMENTS):
+    """
+    Counters of statements run between two `statement_stats` snapshots
+
+    :return: totals and the `top` statements by total time
+    :rtype: dict
+    """
+    statements = []
+    for (queryid, query), counters in after.items():
+        previous = before.get((queryid, query), {})
+        delta = dict((name, counters[name] - previous.get(name, 0)) for name in STATEMENT_COUNTERS)
+        if delta['calls'] <= 0:
+            continue
+        delta['total_time'] = round(delta['total_time'], 3)
+        delta.update(queryid=queryid, query=truncate(query))
+        statements.append(delta)
+    statements.sort(key=lambda statement: statement['total_time'], reverse=True)
+
+    totals = dict((name, sum(statement[name] for statement in statements)) for name in STATEMENT_COUNTERS)
+    totals['total_time'] = round(totals['total_time'], 3)
+    blocks = totals['shared_blks_hit'] + totals['shared_blks_read']
+    totals['hit_ratio'] = round(float(totals['shared_blks_hit']) / blocks, 3) if blocks else None
+    return {'totals': totals, 'statements': statements[:top]}
+
+
+class QueryProfiler(object):
+    """
+    Thread-safe collector of slow statement plans and `pg_stat_statements` deltas of a task
+
+    :param threshold: seconds above which a statement is profiled
+    :type threshold: float
+    :param method: `explain`, `explain_analyze` or `auto_explain`
+    :type method: str
+    :param metrics: task metrics, counting slow statements
+    :type metrics: TaskMetrics
+    """
+
+    def __init__(self, threshold, method='explain', metrics=None):
+        self.threshold = threshold
+        self.method = method
+        self.metrics = metrics
+        self.slow_statements = []
+        self.statement_stats = None
+        self.hook = None
+        self._stats_before = None
+        self._lock = threading.Lock()
+
+    def prepare(self, conn):
+        """
+        Enable auto_explain on a new connection (before its first transaction) with `auto_explain` method
+
+        :return: whether auto_explain is enabled
+        :rtype: bool
+        """
+        if self.method != 'auto_explain':
+            return False
+        autocommit = conn.autocommit
+        try:
+            # Settings made in a transaction would be lost on rollback
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("LOAD 'auto_explain'")
+                cursor.execute('SET auto_explain.log_min_duration = %s', (int(self.threshold * 1000),))
+                cursor.execute('SET auto_explain.log_analyze = on')
+                cursor.execute('SET auto_explain.log_buffers = on')
+                cursor.execute("SET auto_explain.log_format = 'json'")
+                cursor.execute("SET auto_explain.log_level = 'notice'")
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Unable to enable auto_explain, slow statements will be explained again: {}'.format(
+                str(e).strip()))
+            return False
+        finally:
+            conn.autocommit = autocommit
+        conn.notices = PlanNotices()
+        return True
+
+    @staticmethod
+    def plan_count(cursor):
+        notices = cursor.connection.notices
+        return len(notices.plans) if isinstance(notices, PlanNotices) else 0
+
+    @contextmanager
+    def statement(self, cursor, query, parameters=None, explain=True):
+        """
+        Time the statement run in the block and profile it if it is slower than threshold
+
+            with profiler.statement(cursor, query):
+                cursor.execute(query)
+        """
+        plans_before = self.plan_count(cursor)
+        started_at = time.time()
+        yield
+        self.check(cursor, query, time.time() - started_at, plans_before, parameters, explain)
+
+    def check(self, cursor, query, duration, plans_before=0, parameters=None, explain=True):
+        """
+        Profile a statement that ran in `duration` seconds if it is slower than threshold: plan from
+        auto_explain notices received since `plans_before`, or from a follow-up EXPLAIN
+
+        :param explain: follow-up EXPLAIN allowed (single statement, connection still usable)
+        :type explain: bool
+        """
+        if duration < self.threshold:
+            return
+        entry = {'query': truncate(query), 'duration': round(duration, 3)}
+        plans = cursor.connection.notices.plans[plans_before:] if self.plan_count(cursor) > plans_before else []
+        if plans:
+            entry.update(method='auto_explain', plan=max(plans, key=lambda plan: plan['duration'])['plan'])
+        elif explain:
+            entry.update(self.explain(cursor, query, parameters))
+        else:
+            entry['method'] = None
+        entry.update(plan_buffers(entry.get('plan')))
+        logging.warning('Slow statement ({:.1f}s, threshold {}s): {}'.format(duration, self.threshold, entry['query']))
+        with self._lock:
+            self.slow_statements.append(entry)
+        if self.metrics is not None:
+            self.metrics.incr('slow_statements')
+
+    def explain(self, cursor, query, parameters=None):
+        """
+        Plan of a statement from a follow-up EXPLAIN (with ANALYZE and BUFFERS for read only queries in
+        `explain_analyze` method), always rolled back
+
+        :rtype: dict
+        """
+        words = query.split(None, 1)
+        analyze = self.method == 'explain_analyze' and bool(words) and words[0].upper() in READ_ONLY_COMMANDS
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        method = 'explain_analyze' if analyze else 'explain'
+        if cursor.connection.autocommit:
+            begin, rollback = 'BEGIN', 'ROLLBACK'
+        else:
+            begin = 'SAVEPOINT profile_explain'
+            rollback = 'ROLLBACK TO SAVEPOINT profile_explain; RELEASE SAVEPOINT profile_explain'
+        cursor.execute(begin)
+        try:
+            cursor.execute('EXPLAIN ({}) {}'.format(options, query.strip().rstrip(';')), parameters)
+            plan = cursor.fetchone()[0]
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Unable to explain slow statement: {}'.format(str(e).strip()))
+            return {'method': method, 'error': str(e).strip()}
+        finally:
+            # Work done by EXPLAIN ANALYZE is thrown away
+            cursor.execute(rollback)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return {'method': method, 'plan': plan[0]}
+
+    def read_statement_stats(self, hook):
+        """
+        `pg_stat_statements` snapshot, on a connection of its own
+
+        :rtype: dict
+        """
+        conn = hook.get_conn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                return statement_stats(cursor)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Unable to read pg_stat_statements: {}'.format(str(e).strip()))
+            return None
+        finally:
+            conn.close()
+
+    def watch(self, hook):
+        """
+        Take the `pg_stat_statements` snapshot of task start on the database of `hook`
+        (the end snapshot is taken when the report is published)
+        """
+        self.hook = hook
+        self._stats_before = self.read_statement_stats(hook)
+
+    def summary(self):
+        with self._lock:
+            slow_statements = list(self.slow_statements)
+        return {
+            'threshold': self.threshold,
+            'method': self.method,
+            'slow_statements': sorted(slow_statements, key=lambda entry: entry['duration'], reverse=True),
+            'statement_stats': self.statement_stats,
+        }
+
+    def publish(self, context):
+        """
+        Compute `pg_stat_statements` deltas, log the report and push it to XCom (when a task instance
+        is in context)
+
+        :return: report
+        :rtype: dict
+        """
+        if self._stats_before is not None:
+            stats_after = self.read_statement_stats(self.hook)
+            if stats_after is not None:
+                self.statement_stats = statement_stats_delta(self._stats_before, stats_after)
+
+        summary = self.summary()
+        for entry in summary['slow_statements']:
+            logging.info('Slow statement ({:.1f}s, {} plan, {} buffer hits, {} reads): {}'.format(
+                entry['duration'], entry['method'], entry.get('shared_blks_hit'), entry.get('shared_blks_read'),
+                entry['query']))
+            if entry.get('plan'):
+                logging.info('Plan: {}'.format(json.dumps(entry['plan'])))
+        if summary['statement_stats']:
+            totals = summary['statement_stats']['totals']
+            logging.info('pg_stat_statements: {} calls, {:.2f}s, {} rows, {} buffer hits, {} reads'.format(
+                totals['calls'], totals['total_time'], totals['rows'], totals['shared_blks_hit'],
+                totals['shared_blks_read']))
+        task_instance = (context or {}).get('ti')
+        if task_instance is not None:
+            try:
+                task_instance.xcom_push(key=PROFILE_XCOM_KEY, value=summary)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning('Unable to push profile to XCom: {}'.format(str(e)))
+        return summary
+
+
+@contextmanager
+def task_profiler(operator, context):
+    """
+    Create the query profiler of an operator run when its `profile_threshold` is set (None otherwise),
+    publishing its report when the block exits
+
+        with task_metrics(self, context), task_profiler(self, context) as profiler:
+            ...
+
+    :param operator: running operator, with `profile_threshold` and `profile_method` attributes
+    :param context: task context
+    :rtype: QueryProfiler
+    """
+    if operator.profile_threshold is None:
+        operator.profiler = None
+        yield None
+        return
+    profiler = QueryProfiler(operator.profile_threshold, operator.profile_method, metrics=operator.metrics)
+    operator.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        profiler.publish(context)
+
+
+@contextmanager
+def profile_statement(profiler, cursor, query, parameters=None, explain=True):
+    """
+    `profiler.statement(...)`, or a block doing nothing when profiling is disabled (profiler is None)
+    """
+    if profiler is None:
+        yield
+        return
+    with profiler.statement(cursor, query, parameters, explain):
+        yield
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming S3 multipart upload, usable as a write-only file object.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logging = logging.getLogger(__name__)
+
+# S3 requires parts (but the last one) to have at least 5Mb
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+S3_PART_SIZE = 16 * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = 4
+
+
+class S3MultipartWriter(object):
+    """
+    Write-only file object uploading its content to S3 as a multipart upload.
+
+    Data is buffered in fixed size parts which are uploaded concurrently while the caller keeps
+    writing. At most `concurrency` parts are in flight, so memory is bounded by
+    `part_size * (concurrency + 1)`. Use as a context manager: upload is completed on success and
+    aborted if an exception is raised.
+
+    :param s3_client: boto3 S3 client (ex: `S3Hook.get_conn()`)
+    :param bucket_name: destination bucket
+    :type bucket_name: str
+    :param key: destination key
+    :type key: str
+    :param part_size: size of each uploaded part in bytes
+    :type part_size: int
+    :param concurrency: number of parts uploaded concurrently
+    :type concurrency: int
+    :param encrypt: use S3 server side encryption
+    :type encrypt: bool
+    :param extra_args: extra arguments to `create_multipart_upload` (ex: Metadata)
+    :type extra_args: dict
+    """
+
+    def __init__(self, s3_client, bucket_name, key,
+                 part_size=S3_PART_SIZE,
+                 concurrency=S3_UPLOAD_CONCURRENCY,
+                 encrypt=False,
+                 extra_args=None):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(part_size, S3_MIN_PART_SIZE)
+        self.concurrency = concurrency
+        self.extra_args = dict(extra_args or {})
+        if encrypt:
+            self.extra_args['ServerSideEncryption'] = 'AES256'
+        self.bytes_written = 0
+        # Seconds spent sending data to S3, summed over upload threads
+        self.elapsed = 0.0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._parts = []
+        self._futures = []
+        self._upload_id = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed S3MultipartWriter')
+        if isinstance(data, type(u'')):
+            data = data.encode('utf-8')
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        return self.bytes_written
+
+    def close(self):
+        """
+        Upload buffered data and complete the multipart upload
+        """
+        if self.closed:
+            return
+        try:
+            if self._upload_id is None:
+                # Small object: single request
+                started_at = time.time()
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key,
+                                          Body=bytes(self._buffer), **self.extra_args)
+                self.elapsed += time.time() - started_at
+            else:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                for future in self._futures:
+                    future.result()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.key, UploadId=self._upload_id,
+                    MultipartUpload={'Parts': sorted(self._parts, key=lambda p: p['PartNumber'])})
+            logging.info('Uploaded {}Mb to s3://{}/{} in {} parts'.format(
+                self.bytes_written >> 20, self.bucket_name, self.key, max(len(self._parts), 1)))
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self.closed = True
+            self._shutdown()
+
+    def abort(self):
+        """
+        Abort the multipart upload, discarding uploaded parts
+        """
+        self.closed = True
+        self._buffer = bytearray()
+        for future in self._futures:
+            future.cancel()
+        self._shutdown()
+        if self._upload_id is not None:
+            logging.warning('Aborting multipart upload of s3://{}/{}'.format(self.bucket_name, self.key))
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                      UploadId=self._upload_id)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error('Error trying to abort multipart upload: [{}]'.format(str(e)))
+            self._upload_id = None
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.key,
+                                                              **self.extra_args)
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        # Fail fast if a previous part failed
+        for future in self._futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+        part_number = len(self._futures) + 1
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._send_part, part_number, data)
+        except Exception:
+            self._slots.release()
+            raise
+        self._futures.append(future)
+
+    def _send_part(self, part_number, data):
+        started_at = time.time()
+        try:
+            response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.key,
+                                                  UploadId=self._upload_id,
+                                                  PartNumber=part_number, Body=data)
+            self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        finally:
+            with self._lock:
+                self.elapsed += time.time() - started_at
+            self._slots.release()
+
+    def _shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming helpers used to move data between COPY commands, compressors and S3 without
+materializing it in memory or on local disk.
+
+"""
+# pylint: disable=import-error,missing-docstring,too-few-public-methods
+import hashlib
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+PIPE_MAX_CHUNKS = 64
+PIPE_POLL_INTERVAL = 1
+
+
+class PipeAborted(IOError):
+    pass
+
+
+class BoundedPipe(object):
+    """
+    In-memory pipe with a bounded number of buffered chunks.
+
+    The writer side is a file-like object accepted by `cursor.copy_expert(... TO STDOUT)` and the
+    reader side one accepted by `cursor.copy_expert(... FROM STDIN)`. Writers block when the pipe is
+    full, so memory stays bounded by `max_chunks` times the COPY chunk size.
+
+    :param max_chunks: number of chunks buffered before writer blocks
+    :type max_chunks: int
+    """
+
+    _EOF = object()
+
+    def __init__(self, max_chunks=PIPE_MAX_CHUNKS):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = b''
+        self._eof = False
+        self._aborted = False
+        self._error = None
+        self.bytes_written = 0
+
+    # Writer side
+
+    def write(self, data):
+        if not data:
+            return 0
+        if isinstance(data, type(u'')):
+            data = data.encode('utf-8')
+        self._put(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close_writer(self, error=None):
+        """
+        Signal end of data. If `error` is given it is raised on the reader side.
+        """
+        self._error = error
+        try:
+            self._put(self._EOF)
+        except PipeAborted:
+            pass
+
+    def _put(self, item):
+        while True:
+            if self._aborted:
+                raise PipeAborted('Pipe reader was aborted')
+            try:
+                self._queue.put(item, timeout=PIPE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+
+    # Reader side
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._queue.get()
+            if chunk is self._EOF:
+                self._eof = True
+                if self._error is not None:
+                    raise PipeAborted('Pipe writer failed: {}'.format(str(self._error)))
+                break
+            self._buffer += chunk
+            if self._buffer and size is not None and size >= 0:
+                break
+
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def abort(self):
+        """
+        Stop the pipe from the reader side, unblocking (and failing) any pending writer.
+        """
+        self._aborted = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+
+class ProducerThread(threading.Thread):
+    """
+    Run `target(pipe)` in a background thread, closing the pipe writer when done.
+    Any exception raised by target is kept in `error` and forwarded to the pipe reader.
+    """
+
+    def __init__(self, target, pipe, name=None):
+        super(ProducerThread, self).__init__(name=name)
+        self.daemon = True
+        self.target = target
+        self.pipe = pipe
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self.pipe)
+        except Exception as e:  # pylint: disable=broad-except
+            self.error = e
+        finally:
+            self.pipe.close_writer(self.error)
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def get_decompressor(compression):
+    """
+    Return an object with a `decompress(data)` method for a compression name (None, gzip, zstd or lz4)
+    """
+    if compression is None:
+        return None
+    if compression == 'gzip':
+        # 16 + MAX_WBITS: expect gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard is required to read zstd files: pip install zstandard')
+        return zstandard.ZstdDecompressor().decompressobj()
+    if compression == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('lz4 is required to read lz4 files: pip install lz4')
+        return lz4.frame.LZ4FrameDecompressor()
+    raise ValueError('Unsupported compression [{}]'.format(compression))
+
+
+def guess_compression(file_name):
+    """
+    Guess compression from a file name extension
+
+    :rtype: str
+    """
+    if file_name.endswith('.gz') or file_name.endswith('.gzip'):
+        return 'gzip'
+    if file_name.endswith('.zst') or file_name.endswith('.zstd'):
+        return 'zstd'
+    if file_name.endswith('.lz4'):
+        return 'lz4'
+    return None
+
+
+class StreamReader(object):
+    """
+    Read-only file object over a raw binary stream (ex: S3 object body), decompressing it on
+    the fly and optionally skipping its first line. Accepted by `cursor.copy_expert(... FROM STDIN)`.
+
+    :param raw: object with a `read(size)` method
+    :param compression: None, `gzip`, `zstd` or `lz4`
+    :type compression: str
+    :param skip_header: discard data up to the first line break
+    :type skip_header: bool
+    :param chunk_size: bytes read from raw stream at a time
+    :type chunk_size: int
+    """
+
+    def __init__(self, raw, compression=None, skip_header=False, chunk_size=READ_CHUNK_SIZE):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.bytes_read = 0
+        self._decompressor = get_decompressor(compression)
+        self._skip_header = skip_header
+        self._buffer = b''
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while not self._eof and b'\n' not in self._buffer:
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        data, self._buffer = self._buffer[:end], self._buffer[end:]
+        return data
+
+    def _fill(self):
+        chunk = self.raw.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            if self._decompressor is not None and hasattr(self._decompressor, 'flush'):
+                data = self._decompressor.flush()
+            else:
+                data = b''
+        else:
+            self.bytes_read += len(chunk)
+            data = self._decompressor.decompress(chunk) if self._decompressor is not None else chunk
+            # Concatenated gzip members (ex: parallel gzip output) need a new decompressor each
+            while self.compression == 'gzip' and self._decompressor.eof and self._decompressor.unused_data:
+                unused_data = self._decompressor.unused_data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data += self._decompressor.decompress(unused_data)
+
+        if self._skip_header and data:
+            newline = data.find(b'\n')
+            if newline < 0:
+                return
+            data = data[newline + 1:]
+            self._skip_header = False
+        self._buffer += data
+
+
+class HashingWriter(object):
+    """
+    Write-only file object computing a digest of the data written through it
+
+    :param fileobj: writable file object receiving data
+    :param algorithm: hashlib algorithm name
+    :type algorithm: str
+    """
+
+    def __init__(self, fileobj, algorithm='md5'):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+        self.bytes_written = 0
+        self.elapsed = 0.0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        started_at = time.time()
+        self.hash.update(data)
+        self.elapsed += time.time() - started_at
+        self.bytes_written += len(data)
+        self.fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class HashingReader(object):
+    """
+    Read-only file object computing a digest of the data read through it
+
+    :param raw: object with a `read(size)` method
+    :param algorithm: hashlib algorithm name
+    :type algorithm: str
+    """
+
+    def __init__(self, raw, algorithm='md5'):
+        self.raw = raw
+        self.hash = hashlib.new(algorithm)
+        self.bytes_read = 0
+        self.elapsed = 0.0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        started_at = time.time()
+        self.hash.update(data)
+        self.elapsed += time.time() - started_at
+        self.bytes_read += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()